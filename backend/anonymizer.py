@@ -1,10 +1,14 @@
 # --- Imports ---
+import hashlib
+import itertools
+import os
+import socket
 import shutil
 import uuid
 import ipaddress
 import traceback
-from random import randint
-from typing import Dict, List, Callable, Optional, Union # Added Callable, Optional, Union
+from random import randbytes, randint
+from typing import Dict, List, Callable, Optional, Tuple, Union # Added Callable, Optional, Union
 
 # Scapy imports (ensure scapy[complete] is installed)
 # Suppress Scapy IPv6 warning if problematic, but better to have IPv6 enabled
@@ -17,6 +21,7 @@ from scapy.all import rdpcap, wrpcap, Ether, IP, TCP, UDP, ICMP, PacketList, Raw
 # FastAPI specific imports (needed for UploadFile, HTTPException, FileResponse)
 from fastapi import UploadFile, HTTPException
 from fastapi.responses import FileResponse
+from pydantic import TypeAdapter
 
 # Local imports
 from pathlib import Path # Added for dummy storage - will be removed if __main__ is removed
@@ -34,11 +39,36 @@ from backend.exceptions import JobCancelledException
 # SESSION_DIR is now managed by the storage module.
 # os.makedirs(SESSION_DIR, exist_ok=True) # REMOVED
 
-# --- Global Mappings (Consider if these should be session-specific) ---
-# These dictionaries maintain mapping consistency *within a single run* of apply_anonymization
-# or generate_preview. They reset if the backend restarts or between calls if not managed.
-ip_map: Dict[str, str] = {}
-mac_map: Dict[str, str] = {}
+# IPv4 string <-> int conversions go through these C-level helpers;
+# ipaddress is only used for IPv6 and CIDR parsing.
+_aton = socket.inet_aton
+_ntoa = socket.inet_ntoa
+
+
+def _int_to_ip(ip_int: int) -> str:
+    """Formats an int address as a string, IPv4 via inet_ntoa, anything larger via ipaddress."""
+    if ip_int <= 0xFFFFFFFF:
+        return _ntoa(ip_int.to_bytes(4, 'big'))
+    return str(ipaddress.ip_address(ip_int))
+
+
+def _mac_to_bytes(mac: str) -> bytes:
+    """Converts 'aa:bb:cc:dd:ee:ff' to its 6 raw bytes (raises ValueError if malformed)."""
+    return bytes.fromhex(mac.replace(':', ''))
+
+# Validates a whole stored rules list in one pydantic-core call
+_rule_list_adapter = TypeAdapter(List[Rule])
+
+# Column order of the preview returned by generate_preview
+PREVIEW_COLUMNS = (
+    'src_ip', 'dst_ip', 'src_mac', 'dst_mac',
+    'anon_src_ip', 'anon_dst_ip', 'anon_src_mac', 'anon_dst_mac',
+)
+
+# --- Mappings ---
+# IP/MAC mappings only need to be consistent *within a single run* of apply_anonymization
+# or generate_preview, so each call owns its maps (and FallbackIpPool) and passes them to
+# the helpers explicitly. No module-level state, so concurrent jobs don't interfere.
 
 # --- Helper Functions ---
 
@@ -56,62 +86,137 @@ def anon_mac(mac: str) -> str:
         return ':'.join(f'{randint(0, 255):02X}' for _ in range(6))
 
 
-def anon_ip(ip: str, rules: List[Rule], current_ip_map: Dict[str, str]) -> str:
+def anon_mac_bytes(mac: bytes) -> bytes:
+    """Same as anon_mac for a 6-byte MAC: keeps the 3-byte OUI, randomizes the rest."""
+    return mac[:3] + randbytes(3)
+
+
+def _mac_from_map(mac_key: bytes, current_mac_map: Dict[bytes, str]) -> str:
+    """Returns the anonymized MAC string for mac_key, creating the mapping on first use."""
+    anon = current_mac_map.get(mac_key)
+    if anon is None:
+        # Stringified once per MAC, in the same upper-case format anon_mac produces
+        anon = current_mac_map[mac_key] = anon_mac_bytes(mac_key).hex(':').upper()
+    return anon
+
+
+def anon_ip(ip: str, compiled_rules: List[Tuple[int, int, int, int, int]], fallback_pool: "FallbackIpPool") -> str:
     """
     Translates an IP address based on user-defined CIDR rules.
-    Falls back to a unique random 10.x.x.x address for the session if no rule matches.
-    Uses the provided current_ip_map to ensure uniqueness of fallback IPs.
+    `compiled_rules` are the int tuples built once by compile_rules().
+    Falls back to a unique 10.x.x.x address from fallback_pool if no rule matches.
     """
     try:
-        ip_addr = ipaddress.ip_address(ip)
+        try:
+            packed = _aton(ip)
+            ip_version, max_prefixlen = 4, 32
+        except OSError:
+            # Not dotted-quad IPv4, let ipaddress handle IPv6 (raises ValueError if invalid)
+            ip_addr = ipaddress.ip_address(ip)
+            packed = ip_addr.packed
+            ip_version, max_prefixlen = ip_addr.version, ip_addr.max_prefixlen
+        ip_int = int.from_bytes(packed, 'big')
         # Check against user rules first (rules should be pre-sorted by specificity)
-        for rule_model in rules:
-            # Use .model_dump() or .dict() if using older Pydantic
-            rule = rule_model.model_dump(by_alias=False)
-            src_key = rule.get('source')
-            tgt_key = rule.get('target')
-            if not (src_key and tgt_key):
-                continue # Skip invalid rules
-
-            try:
-                net_from = ipaddress.ip_network(src_key, strict=False)
-                if ip_addr in net_from:
-                    net_to = ipaddress.ip_network(tgt_key, strict=False)
-                    # Calculate offset within the source network
-                    offset = int(ip_addr) - int(net_from.network_address)
-                    # Apply offset to the target network, handling network size differences
-                    if offset < net_to.num_addresses:
-                        new_ip_int = int(net_to.network_address) + offset
-                        # Ensure the new IP is within the target network bounds
-                        if new_ip_int <= int(net_to.broadcast_address):
-                             new_ip_str = str(ipaddress.ip_address(new_ip_int))
-                             return new_ip_str # Return the successfully translated IP
-                    # If offset doesn't fit or rule is otherwise unusable
-                    logging.debug(f"anon_ip: Offset issue or rule unusable for IP {ip} with rule {src_key} -> {tgt_key}. Falling back.")
-                    # If the specific rule matched but offset failed, break the loop to force fallback
-                    break # Exit the rule loop to force fallback below
-
-            except ValueError as e:
-                continue # Skip rule if CIDRs are invalid
-
-        # Fallback: random 10.x.x.x unique across the current ip_map values
+        for version, net_from, prefixlen, net_to, to_num_addresses in compiled_rules:
+            if version != ip_version:
+                continue
+            shift = max_prefixlen - prefixlen
+            if (ip_int >> shift) == (net_from >> shift):
+                # Calculate offset within the source network and apply it to the target network
+                offset = ip_int - net_from
+                if offset < to_num_addresses:
+                    fallback_pool.mark_used(net_to + offset)
+                    return _int_to_ip(net_to + offset)
+                # If the specific rule matched but offset failed, break the loop to force fallback
+                logging.debug(f"anon_ip: Offset {offset} of IP {ip} doesn't fit target network of matching rule. Falling back.")
+                break
+
+        # Fallback: unique 10.x.x.x from the pool
         # Reached ONLY if the loop completes without returning a translated IP or breaking due to offset issue
-        attempts = 0
-        while attempts < 1000: # Limit attempts to prevent hangs
-            rand_ip = f"10.{randint(0, 255)}.{randint(0, 255)}.{randint(1, 254)}"
-            # Ensure the generated random IP is not already a target value for another original IP
-            if rand_ip not in current_ip_map.values(): # Use current_ip_map
-                 return rand_ip
-            attempts += 1
-        # If we can't find a unique random IP after many attempts
-        logging.warning(f"Could not generate unique random IP for {ip} after {attempts} attempts.")
-        fallback_ip = f"10.255.255.{randint(1,254)}"
-        return fallback_ip
+        return fallback_pool.allocate(packed)
 
     except ValueError:
         logging.warning(f"anon_ip: Invalid original IP address format '{ip}'. Returning as is.")
         return ip # Return original if it's not a valid IP
 
+
+class FallbackIpPool:
+    """
+    Hands out unique 10.x.x.x addresses for IPs that no rule maps.
+
+    The start address is a keyed BLAKE2b hash of the original IP, so the same
+    IP always lands on the same slot within a run. Collisions are resolved by
+    linear probing over a one-bit-per-address bitmap of 10.0.0.0/8; addresses
+    ending in .0 or .255 are never handed out. Create one pool per run, next
+    to the IP map it fills.
+    """
+
+    _SPACE = 1 << 24 # Addresses in 10.0.0.0/8
+    _CAPACITY = (1 << 16) * 254 # Minus the .0 and .255 addresses
+
+    def __init__(self, salt: Optional[bytes] = None):
+        self.salt = salt if salt is not None else os.urandom(16)
+        self._used = bytearray(self._SPACE >> 3)
+        self._count = 0
+
+    def mark_used(self, ip_int: int) -> None:
+        """Reserves an address a rule mapped into 10.0.0.0/8 so fallbacks don't reuse it."""
+        if (ip_int >> 24) != 10:
+            return
+        slot = ip_int & 0xFFFFFF
+        byte, bit = slot >> 3, 1 << (slot & 7)
+        if not self._used[byte] & bit:
+            self._used[byte] |= bit
+            if 0 < (slot & 0xFF) < 255: # Only count addresses allocate() could hand out
+                self._count += 1
+
+    def allocate(self, packed_ip: bytes) -> str:
+        """Returns a 10.x.x.x address not yet handed out or reserved in this pool."""
+        used = self._used
+        slot = int.from_bytes(hashlib.blake2b(packed_ip, digest_size=3, key=self.salt).digest(), 'big')
+        if self._count >= self._CAPACITY:
+            logging.warning("Fallback IP pool exhausted. Reusing addresses in 10.0.0.0/8.")
+            return f"10.{(slot >> 16) & 0xFF}.{(slot >> 8) & 0xFF}.{(slot & 0xFF) or 1}"
+        while True:
+            last_octet = slot & 0xFF
+            if last_octet != 0 and last_octet != 255 and not used[slot >> 3] & (1 << (slot & 7)):
+                break
+            slot = (slot + 1) & 0xFFFFFF
+        used[slot >> 3] |= 1 << (slot & 7)
+        self._count += 1
+        return f"10.{(slot >> 16) & 0xFF}.{(slot >> 8) & 0xFF}.{slot & 0xFF}"
+
+
+# --- Rule Compilation ---
+
+def compile_rules(rules: List[Rule]) -> List[Tuple[int, int, int, int, int]]:
+    """
+    Converts sorted Rule models into int tuples so the per-IP matching doesn't
+    have to parse CIDR strings again.
+
+    Each tuple is (ip_version, source_network_int, source_prefixlen,
+    target_network_int, target_num_addresses). Rules with invalid CIDRs are
+    skipped, the order of the input list is kept.
+    """
+    compiled = []
+    for rule in rules:
+        if not (rule.source and rule.target):
+            continue
+        try:
+            net_from = ipaddress.ip_network(rule.source, strict=False)
+            net_to = ipaddress.ip_network(rule.target, strict=False)
+        except ValueError:
+            continue
+        compiled.append((
+            net_from.version,
+            int(net_from.network_address),
+            net_from.prefixlen,
+            int(net_to.network_address),
+            net_to.num_addresses,
+        ))
+    return compiled
+
+
 # --- Core API Logic Functions (IP/MAC Anonymization) ---
 
 # --- MODIFIED save_rules to accept physical session ID and rules list ---
@@ -143,68 +248,103 @@ def save_rules(session_id: str, rules: List[Dict]):
 
 def generate_preview(session_id: str, input_pcap_filename: str):
     """Generates a preview of anonymized data based on saved rules."""
-    global ip_map, mac_map
-    # Use temporary maps for preview to avoid polluting global state used by apply_anonymization
+    # Maps local to this preview; apply_anonymization builds its own
     temp_ip_map: Dict[str, str] = {}
     temp_mac_map: Dict[str, str] = {}
+    temp_ip_pool = FallbackIpPool()
 
     try:
         rules_data = storage.get_rules(session_id) # Use new storage method
         if rules_data is None: # Handle case where rules might not exist
             rules_data = []
-        rules_models = [Rule(**rule_data) for rule_data in rules_data]
+        rules_models = _rule_list_adapter.validate_python(rules_data)
         # Sort rules for preview consistency (same logic as apply)
         rules_models.sort(key=lambda rule: ipaddress.ip_network(rule.source, strict=False).prefixlen, reverse=True)
-        # path = storage.get_capture_path(session_id) # No longer needed directly
-        packets = storage.read_pcap_from_session(session_id, filename=input_pcap_filename) # Use new storage method
-    except FileNotFoundError: # Raised by read_pcap_from_session if file not found
+        compiled_rules = compile_rules(rules_models)
+        # Stream the capture; the preview only looks at its head
+        reader = storage.open_pcap_reader(session_id, filename=input_pcap_filename)
+    except FileNotFoundError: # Raised by open_pcap_reader if file not found
          raise HTTPException(status_code=404, detail=f"Session data or PCAP file '{input_pcap_filename}' not found for preview.")
     except Exception as e: # Other errors from storage or rule processing
          raise HTTPException(status_code=500, detail=f"Error loading data for preview (file '{input_pcap_filename}'): {e}")
 
     seen = set()
-    preview = []
+    # Column-oriented result: one list per field instead of two dicts per flow
+    columns: Dict[str, List[str]] = {name: [] for name in PREVIEW_COLUMNS}
+    src_ips, dst_ips = columns['src_ip'], columns['dst_ip']
+    src_macs, dst_macs = columns['src_mac'], columns['dst_mac']
+    a_src_ips, a_dst_ips = columns['anon_src_ip'], columns['anon_dst_ip']
+    a_src_macs, a_dst_macs = columns['anon_src_mac'], columns['anon_dst_mac']
     # Limit preview to a reasonable number of unique flows to avoid large responses/long processing
     preview_limit = 100
+    # Only scan the head of the capture; a preview doesn't need every flow in the file
+    scan_limit = preview_limit * 10
     count = 0
-    for pkt in packets:
-        if count >= preview_limit:
-            break
-        if Ether in pkt and IP in pkt:
-            src_ip = pkt[IP].src if hasattr(pkt[IP], 'src') else None
-            dst_ip = pkt[IP].dst if hasattr(pkt[IP], 'dst') else None
-            src_mac = pkt[Ether].src if hasattr(pkt[Ether], 'src') else None
-            dst_mac = pkt[Ether].dst if hasattr(pkt[Ether], 'dst') else None
-
-            if not all([src_ip, dst_ip, src_mac, dst_mac]):
-                continue
+    with reader:
+        for pkt in itertools.islice(reader, scan_limit):
+            if Ether in pkt and IP in pkt:
+                src_ip = pkt[IP].src if hasattr(pkt[IP], 'src') else None
+                dst_ip = pkt[IP].dst if hasattr(pkt[IP], 'dst') else None
+                src_mac = pkt[Ether].src if hasattr(pkt[Ether], 'src') else None
+                dst_mac = pkt[Ether].dst if hasattr(pkt[Ether], 'dst') else None
+
+                if not all([src_ip, dst_ip, src_mac, dst_mac]):
+                    continue
+
+                try:
+                    # 20-byte packed key: one bytes hash instead of hashing four strings
+                    key = _aton(src_ip) + _aton(dst_ip) + _mac_to_bytes(src_mac) + _mac_to_bytes(dst_mac)
+                except (OSError, ValueError):
+                    key = (src_ip, dst_ip, src_mac, dst_mac)
+                if key in seen:
+                    continue
+                seen.add(key)
+
+                # Call anon_ip for preview, passing the temporary map
+                anon_src_ip = temp_ip_map.get(src_ip)
+                if anon_src_ip is None:
+                    anon_src_ip = temp_ip_map[src_ip] = anon_ip(src_ip, compiled_rules, temp_ip_pool)
+                anon_dst_ip = temp_ip_map.get(dst_ip)
+                if anon_dst_ip is None:
+                    anon_dst_ip = temp_ip_map[dst_ip] = anon_ip(dst_ip, compiled_rules, temp_ip_pool)
+                anon_src_mac = temp_mac_map.setdefault(src_mac, anon_mac(src_mac))
+                anon_dst_mac = temp_mac_map.setdefault(dst_mac, anon_mac(dst_mac))
+
+                src_ips.append(src_ip)
+                dst_ips.append(dst_ip)
+                src_macs.append(src_mac)
+                dst_macs.append(dst_mac)
+                a_src_ips.append(anon_src_ip)
+                a_dst_ips.append(anon_dst_ip)
+                a_src_macs.append(anon_src_mac)
+                a_dst_macs.append(anon_dst_mac)
+                count += 1
+                if count == preview_limit:
+                    break
+    logging.info(f"Preview generated for session {session_id} from '{input_pcap_filename}' (limit: {preview_limit} flows)")
+    return {"columns": columns, "rows": count}
 
-            key = (src_ip, dst_ip, src_mac, dst_mac)
-            if key in seen:
-                continue
-            seen.add(key)
-            count += 1
 
-            original = {
+def preview_to_rows(preview: Dict) -> List[Dict[str, Dict[str, str]]]:
+    """
+    Expands the column-oriented result of generate_preview into the
+    [{'original': {...}, 'anonymized': {...}}, ...] list the API returns.
+    """
+    columns = preview["columns"]
+    return [
+        {
+            'original': {
                 'src_ip': src_ip, 'dst_ip': dst_ip,
                 'src_mac': src_mac, 'dst_mac': dst_mac,
-            }
-
-            # Call anon_ip for preview, passing the temporary map
-            anon_src_ip = temp_ip_map.setdefault(src_ip, anon_ip(src_ip, rules_models, temp_ip_map))
-            anon_dst_ip = temp_ip_map.setdefault(dst_ip, anon_ip(dst_ip, rules_models, temp_ip_map))
-            anon_src_mac = temp_mac_map.setdefault(src_mac, anon_mac(src_mac))
-            anon_dst_mac = temp_mac_map.setdefault(dst_mac, anon_mac(dst_mac))
-
-            anonymized = {
-                'src_ip': anon_src_ip,
-                'dst_ip': anon_dst_ip,
-                'src_mac': anon_src_mac,
-                'dst_mac': anon_dst_mac,
-            }
-            preview.append({'original': original, 'anonymized': anonymized})
-    logging.info(f"Preview generated for session {session_id} from '{input_pcap_filename}' (limit: {preview_limit} flows)")
-    return preview
+            },
+            'anonymized': {
+                'src_ip': a_src_ip, 'dst_ip': a_dst_ip,
+                'src_mac': a_src_mac, 'dst_mac': a_dst_mac,
+            },
+        }
+        for src_ip, dst_ip, src_mac, dst_mac, a_src_ip, a_dst_ip, a_src_mac, a_dst_mac
+        in zip(*(columns[name] for name in PREVIEW_COLUMNS))
+    ]
 
 
 # --- MODIFIED apply_anonymization with progress and cancellation callbacks ---
@@ -230,18 +370,19 @@ def apply_anonymization(
     Returns:
         A dictionary containing information about the output.
     """
-    global ip_map, mac_map
-    ip_map.clear()
-    mac_map.clear()
+    ip_map: Dict[str, str] = {}
+    mac_map: Dict[bytes, str] = {} # Keyed by the 6 raw MAC bytes
+    ip_pool = FallbackIpPool()
     logging.info(f"Starting IP/MAC anonymization: Input Trace ID {input_trace_id}, Input File '{input_pcap_filename}' -> Output Trace ID {new_output_trace_id}, Output File '{output_pcap_filename}'")
 
     try:
         rules_data = storage.get_rules(input_trace_id) # Use input_trace_id for rules
         if rules_data is None:
             rules_data = []
-        rules_models = [Rule(**rule_data) for rule_data in rules_data]
+        rules_models = _rule_list_adapter.validate_python(rules_data)
 
         rules_models.sort(key=lambda rule: ipaddress.ip_network(rule.source, strict=False).prefixlen, reverse=True)
+        compiled_rules = compile_rules(rules_models)
 
         logging.info(f"Reading packets for input trace {input_trace_id}, file '{input_pcap_filename}' using storage module...")
         packets: PacketList = storage.read_pcap_from_session(input_trace_id, filename=input_pcap_filename)
@@ -253,8 +394,9 @@ def apply_anonymization(
         logging.error(f"Error loading data for anonymization (input trace {input_trace_id}, file '{input_pcap_filename}'): {e}")
         raise
 
-    new_packets = []
     total_packets = len(packets)
+    # One slot per input packet, filled by index below
+    new_packets: List[Optional[Packet]] = [None] * total_packets
     last_reported_progress = -1
 
     logging.info(f"Processing {total_packets} packets for anonymization...")
@@ -273,32 +415,60 @@ def apply_anonymization(
 
         try:
             if Ether in pkt and IP in pkt:
-                processed_packet = pkt.copy()
-                original_src_ip = processed_packet[IP].src if hasattr(processed_packet[IP], 'src') else 'N/A'
-                original_dst_ip = processed_packet[IP].dst if hasattr(processed_packet[IP], 'dst') else 'N/A'
-
-                if hasattr(processed_packet[Ether], 'src'):
-                    processed_packet[Ether].src = mac_map.setdefault(processed_packet[Ether].src, anon_mac(processed_packet[Ether].src))
-                if hasattr(processed_packet[Ether], 'dst'):
-                    processed_packet[Ether].dst = mac_map.setdefault(processed_packet[Ether].dst, anon_mac(processed_packet[Ether].dst))
-
-                resolved_src_ip = 'N/A'
-                resolved_dst_ip = 'N/A'
-
-                if hasattr(processed_packet[IP], 'src'):
-                    resolved_src_ip = ip_map.setdefault(original_src_ip, anon_ip(original_src_ip, rules_models, ip_map))
-                    processed_packet[IP].src = resolved_src_ip
-                if hasattr(processed_packet[IP], 'dst'):
-                    resolved_dst_ip = ip_map.setdefault(original_dst_ip, anon_ip(original_dst_ip, rules_models, ip_map))
-                    processed_packet[IP].dst = resolved_dst_ip
+                ether_layer = pkt[Ether]
+                ip_layer = pkt[IP]
+                original_src_ip = ip_layer.src if hasattr(ip_layer, 'src') else 'N/A'
+                original_dst_ip = ip_layer.dst if hasattr(ip_layer, 'dst') else 'N/A'
+                original_src_mac = ether_layer.src if hasattr(ether_layer, 'src') else None
+                original_dst_mac = ether_layer.dst if hasattr(ether_layer, 'dst') else None
+
+                # Resolve all new values first, then only copy the packet if one of them differs
+                # MAC keys are sliced straight from the frame bytes when the packet was read from disk
+                raw = pkt.original if isinstance(pkt, Ether) and pkt.original and len(pkt.original) >= 12 else None
+                new_src_mac = new_dst_mac = None
+                if original_src_mac is not None:
+                    src_mac_key = raw[6:12] if raw else _mac_to_bytes(original_src_mac)
+                    new_src_mac = _mac_from_map(src_mac_key, mac_map)
+                if original_dst_mac is not None:
+                    dst_mac_key = raw[0:6] if raw else _mac_to_bytes(original_dst_mac)
+                    new_dst_mac = _mac_from_map(dst_mac_key, mac_map)
+
+                resolved_src_ip = resolved_dst_ip = None
+
+                # Each address is resolved by anon_ip once per run, then read from ip_map
+                if hasattr(ip_layer, 'src'):
+                    resolved_src_ip = ip_map.get(original_src_ip)
+                    if resolved_src_ip is None:
+                        resolved_src_ip = ip_map[original_src_ip] = anon_ip(original_src_ip, compiled_rules, ip_pool)
+                if hasattr(ip_layer, 'dst'):
+                    resolved_dst_ip = ip_map.get(original_dst_ip)
+                    if resolved_dst_ip is None:
+                        resolved_dst_ip = ip_map[original_dst_ip] = anon_ip(original_dst_ip, compiled_rules, ip_pool)
+
+                changed = (
+                    (new_src_mac is not None and new_src_mac.lower() != original_src_mac.lower())
+                    or (new_dst_mac is not None and new_dst_mac.lower() != original_dst_mac.lower())
+                    or (resolved_src_ip is not None and resolved_src_ip != original_src_ip)
+                    or (resolved_dst_ip is not None and resolved_dst_ip != original_dst_ip)
+                )
+                if changed:
+                    processed_packet = pkt.copy()
+                    if new_src_mac is not None:
+                        processed_packet[Ether].src = new_src_mac
+                    if new_dst_mac is not None:
+                        processed_packet[Ether].dst = new_dst_mac
+                    if resolved_src_ip is not None:
+                        processed_packet[IP].src = resolved_src_ip
+                    if resolved_dst_ip is not None:
+                        processed_packet[IP].dst = resolved_dst_ip
+
+                    del processed_packet[IP].chksum
+                    if TCP in processed_packet: del processed_packet[TCP].chksum
+                    if UDP in processed_packet: del processed_packet[UDP].chksum
+                    if ICMP in processed_packet: del processed_packet[ICMP].chksum
 
                 anon_src_ip_final = processed_packet[IP].src
                 anon_dst_ip_final = processed_packet[IP].dst
-
-                del processed_packet[IP].chksum
-                if TCP in processed_packet: del processed_packet[TCP].chksum
-                if UDP in processed_packet: del processed_packet[UDP].chksum
-                if ICMP in processed_packet: del processed_packet[ICMP].chksum
             else:
                  if IP in processed_packet:
                       anon_src_ip_final = processed_packet[IP].src
@@ -306,10 +476,10 @@ def apply_anonymization(
                  else:
                       anon_src_ip_final = 'N/A (No IP)'
                       anon_dst_ip_final = 'N/A (No IP)'
-            new_packets.append(processed_packet)
+            new_packets[i] = processed_packet
         except Exception as packet_err:
              logging.warning(f"Error processing packet {i+1}/{total_packets} in input trace {input_trace_id}: {packet_err}. Appending original.")
-             new_packets.append(pkt)
+             new_packets[i] = pkt
 
         if progress_callback and total_packets > 0:
             current_progress = int(((i + 1) / total_packets) * 100)
@@ -322,7 +492,15 @@ def apply_anonymization(
 
     try:
         logging.info(f"Writing {len(new_packets)} processed packets to '{output_pcap_filename}' for new output trace {new_output_trace_id} using storage module...")
-        output_path_obj = storage.write_pcap_to_session(new_output_trace_id, output_pcap_filename, PacketList(new_packets)) # Ensure PacketList
+        if all(isinstance(new_pkt, Ether) for new_pkt in new_packets):
+            linktype, snaplen = storage.read_pcap_link_info(input_trace_id, input_pcap_filename)
+            records = (_pcap_record(pkt, new_pkt) for pkt, new_pkt in zip(packets, new_packets))
+            output_path_obj = storage.write_pcap_records_to_session(
+                new_output_trace_id, output_pcap_filename, records, linktype=linktype, snaplen=snaplen
+            )
+        else:
+            # Mixed/non-Ethernet link types: let Scapy pick the linktype per file
+            output_path_obj = storage.write_pcap_to_session(new_output_trace_id, output_pcap_filename, PacketList(new_packets)) # Ensure PacketList
         logging.info(f"Successfully wrote anonymized file: {str(output_path_obj)}")
     except Exception as e:
         logging.error(f"Error writing anonymized pcap file for new output trace {new_output_trace_id} to '{output_pcap_filename}': {e}")
@@ -335,6 +513,21 @@ def apply_anonymization(
     }
 
 
+def _pcap_record(pkt: Packet, new_pkt: Packet) -> Tuple[int, int, bytes, int]:
+    """
+    Builds the (ts_sec, ts_usec, frame_bytes, wire_len) record written for new_pkt.
+    Packets left untouched reuse the bytes read from the input file; only
+    rewritten packets go through Scapy's build.
+    """
+    frame = pkt.original if new_pkt is pkt and pkt.original else bytes(new_pkt)
+    ts = new_pkt.time
+    ts_sec = int(ts)
+    ts_usec = int(round((ts - ts_sec) * 1000000))
+    if ts_usec >= 1000000:
+        ts_sec, ts_usec = ts_sec + 1, ts_usec - 1000000
+    return ts_sec, ts_usec, frame, max(len(frame), new_pkt.wirelen or 0)
+
+
 # --- Backward Compatibility / Download Helper ---
 def apply_anonymization_response(session_id: str, filename: str):
     """
@@ -387,11 +580,10 @@ def get_subnets(session_id: str, input_pcap_filename: str):
     invalid_ips_count = 0
     for ip_str in all_ips:
         try:
-            # Calculate the /24 network for each valid IP
-            network = ipaddress.ip_network(f"{ip_str}/24", strict=False)
-            cidr = str(network)
+            # Calculate the /24 network for each valid IP by zeroing the last octet
+            cidr = f"{_ntoa(_aton(ip_str)[:3] + bytes(1))}/24"
             subnets[cidr] = subnets.get(cidr, 0) + 1
-        except ValueError:
+        except OSError:
             # Count invalid IP formats encountered
             invalid_ips_count += 1
             logging.warning(f"Invalid IP format encountered in get_subnets: {ip_str}")
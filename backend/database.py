@@ -1,9 +1,15 @@
 # File: database.py
 
+import json
 import os
-from typing import Optional, Generator, Dict # Needed for the session generator and JSON field
-from sqlmodel import Field, SQLModel, create_engine, Session, JSON, Column # Key SQLModel imports
-from datetime import datetime # For timestamps
+import zlib
+from typing import Optional, AsyncGenerator, Dict # Needed for the session generator and JSON field
+from sqlalchemy import LargeBinary, event
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlmodel import Field, SQLModel, create_engine, JSON, Column # Key SQLModel imports
+from sqlmodel.ext.asyncio.session import AsyncSession
+from datetime import datetime, timezone # For timestamps
 
 # --- Database File Location and URL Definition ---
 
@@ -15,6 +21,8 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # sqlite:/// means a relative path from the current working directory when running
 # We use an absolute path here to avoid issues with the execution directory
 DATABASE_URL = f"sqlite:///{os.path.join(BASE_DIR, DATABASE_FILE)}"
+# Same database through the aiosqlite driver, for the request handlers
+ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{os.path.join(BASE_DIR, DATABASE_FILE)}"
 
 # --- Database Engine ---
 
@@ -24,9 +32,57 @@ DATABASE_URL = f"sqlite:///{os.path.join(BASE_DIR, DATABASE_FILE)}"
 engine = create_engine(DATABASE_URL, echo=False, connect_args={"check_same_thread": False})
 # echo=False will prevent SQLModel from printing every SQL statement
 
+# The request handlers use the async engine so DB I/O doesn't block the event loop.
+# The sync 'engine' above stays for table creation and the background job threads.
+async_engine = create_async_engine(ASYNC_DATABASE_URL, echo=False)
+# expire_on_commit=False: objects stay readable after commit without an implicit
+# (synchronous) reload, which AsyncSession can't do
+async_session_factory = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+@event.listens_for(engine, "connect")
+@event.listens_for(async_engine.sync_engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Write-ahead logging: job progress commits from the background threads no
+    longer block the API's readers (nor wait for them), and with
+    synchronous=NORMAL a commit doesn't fsync (WAL is still crash-safe).
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
 
 # --- Table Model Definition using SQLModel ---
 
+def utc_now() -> datetime:
+    """Timezone-aware replacement for the deprecated datetime.utcnow()."""
+    return datetime.now(timezone.utc)
+
+
+class CompressedJSON(TypeDecorator):
+    """
+    JSON stored zlib-compressed, for large and repetitive documents such as the
+    DICOM extraction results. Values stored as plain JSON text (by a JSON
+    column, before) are still read.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return zlib.compress(json.dumps(value, separators=(",", ":")).encode())
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str): # Uncompressed JSON text
+            return json.loads(value)
+        return json.loads(zlib.decompress(value))
+
+
 # This class defines BOTH the database table structure
 # and the Pydantic model for API validation and serialization.
 class PcapSession(SQLModel, table=True):
@@ -44,7 +100,7 @@ class PcapSession(SQLModel, table=True):
 
     # Timestamp of when the session was uploaded/created
     # default_factory ensures a new timestamp is generated whenever a record is created
-    upload_timestamp: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+    upload_timestamp: datetime = Field(default_factory=utc_now, nullable=False, index=True) # Ordering/pagination of /sessions
 
     # Path where the original .pcap file is stored (relative or absolute)
     pcap_path: str = Field(nullable=False)
@@ -59,7 +115,7 @@ class PcapSession(SQLModel, table=True):
     #     default=None, sa_column_kwargs={"onupdate": datetime.utcnow}
     # )
     # Simpler, more compatible alternative if DB-level onupdate isn't strictly needed:
-    updated_at: Optional[datetime] = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = Field(default_factory=utc_now)
 
     # --- Fields for Transformed PCAPs (Task 3) ---
     is_transformed: bool = Field(default=False, index=True)
@@ -78,8 +134,8 @@ class AsyncJob(SQLModel, table=True):
     status: str = Field(default="pending", index=True, nullable=False) # 'pending', 'running', 'cancelling', 'completed', 'failed', 'cancelled'
     stop_requested: bool = Field(default=False, nullable=False) # Flag to signal task cancellation
     progress: int = Field(default=0)
-    # Store DICOM results as JSON. Use Column(JSON) for cross-DB compatibility.
-    result_data: Optional[Dict] = Field(default=None, sa_column=Column(JSON))
+    # Store DICOM results as (compressed) JSON
+    result_data: Optional[Dict] = Field(default=None, sa_column=Column(CompressedJSON))
     error_message: Optional[str] = Field(default=None)
     # Add trace_name to store the user-friendly name associated with the session at job creation time
     trace_name: Optional[str] = Field(default=None, description="User-provided name for the input trace at job creation")
@@ -87,8 +143,18 @@ class AsyncJob(SQLModel, table=True):
     # New field for the output trace ID
     output_trace_id: Optional[str] = Field(default=None, foreign_key="pcapsession.id", index=True, nullable=True, description="ID of the PcapSession created as output by this job")
 
-    created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
-    updated_at: Optional[datetime] = Field(default_factory=datetime.utcnow) # Consider adding onupdate logic if needed
+    created_at: datetime = Field(default_factory=utc_now, nullable=False, index=True) # Ordering/pagination of /jobs
+    updated_at: Optional[datetime] = Field(default_factory=utc_now) # Consider adding onupdate logic if needed
+
+
+# --- DICOM Metadata Overrides Table ---
+
+class DicomMetadataOverride(SQLModel, table=True):
+    # One row per (session, IP pair), so saving the overrides of one pair
+    # doesn't rewrite those of every other pair of the session
+    session_id: str = Field(foreign_key="pcapsession.id", primary_key=True)
+    ip_pair_key: str = Field(primary_key=True) # e.g., "192.168.1.10-192.168.1.20"
+    overrides: Dict = Field(default_factory=dict, sa_column=Column(JSON, nullable=False))
 
 
 # --- Function to Create the Database and Tables ---
@@ -99,20 +165,25 @@ def create_db_and_tables():
     # SQLModel.metadata contains info about all classes inheriting from SQLModel with table=True
     # create_all creates them in the database connected via the engine if they don't already exist.
     SQLModel.metadata.create_all(engine)
+    # create_all only creates indexes along with new tables: add the ones
+    # declared since an existing database was created
+    for table in SQLModel.metadata.tables.values():
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
     print("Database and tables should be created if they didn't exist.")
 
 
 # --- Database Session Management (FastAPI Pattern) ---
 
-def get_session() -> Generator[Session, None, None]:
+async def get_session() -> AsyncGenerator[AsyncSession, None]:
     """
-    FastAPI dependency generator to get a database session per request.
+    FastAPI dependency generator to get an async database session per request.
     Ensures the session is always closed, even if errors occur.
     """
-    # Session(engine) creates a session object bound to our engine
-    with Session(engine) as session:
+    # The factory creates an AsyncSession bound to the async engine
+    async with async_session_factory() as session:
         try:
             yield session # Provide the session to the endpoint function
         finally:
             # This finally block ensures the session is closed at the end of the request
-            session.close()
+            await session.close()
@@ -11,24 +11,34 @@
 # 5. Manufacturer’s Model Name
 # 6. A-Associated
 
+import hashlib
 import io
 import logging
+import mmap
 import struct
+import time
 import os
+import pickle
+import socket
 import traceback
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
 from collections import defaultdict
+from operator import itemgetter
 from typing import Dict, List, Optional, Tuple, Any
 
 import re # Import regex module
 import pydicom
 from pydicom.errors import InvalidDicomError
+from pydicom.multival import MultiValue
 # from pydicom.uid import UID, ImplicitVRLittleEndian, ExplicitVRLittleEndian, DeflatedExplicitVRLittleEndian, ExplicitVRBigEndian # Not strictly needed for this logic
 
+logger = logging.getLogger(__name__)
+
 # Scapy imports
 logging.getLogger("scapy.runtime").setLevel(logging.ERROR)
 try:
     # Try importing DICOM layer if available in Scapy contrib
-    from scapy.all import rdpcap, TCP, IP, Raw # type: ignore
+    from scapy.all import TCP, IP, Raw, conf # type: ignore
     from scapy.sessions import TCPSession # type: ignore
     try:
         from scapy.contrib.dicom import DicomAssociateRQ, DicomAssociateAC # type: ignore
@@ -43,56 +53,156 @@ except ImportError as e:
     pass
 
 
-# Import storage utilities and necessary models
+# dpkt is optional: when installed it replaces Scapy for the packet loop, which
+# only needs IP/TCP header fields and the TCP payload, not a full dissection.
 try:
-    from storage import get_capture_path, SESSION_DIR # type: ignore
-    # *** IMPORTANT: Assume DicomExtractedMetadata is defined elsewhere (e.g., models.py) ***
-    # *** You MUST add `negotiation_successful: Optional[bool] = None` AND the fields below to its definition ***
-    # Example placeholder if models.py is not available:
-    class DicomExtractedMetadata:
-        def __init__(self, CallingAE=None, CalledAE=None, ImplementationClassUID=None, ImplementationVersionName=None, negotiation_successful=None,
-                     Manufacturer=None, ManufacturerModelName=None, DeviceSerialNumber=None, SoftwareVersions=None, TransducerData=None, StationName=None, # Added fields
-                     **kwargs):
-            self.CallingAE = CallingAE
-            self.CalledAE = CalledAE
-            self.ImplementationClassUID = ImplementationClassUID
-            self.ImplementationVersionName = ImplementationVersionName
-            self.negotiation_successful = negotiation_successful
-            # --- Added Fields for P-DATA extraction ---
-            self.Manufacturer = Manufacturer
-            self.ManufacturerModelName = ManufacturerModelName
-            self.DeviceSerialNumber = DeviceSerialNumber
-            self.SoftwareVersions = SoftwareVersions # Note: DICOM tag (0018,1020) can be multi-valued
-            self.TransducerData = TransducerData     # Note: DICOM tag (0018,5010) can be multi-valued
-            self.StationName = StationName           # Note: DICOM tag (0008,1010)
-            # -----------------------------------------
-            # Store any other kwargs for flexibility
-            for key, value in kwargs.items():
-                setattr(self, key, value)
-    print("WARN: Using placeholder DicomExtractedMetadata model. Ensure the actual model from models.py is used and includes 'negotiation_successful' and the other extracted fields.")
+    import dpkt # type: ignore
+    HAS_DPKT = True
+except ImportError:
+    HAS_DPKT = False
+
 
+# NumPy is optional: it strips the AE title padding of all A-ASSOCIATE payloads in one batch.
+try:
+    import numpy as np # type: ignore
+    HAS_NUMPY = True
 except ImportError:
-    SESSION_DIR = './sessions'
-    def get_capture_path(session_id: str):
-        return os.path.join(SESSION_DIR, f"{session_id}.pcap")
-    print("WARN: Using fallback get_capture_path and placeholder DicomExtractedMetadata.")
-    class DicomExtractedMetadata: # Duplicate placeholder definition
-         def __init__(self, CallingAE=None, CalledAE=None, ImplementationClassUID=None, ImplementationVersionName=None, negotiation_successful=None, **kwargs):
-            self.CallingAE = CallingAE
-            self.CalledAE = CalledAE
-            self.ImplementationClassUID = ImplementationClassUID
-            self.ImplementationVersionName = ImplementationVersionName
-            self.negotiation_successful = negotiation_successful
-             # --- Added Fields for P-DATA extraction ---
-            self.Manufacturer = Manufacturer
-            self.ManufacturerModelName = ManufacturerModelName
-            self.DeviceSerialNumber = DeviceSerialNumber
-            self.SoftwareVersions = SoftwareVersions
-            self.TransducerData = TransducerData
-            self.StationName = StationName
-            # -----------------------------------------
-            for key, value in kwargs.items():
-                setattr(self, key, value)
+    HAS_NUMPY = False
+
+
+# Reassembled streams are deduplicated on a 16-byte digest, which is stable
+# across processes and runs (unlike the randomized builtin hash()).
+# xxhash is optional: xxh3 is several times faster than blake2b, the fallback.
+try:
+    import xxhash # type: ignore
+    _stream_digest = xxhash.xxh3_128_digest
+except ImportError:
+    def _stream_digest(data: bytes) -> bytes:
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+
+from backend import storage
+from backend.dicom_pdu_walk import PDU_HEADER_SIZE, data_pdvs, read_pdu_header
+
+
+class DicomExtractedMetadata:
+    """
+    Metadata parsed from one TCP stream. Mirrors the fields of
+    models.DicomExtractedMetadata but skips pydantic validation: values may
+    still be raw pydicom values (e.g. MultiValue) until they are merged.
+    """
+    __slots__ = (
+        'CallingAE', 'CalledAE', 'ImplementationClassUID', 'ImplementationVersionName', 'negotiation_successful',
+        'Manufacturer', 'ManufacturerModelName', 'DeviceSerialNumber', 'SoftwareVersions', 'TransducerData', 'StationName',
+    )
+
+    def __init__(self, CallingAE=None, CalledAE=None, ImplementationClassUID=None, ImplementationVersionName=None, negotiation_successful=None,
+                 Manufacturer=None, ManufacturerModelName=None, DeviceSerialNumber=None, SoftwareVersions=None, TransducerData=None, StationName=None):
+        self.CallingAE = CallingAE
+        self.CalledAE = CalledAE
+        self.ImplementationClassUID = ImplementationClassUID
+        self.ImplementationVersionName = ImplementationVersionName
+        self.negotiation_successful = negotiation_successful
+        # --- Fields from P-DATA ---
+        self.Manufacturer = Manufacturer
+        self.ManufacturerModelName = ManufacturerModelName
+        self.DeviceSerialNumber = DeviceSerialNumber
+        self.SoftwareVersions = SoftwareVersions # Note: DICOM tag (0018,1020) can be multi-valued
+        self.TransducerData = TransducerData     # Note: DICOM tag (0018,5010) can be multi-valued
+        self.StationName = StationName           # Note: DICOM tag (0008,1010)
+
+
+# --- DICOM Upper Layer header layouts (Big Endian) ---
+_PDU_HDR = struct.Struct('>BBI') # PDU type, Reserved, PDU length
+
+_UL_PDU_TYPES = frozenset(range(0x01, 0x09)) # A-ASSOCIATE-RQ (0x01) .. A-ABORT (0x08)
+_AS_PDU_TYPES = (b'\x01', b'\x02') # A-ASSOCIATE-RQ, A-ASSOCIATE-AC: payload.startswith() prefixes
+
+# Dataset attributes collected from P-DATA, keyed by integer tag so pydicom
+# only decodes these elements (specific_tags) and lookups skip the keyword dictionary
+_WANTED_TAGS: Dict[int, str] = {
+    0x00080070: 'Manufacturer',
+    0x00081090: 'ManufacturerModelName',
+    0x00181000: 'DeviceSerialNumber',
+    0x00181020: 'SoftwareVersions', # Can be str or list
+    0x00185010: 'TransducerData',   # Can be multi-valued
+    0x00081010: 'StationName',
+}
+_WANTED_TAG_LIST = list(_WANTED_TAGS)
+_WANTED_FIELDS = tuple(_WANTED_TAGS.values())
+
+# This module is the only pydicom reader in the backend (scene generation only
+# writes datasets), and it only keeps a few string tags, so the per-element
+# value validation pydicom runs while reading is pure overhead here. Also set
+# in every parsing worker process, which imports this module.
+pydicom.config.settings.reading_validation_mode = pydicom.config.IGNORE
+
+_ITEM_HDR = struct.Struct('>BBH') # A-ASSOCIATE variable item: Item type, Reserved, Item length
+_MAX_LENGTH = struct.Struct('>I')
+
+
+def _decode_ul_text(data) -> str:
+    """Decodes an AE title / UID field, dropping space and NUL padding."""
+    return bytes(data).decode('ascii', errors='replace').strip(' \x00')
+
+
+def _iter_items(data, pos: int, end: int):
+    """Yields (item_type, value_start, value_end) for the variable items in data[pos:end]."""
+    while pos + _ITEM_HDR.size <= end:
+        item_type, _, item_length = _ITEM_HDR.unpack_from(data, pos)
+        value_start = pos + _ITEM_HDR.size
+        value_end = value_start + item_length
+        if value_end > end:
+            return # Truncated item
+        yield item_type, value_start, value_end
+        pos = value_end
+
+
+def _parse_associate(pdu_data) -> Dict[str, Any]:
+    """
+    Parses the body of an A-ASSOCIATE-RQ/AC PDU (after the 6-byte PDU header).
+
+    These are DUL PDUs, not DICOM datasets, so the fixed fields and variable
+    items (PS3.8 9.3.2/9.3.3) are read directly instead of through pydicom.
+    Presentation contexts map ID -> {'AbstractSyntax', 'TransferSyntaxes', 'Result'};
+    AbstractSyntax is only present in an RQ, Result only in an AC.
+    """
+    if len(pdu_data) < 68:
+        raise ValueError(f"A-ASSOCIATE PDU too short ({len(pdu_data)} bytes)")
+    info: Dict[str, Any] = {
+        'ProtocolVersion': int.from_bytes(pdu_data[0:2], 'big'),
+        'CalledAE': _decode_ul_text(pdu_data[4:20]),
+        'CallingAE': _decode_ul_text(pdu_data[20:36]),
+        'ApplicationContext': None,
+        'PresentationContexts': {},
+        'MaxLength': None,
+        'ImplementationClassUID': None,
+        'ImplementationVersionName': None,
+    }
+    contexts = info['PresentationContexts']
+    for item_type, start, end in _iter_items(pdu_data, 68, len(pdu_data)):
+        if item_type == 0x10: # Application Context
+            info['ApplicationContext'] = _decode_ul_text(pdu_data[start:end])
+        elif item_type in (0x20, 0x21) and end - start >= 4: # Presentation Context (RQ / AC)
+            context: Dict[str, Any] = {'TransferSyntaxes': []}
+            if item_type == 0x21:
+                context['Result'] = pdu_data[start + 2]
+            for sub_type, sub_start, sub_end in _iter_items(pdu_data, start + 4, end):
+                if sub_type == 0x30:
+                    context['AbstractSyntax'] = _decode_ul_text(pdu_data[sub_start:sub_end])
+                elif sub_type == 0x40:
+                    context['TransferSyntaxes'].append(_decode_ul_text(pdu_data[sub_start:sub_end]))
+            contexts[pdu_data[start]] = context
+        elif item_type == 0x50: # User Information
+            for sub_type, sub_start, sub_end in _iter_items(pdu_data, start, end):
+                if sub_type == 0x51 and sub_end - sub_start == 4:
+                    info['MaxLength'] = _MAX_LENGTH.unpack_from(pdu_data, sub_start)[0]
+                elif sub_type == 0x52:
+                    info['ImplementationClassUID'] = _decode_ul_text(pdu_data[sub_start:sub_end])
+                elif sub_type == 0x55:
+                    info['ImplementationVersionName'] = _decode_ul_text(pdu_data[sub_start:sub_end])
+    return info
+
 
 # --- Custom Exception for Cancellation ---
 class JobCancelledException(Exception):
@@ -100,58 +210,34 @@ class JobCancelledException(Exception):
     pass
 
 # --- PDU Reading Logic (Helper Function) ---
-def read_pdu(stream: io.BytesIO) -> Optional[Tuple[int, int, bytes]]:
-    """Reads the next PDU (Protocol Data Unit) from the stream."""
-    header_bytes = stream.read(6) # PDU type (1 byte) + Reserved (1 byte) + Length (4 bytes)
-    if len(header_bytes) < 6:
-        # Not enough data for a header
-        # print("Debug: Not enough data for PDU header.")
-        return None
+def read_pdu(buf: bytes, mv: memoryview, pos: int, end: int) -> Optional[Tuple[int, int, int, memoryview]]:
+    """
+    Reads the PDU (Protocol Data Unit) starting at `pos` in the stream buffer.
 
-    try:
-        pdu_type, reserved, pdu_length = struct.unpack('>B B I', header_bytes) # Big Endian
-        # print(f"Debug: Read PDU header: type={pdu_type}, reserved={reserved}, length={pdu_length}")
-
-        pdu_data = stream.read(pdu_length)
-        if len(pdu_data) < pdu_length:
-            print(f"WARN: Incomplete PDU data. Expected {pdu_length} bytes, got {len(pdu_data)}.")
-             # Rewind the stream to before reading this incomplete PDU's data and header
-            stream.seek(stream.tell() - len(pdu_data) - 6)
-            return None # Indicate failure to read complete PDU
-
-        # print(f"Debug: Successfully read PDU data ({pdu_length} bytes).")
-        return pdu_type, pdu_length, pdu_data
-    except struct.error as e:
-        print(f"ERROR unpacking PDU header: {e}. Header bytes: {header_bytes!r}")
-         # Rewind stream before the failed header read attempt
-        stream.seek(stream.tell() - len(header_bytes))
-        return None
-    except Exception as e:
-        print(f"ERROR reading PDU: {e}\n{traceback.format_exc()}")
-         # Rewind stream to before the header read attempt
-        stream.seek(stream.tell() - len(header_bytes))
-        return None
+    Returns (pdu_type, pdu_length, next_pos, pdu_data), where pdu_data is a
+    zero-copy slice of `mv` (a memoryview of `buf`), or None if no complete PDU starts at `pos`.
+    """
+    header = read_pdu_header(buf, pos, end)
+    if header is None:
+        if end - pos >= PDU_HEADER_SIZE:
+            logger.warning("Incomplete PDU data at stream position %d.", pos)
+        return None # Indicate failure to read complete PDU
+
+    pdu_type, data_start, next_pos = header
+    return pdu_type, next_pos - data_start, next_pos, mv[data_start:next_pos]
 
 
 # --- Metadata Extraction Logic ---
-def extract_relevant_metadata(stream: io.BytesIO, key: Tuple[str, str, int]) -> Optional[DicomExtractedMetadata]:
+def extract_relevant_metadata(buf: bytes, key: Tuple[str, str, int]) -> Optional[DicomExtractedMetadata]:
     """
-    Parses a DICOM TCP stream (from BytesIO) and extracts relevant metadata
+    Parses a reassembled DICOM TCP stream and extracts relevant metadata
     like AE Titles and Implementation details from Association PDUs.
 
     MODIFIED: Extracts basic info even if context negotiation fails.
     """
-    client_ip, server_ip, server_port = key
-    # --- DEBUG LOGGING START ---
-    target_client_ip = "172.18.121.241"
-    target_server_ip = "10.193.145.168"
-    is_target_stream = (client_ip == target_client_ip and server_ip == target_server_ip) or \
-                       (client_ip == target_server_ip and server_ip == target_client_ip) # Check both directions
-
-    if is_target_stream:
-        print(f"--- DEBUG DICOM: Processing target stream {key} ---")
-    # --- DEBUG LOGGING END ---
-    print(f">>> [Extractor] Attempting to decode stream for key: {key}")
+    # Per-PDU/PDV messages are only formatted when DEBUG logging is enabled
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug: logger.debug("Attempting to decode stream for key: %s", key)
 
     # Stores metadata found across different PDUs in the stream
     found_metadata: Dict[str, Any] = {}
@@ -160,283 +246,194 @@ def extract_relevant_metadata(stream: io.BytesIO, key: Tuple[str, str, int]) ->
     # Stores presentation context results from A-ASSOCIATE-AC
     current_context_results: Dict[int, Dict[str, Any]] = {}
     # Stores reassembled P-DATA fragments per presentation context ID
-    p_data_fragments: Dict[int, bytes] = defaultdict(bytes)
+    p_data_fragments: Dict[int, List[memoryview]] = defaultdict(list)
     # Flag to track if we have successfully parsed any P-DATA dataset
     parsed_p_data_success = False
-
-    # Ensure stream is at the beginning
-    stream.seek(0)
-    initial_buffer_len = len(stream.getbuffer())
-    print(f"Debug: Stream buffer length: {initial_buffer_len} bytes.")
+    # Set once every wanted P-DATA tag has a value; the rest of the stream is then skipped
+    all_tags_found = False
+
+    # PDUs are sliced out of the stream buffer by offset, without copying
+    mv = memoryview(buf)
+    initial_buffer_len = len(mv)
+    if debug: logger.debug("Stream buffer length: %d bytes.", initial_buffer_len)
+
+    # Fast path: a DICOM stream starts with a known PDU type, a zero reserved
+    # byte and a PDU length that fits in the stream. Anything else (HTTP, TLS,
+    # SSH, ...) is rejected without entering the PDU loop.
+    if (initial_buffer_len < _PDU_HDR.size or buf[0] not in _UL_PDU_TYPES or buf[1] != 0
+            or _PDU_HDR.unpack_from(buf)[2] > initial_buffer_len - _PDU_HDR.size):
+        if debug: logger.debug("Stream for key %s does not start with a DICOM PDU. Skipping.", key)
+        return None
 
     # --- Main PDU Processing Loop ---
-    while stream.tell() < initial_buffer_len:
-        current_pos = stream.tell()
-        # print(f"Debug: Reading PDU at stream position {current_pos}/{initial_buffer_len}")
-        pdu_info = read_pdu(stream)
+    current_pos = 0
+    while current_pos < initial_buffer_len:
+        pdu_info = read_pdu(buf, mv, current_pos, initial_buffer_len)
 
         if pdu_info is None:
             # Failed to read a complete PDU, likely end of stream or garbage data
-            print(f"Debug: read_pdu returned None at position {current_pos}. Assuming end of relevant PDUs.")
+            if debug: logger.debug("read_pdu returned None at position %d. Assuming end of relevant PDUs.", current_pos)
             break # Exit loop
 
-        pdu_type, pdu_length, pdu_data = pdu_info
-        pdu_data_stream = io.BytesIO(pdu_data) # Use BytesIO for pydicom
+        pdu_type, pdu_length, current_pos, pdu_data = pdu_info
 
         # --- Process specific PDU types ---
         if pdu_type == 0x01: # A-ASSOCIATE-RQ
-             print(f"Debug: Found A-ASSOCIATE-RQ PDU (Length: {pdu_length})")
-             # --- DEBUG LOGGING START ---
-             if is_target_stream: print(f"--- DEBUG DICOM: Found A-ASSOCIATE-RQ in target stream ---")
-             # --- DEBUG LOGGING END ---
+             if debug: logger.debug("Found A-ASSOCIATE-RQ PDU (Length: %d)", pdu_length)
              try:
-                 # force=True allows reading even if preamble/prefix is missing
-                 assoc_ds = pydicom.dcmread(pdu_data_stream, force=True)
-                 print(f"Successfully parsed A-ASSOCIATE-RQ PDU.")
-                 # --- DEBUG LOGGING START ---
-                 if is_target_stream: print(f"--- DEBUG DICOM: Successfully parsed A-ASSOCIATE-RQ ---")
-                 # --- DEBUG LOGGING END ---
+                 assoc_info = _parse_associate(pdu_data)
 
                  # --- STEP 2 (Modified): Extract Metadata Early ---
-                 calling_ae_rq = assoc_ds.get("CallingAETitle", "").strip()
-                 called_ae_rq = assoc_ds.get("CalledAETitle", "").strip()
-                 found_metadata['CallingAE'] = calling_ae_rq
-                 found_metadata['CalledAE'] = called_ae_rq
-                 # --- DEBUG LOGGING START ---
-                 if is_target_stream: print(f"--- DEBUG DICOM: Extracted from RQ: CallingAE='{calling_ae_rq}', CalledAE='{called_ae_rq}' ---")
-                 # --- DEBUG LOGGING END ---
-                 user_info = assoc_ds.get("UserInformation", None)
-                 if user_info:
-                      found_metadata['ImplementationClassUID'] = user_info.get("ImplementationClassUID")
-                      found_metadata['ImplementationVersionName'] = user_info.get("ImplementationVersionName")
+                 found_metadata['CallingAE'] = assoc_info['CallingAE']
+                 found_metadata['CalledAE'] = assoc_info['CalledAE']
+                 found_metadata['ImplementationClassUID'] = assoc_info['ImplementationClassUID']
+                 found_metadata['ImplementationVersionName'] = assoc_info['ImplementationVersionName']
 
                  # Store proposed contexts
-                 assoc_rq_contexts = {}
-                 if hasattr(assoc_ds, 'PresentationContext'):
-                     for pres_context in assoc_ds.PresentationContext:
-                        # Check if TransferSyntax is a list or single item
-                        transfer_syntaxes = pres_context.TransferSyntax
-                        if not isinstance(transfer_syntaxes, list):
-                            transfer_syntaxes = [transfer_syntaxes] # Ensure it's a list
-                        assoc_rq_contexts[pres_context.PresentationContextID] = {
-                            'AbstractSyntax': pres_context.AbstractSyntax,
-                            'TransferSyntaxes': transfer_syntaxes
-                        }
-                 print(f"Extracted from RQ: Calling='{found_metadata.get('CallingAE')}', Called='{found_metadata.get('CalledAE')}', UID='{found_metadata.get('ImplementationClassUID')}', Version='{found_metadata.get('ImplementationVersionName')}'")
-                 print(f"Parsed RQ Contexts: {assoc_rq_contexts}")
-
-
-             except InvalidDicomError as e:
-                 print(f"Error parsing A-ASSOCIATE-RQ: {e}")
-                 # --- DEBUG LOGGING START ---
-                 if is_target_stream: print(f"--- DEBUG DICOM: FAILED to parse A-ASSOCIATE-RQ (InvalidDicomError): {e} ---")
-                 # --- DEBUG LOGGING END ---
+                 assoc_rq_contexts = {
+                     context_id: {
+                         'AbstractSyntax': context.get('AbstractSyntax'),
+                         'TransferSyntaxes': context['TransferSyntaxes']
+                     }
+                     for context_id, context in assoc_info['PresentationContexts'].items()
+                 }
+                 if debug:
+                     logger.debug("Extracted from RQ: Calling='%s', Called='%s', UID='%s', Version='%s'",
+                                  found_metadata['CallingAE'], found_metadata['CalledAE'],
+                                  found_metadata['ImplementationClassUID'], found_metadata['ImplementationVersionName'])
+                     logger.debug("Parsed RQ Contexts: %s", assoc_rq_contexts)
+
+             except (ValueError, struct.error) as e:
+                 logger.warning("Error parsing A-ASSOCIATE-RQ in stream %s: %s", key, e)
              except Exception as e:
-                 print(f"ERROR processing A-ASSOCIATE-RQ: {e}\n{traceback.format_exc()}")
-                 # --- DEBUG LOGGING START ---
-                 if is_target_stream: print(f"--- DEBUG DICOM: FAILED to parse A-ASSOCIATE-RQ (Exception): {e} ---")
-                 # --- DEBUG LOGGING END ---
+                 logger.error("ERROR processing A-ASSOCIATE-RQ in stream %s: %s", key, e, exc_info=True)
 
         elif pdu_type == 0x02: # A-ASSOCIATE-AC
-             print(f"Debug: Found A-ASSOCIATE-AC PDU (Length: {pdu_length})")
-             # --- DEBUG LOGGING START ---
-             if is_target_stream: print(f"--- DEBUG DICOM: Found A-ASSOCIATE-AC in target stream ---")
-             # --- DEBUG LOGGING END ---
+             if debug: logger.debug("Found A-ASSOCIATE-AC PDU (Length: %d)", pdu_length)
              try:
-                 assoc_ds = pydicom.dcmread(pdu_data_stream, force=True)
-                 print(f"Successfully parsed A-ASSOCIATE-AC PDU.")
-                 # --- DEBUG LOGGING START ---
-                 if is_target_stream: print(f"--- DEBUG DICOM: Successfully parsed A-ASSOCIATE-AC ---")
-                 # --- DEBUG LOGGING END ---
+                 assoc_info = _parse_associate(pdu_data)
 
                  # --- STEP 2 (Modified): Extract/Update Metadata Early ---
                  # Update AE Titles if different (unlikely), prioritize AC for implementation info
-                 calling_ae_ac = assoc_ds.get("CallingAETitle", "").strip()
-                 called_ae_ac = assoc_ds.get("CalledAETitle", "").strip()
+                 calling_ae_ac = assoc_info['CallingAE']
+                 called_ae_ac = assoc_info['CalledAE']
                  # Update only if not empty and potentially different from RQ
                  if calling_ae_ac: found_metadata['CallingAE'] = calling_ae_ac
                  if called_ae_ac: found_metadata['CalledAE'] = called_ae_ac
-                 # --- DEBUG LOGGING START ---
-                 if is_target_stream: print(f"--- DEBUG DICOM: Extracted from AC: CallingAE='{calling_ae_ac}', CalledAE='{called_ae_ac}' ---")
-                 if is_target_stream: print(f"--- DEBUG DICOM: Metadata AE Titles after AC: Calling='{found_metadata.get('CallingAE')}', Called='{found_metadata.get('CalledAE')}' ---")
-                 # --- DEBUG LOGGING END ---
-                 user_info = assoc_ds.get("UserInformation", None)
-                 if user_info:
-                      found_metadata['ImplementationClassUID'] = user_info.get("ImplementationClassUID", found_metadata.get('ImplementationClassUID'))
-                      found_metadata['ImplementationVersionName'] = user_info.get("ImplementationVersionName", found_metadata.get('ImplementationVersionName'))
+                 if assoc_info['ImplementationClassUID']:
+                      found_metadata['ImplementationClassUID'] = assoc_info['ImplementationClassUID']
+                 if assoc_info['ImplementationVersionName']:
+                      found_metadata['ImplementationVersionName'] = assoc_info['ImplementationVersionName']
 
                  # --- STEP 1 (Modified): Locate Context Logic & Store Results ---
                  current_context_results = {}
-                 if hasattr(assoc_ds, 'PresentationContext'):
-                     for pres_context in assoc_ds.PresentationContext:
-                         current_context_results[pres_context.PresentationContextID] = {
-                             'Result': pres_context.Result,
-                             'TransferSyntax': pres_context.TransferSyntax # Accepted TS UID
-                         }
-                         # Optional: Log rejection during parsing
-                         if pres_context.Result != 0:
-                            print(f"Info: AC reports Context ID {pres_context.PresentationContextID} rejected/no-negotiation (Result: {pres_context.Result}).")
-
-                 print(f"Extracted from AC: UID='{found_metadata.get('ImplementationClassUID')}', Version='{found_metadata.get('ImplementationVersionName')}'")
-                 print(f"Parsed AC Context Results: {current_context_results}")
-
-
-             except InvalidDicomError as e:
-                 print(f"Error parsing A-ASSOCIATE-AC: {e}")
-                 # --- DEBUG LOGGING START ---
-                 if is_target_stream: print(f"--- DEBUG DICOM: FAILED to parse A-ASSOCIATE-AC (InvalidDicomError): {e} ---")
-                 # --- DEBUG LOGGING END ---
+                 for context_id, context in assoc_info['PresentationContexts'].items():
+                     current_context_results[context_id] = {
+                         'Result': context.get('Result'),
+                         'TransferSyntax': context['TransferSyntaxes'][0] if context['TransferSyntaxes'] else None # Accepted TS UID
+                     }
+                     # Optional: Log rejection during parsing
+                     if debug and context.get('Result') != 0:
+                        logger.debug("AC reports Context ID %s rejected/no-negotiation (Result: %s).", context_id, context.get('Result'))
+
+                 if debug:
+                     logger.debug("Extracted from AC: UID='%s', Version='%s'",
+                                  found_metadata.get('ImplementationClassUID'), found_metadata.get('ImplementationVersionName'))
+                     logger.debug("Parsed AC Context Results: %s", current_context_results)
+
+             except (ValueError, struct.error) as e:
+                 logger.warning("Error parsing A-ASSOCIATE-AC in stream %s: %s", key, e)
              except Exception as e:
-                 print(f"ERROR processing A-ASSOCIATE-AC: {e}\n{traceback.format_exc()}")
-                 # --- DEBUG LOGGING START ---
-                 if is_target_stream: print(f"--- DEBUG DICOM: FAILED to parse A-ASSOCIATE-AC (Exception): {e} ---")
-                 # --- DEBUG LOGGING END ---
+                 logger.error("ERROR processing A-ASSOCIATE-AC in stream %s: %s", key, e, exc_info=True)
 
         elif pdu_type == 0x04: # P-DATA-TF
-            # print(f"Debug: Found P-DATA-TF PDU (Length: {pdu_length})")
-            # P-DATA-TF contains one or more PDVs (Presentation Data Values)
-            pdv_stream = io.BytesIO(pdu_data)
-            while pdv_stream.tell() < pdu_length:
-                # Read PDV header: Length (4 bytes, Big Endian), Context ID (1 byte)
-                pdv_header = pdv_stream.read(5)
-                if len(pdv_header) < 5:
-                    print(f"WARN: Incomplete PDV header in P-DATA-TF at pos {pdv_stream.tell()}. Stopping parse.")
-                    break
+            # P-DATA-TF contains one or more PDVs (Presentation Data Values); command PDVs
+            # (C-STORE-RQ/RSP, ...) carry none of the wanted tags and are not returned
+            pdvs, pdv_stop = data_pdvs(buf, current_pos - pdu_length, current_pos)
+            if pdv_stop != current_pos:
+                logger.warning("Incomplete PDV in P-DATA-TF at pos %d. Stopping parse.", pdv_stop - (current_pos - pdu_length))
+            for pdv_context_id, is_last_fragment, data_start, data_end in pdvs:
+                # Append data fragment to the buffer for this context ID
+                p_data_fragments[pdv_context_id].append(mv[data_start:data_end])
+
+                # If this is the last fragment, try to parse the reassembled data
+                if not is_last_fragment:
+                    continue
+                fragment_data = b''.join(p_data_fragments.pop(pdv_context_id, [])) # Also clears the buffer for this context ID
+                if not fragment_data:
+                    if debug: logger.debug("Received last fragment for Context ID %d, but no data buffered.", pdv_context_id)
+                    continue
                 try:
-                    pdv_item_len, pdv_context_id = struct.unpack('>IB', pdv_header)
-                    # Read PDV data (Message Control Header (1 byte) + Data)
-                    pdv_data_field = pdv_stream.read(pdv_item_len - 1) # Length includes context ID byte
-                    if len(pdv_data_field) < (pdv_item_len - 1):
-                         print(f"WARN: Incomplete PDV data. Expected {pdv_item_len - 1}, got {len(pdv_data_field)}. Stopping parse.")
-                         break
-
-                    # The first byte of pdv_data_field is the Message Control Header
-                    # Bit 1 indicates if it's Command (1) or Data (0)
-                    # Bit 0 indicates if it's the last fragment (1) or not (0)
-                    message_control_header = pdv_data_field[0]
-                    is_command = (message_control_header & 0x02) != 0
-                    is_last_fragment = (message_control_header & 0x01) != 0
-                    actual_data = pdv_data_field[1:]
-
-                    # print(f"Debug: PDV ContextID={pdv_context_id}, Length={pdv_item_len}, IsCommand={is_command}, IsLast={is_last_fragment}, DataLen={len(actual_data)}")
-
-                    # Append data fragment to the buffer for this context ID
-                    p_data_fragments[pdv_context_id] += actual_data
-
-                    # If this is the last fragment, try to parse the reassembled data
-                    if is_last_fragment:
-                        # print(f"Debug: Last fragment received for Context ID {pdv_context_id}. Total size: {len(p_data_fragments[pdv_context_id])}")
-                        fragment_data = p_data_fragments[pdv_context_id]
-                        if fragment_data:
-                            try:
-                                # Use BytesIO for pydicom
-                                fragment_stream = io.BytesIO(fragment_data)
-                                # force=True might be needed if data is slightly malformed
-                                # stop_before_pixels=True can speed up parsing if pixel data isn't needed
-                                p_data_ds = pydicom.dcmread(fragment_stream, force=True, stop_before_pixels=True)
-                                print(f"Successfully parsed DICOM dataset from P-DATA (Context ID: {pdv_context_id})")
-                                parsed_p_data_success = True # Mark success
-
-                                # --- Extract Desired Tags ---
-                                # Only update if not already found, taking the first occurrence
-                                if 'Manufacturer' not in found_metadata or found_metadata['Manufacturer'] is None:
-                                    found_metadata['Manufacturer'] = p_data_ds.get("Manufacturer")
-                                if 'ManufacturerModelName' not in found_metadata or found_metadata['ManufacturerModelName'] is None:
-                                    found_metadata['ManufacturerModelName'] = p_data_ds.get("ManufacturerModelName")
-                                if 'DeviceSerialNumber' not in found_metadata or found_metadata['DeviceSerialNumber'] is None:
-                                    found_metadata['DeviceSerialNumber'] = p_data_ds.get("DeviceSerialNumber")
-                                if 'SoftwareVersions' not in found_metadata or found_metadata['SoftwareVersions'] is None:
-                                    found_metadata['SoftwareVersions'] = p_data_ds.get("SoftwareVersions") # Can be str or list
-                                if 'TransducerData' not in found_metadata or found_metadata['TransducerData'] is None:
-                                    found_metadata['TransducerData'] = p_data_ds.get("TransducerData") # Can be multi-valued
-                                if 'StationName' not in found_metadata or found_metadata['StationName'] is None:
-                                    found_metadata['StationName'] = p_data_ds.get("StationName")
-
-                                # Log extracted values for debugging
-                                # print(f"  Extracted P-DATA: Manufacturer='{found_metadata.get('Manufacturer')}', Model='{found_metadata.get('ManufacturerModelName')}', SN='{found_metadata.get('DeviceSerialNumber')}', SW='{found_metadata.get('SoftwareVersions')}', Transducer='{found_metadata.get('TransducerData')}', Station='{found_metadata.get('StationName')}'")
-
-                            except InvalidDicomError as e:
-                                print(f"WARN: Failed to parse reassembled P-DATA fragment for Context ID {pdv_context_id} as DICOM: {e}")
-                            except Exception as e:
-                                print(f"ERROR processing P-DATA fragment for Context ID {pdv_context_id}: {e}\n{traceback.format_exc()}")
-                            finally:
-                                # Clear the buffer for this context ID after attempting parse
-                                del p_data_fragments[pdv_context_id]
-                        else:
-                             print(f"Debug: Received last fragment for Context ID {pdv_context_id}, but no data buffered.")
-
-
-                except struct.error as e:
-                    print(f"ERROR unpacking PDV header: {e}. Header bytes: {pdv_header!r}")
-                    break # Stop processing this PDU
+                    # The only file-like wrapper in the stream walk: one per reassembled
+                    # dataset, sharing fragment_data's buffer (PDUs/PDVs are memoryview slices)
+                    # force=True might be needed if data is slightly malformed
+                    # stop_before_pixels=True can speed up parsing if pixel data isn't needed
+                    p_data_ds = pydicom.dcmread(io.BytesIO(fragment_data), force=True, stop_before_pixels=True, specific_tags=_WANTED_TAG_LIST)
+                    if debug: logger.debug("Successfully parsed DICOM dataset from P-DATA (Context ID: %d)", pdv_context_id)
+                    parsed_p_data_success = True # Mark success
+
+                    # --- Extract Desired Tags ---
+                    # Only update if not already found, taking the first occurrence
+                    for tag, field in _WANTED_TAGS.items():
+                        if found_metadata.get(field) is None:
+                            element = p_data_ds.get(tag)
+                            found_metadata[field] = element.value if element is not None else None
+                    if all(found_metadata.get(field) is not None for field in _WANTED_FIELDS):
+                        # Later datasets (e.g. the rest of a C-STORE series) can't add anything
+                        all_tags_found = True
+                        break
+
+                except InvalidDicomError as e:
+                    logger.warning("Failed to parse reassembled P-DATA fragment for Context ID %d as DICOM: %s", pdv_context_id, e)
                 except Exception as e:
-                    print(f"ERROR processing PDV item: {e}\n{traceback.format_exc()}")
-                    break # Stop processing this PDU
+                    logger.error("ERROR processing P-DATA fragment for Context ID %d: %s", pdv_context_id, e, exc_info=True)
 
+            if all_tags_found:
+                if debug: logger.debug("All wanted P-DATA tags found for key %s. Skipping the rest of the stream.", key)
+                break
 
         elif pdu_type == 0x06: # A-RELEASE-RQ
-            print("Debug: Found A-RELEASE-RQ PDU.")
-            pass # Can handle if needed
+            if debug: logger.debug("Found A-RELEASE-RQ PDU.")
 
         elif pdu_type == 0x07: # A-RELEASE-RP
-            print("Debug: Found A-RELEASE-RP PDU.")
-            pass # Can handle if needed
+            if debug: logger.debug("Found A-RELEASE-RP PDU.")
 
         elif pdu_type == 0x08: # A-ABORT
-            print("WARN: Found A-ABORT PDU. Association terminated abruptly.")
             # Could extract Source and Reason from A-ABORT if needed
-            pass
-
-        else:
-            # print(f"Debug: Skipping unknown or unhandled PDU type {pdu_type} (Length: {pdu_length})")
-            pass
+            if debug: logger.debug("Found A-ABORT PDU. Association terminated abruptly.")
 
     # --- End of PDU Processing Loop ---
-    print(f"Debug: Finished processing stream for key {key}. Final stream position: {stream.tell()}/{initial_buffer_len}")
+    if debug: logger.debug("Finished processing stream for key %s. Final stream position: %d/%d", key, current_pos, initial_buffer_len)
 
     # --- STEP 3 & 4 (Modified): Relax Condition & Add Indicator ---
     # Check if essential metadata (AE Titles) was found OR if we successfully parsed P-DATA
     # We might get P-DATA without seeing the full association setup in some captures.
-    # --- DEBUG LOGGING START ---
-    final_check_condition = (found_metadata.get('CallingAE') and found_metadata.get('CalledAE')) or parsed_p_data_success
-    if is_target_stream:
-        print(f"--- DEBUG DICOM: Final Check: CallingAE='{found_metadata.get('CallingAE')}', CalledAE='{found_metadata.get('CalledAE')}', ParsedPDataSuccess={parsed_p_data_success} ---")
-        print(f"--- DEBUG DICOM: Final Check Condition Result: {final_check_condition} ---")
-    # --- DEBUG LOGGING END ---
-    if final_check_condition:
-        if not (found_metadata.get('CallingAE') and found_metadata.get('CalledAE')):
-             print("WARN: Proceeding based on successful P-DATA parse, but AE Titles were not found/extracted.")
-        else:
-             print(f"Debug: Found essential AE Titles: Calling='{found_metadata.get('CallingAE')}', Called='{found_metadata.get('CalledAE')}'")
+    has_ae_titles = bool(found_metadata.get('CallingAE') and found_metadata.get('CalledAE'))
+    if has_ae_titles or parsed_p_data_success:
+        if not has_ae_titles:
+             logger.warning("Stream %s: proceeding based on successful P-DATA parse, but AE Titles were not found/extracted.", key)
 
         # Determine if negotiation was successful (at least one context accepted) - only relevant if we saw AC PDU
         any_context_accepted = False
         if assoc_rq_contexts and current_context_results: # Check if we have both RQ proposals and AC results
-            for context_id, rq_context in assoc_rq_contexts.items():
-                if context_id in current_context_results:
-                    ac_result = current_context_results[context_id]
-                    if ac_result.get('Result') == 0: # 0 = Acceptance
-                        print(f"Debug: Context ID {context_id} accepted.")
-                        any_context_accepted = True
-                        break # Found one, no need to check further for this flag
-                # else: (Optional: warning if AC didn't mention a proposed context ID)
-                #    print(f"WARN: Proposed Context ID {context_id} not found in A-ASSOC-AC results.")
-        else:
-             print("Debug: Cannot determine negotiation success (missing RQ contexts or AC results).")
+            for context_id in assoc_rq_contexts:
+                ac_result = current_context_results.get(context_id)
+                if ac_result is not None and ac_result.get('Result') == 0: # 0 = Acceptance
+                    any_context_accepted = True
+                    break # Found one, no need to check further for this flag
+        elif current_context_results: # Only the AC side of the association was captured
+            any_context_accepted = any(ac_result.get('Result') == 0 for ac_result in current_context_results.values())
+        elif debug:
+             logger.debug("Cannot determine negotiation success (missing RQ contexts or AC results).")
 
-        # Log negotiation outcome
-        print(f"Debug: Negotiation success flag calculated as: {any_context_accepted}")
         if not any_context_accepted and current_context_results:
             # Log if we had AC results but none were accepted
-            print("WARN: No presentation contexts appear to have been accepted in the A-ASSOCIATE-AC PDU based on parsed results.")
+            logger.warning("Stream %s: no presentation contexts appear to have been accepted in the A-ASSOCIATE-AC PDU.", key)
 
         # --- Create Metadata Object ---
         # Proceed to create the metadata object REGARDLESS of negotiation success,
         # as long as we have the essential AE titles.
-        print(f"Debug: Proceeding to create DicomExtractedMetadata object with collected data.")
         try:
-           # *** IMPORTANT: Ensure DicomExtractedMetadata model includes 'negotiation_successful' ***
-           # If not, remove the negotiation_successful argument below.
            return DicomExtractedMetadata(
                # Use .get() for safety, though we checked AE titles above
                CallingAE=found_metadata.get('CallingAE'),
@@ -456,355 +453,783 @@ def extract_relevant_metadata(stream: io.BytesIO, key: Tuple[str, str, int]) ->
            )
         except Exception as e:
             # Catch potential errors during model instantiation (e.g., Pydantic validation)
-            print(f"ERROR creating DicomExtractedMetadata object: {e}\n{traceback.format_exc()}")
+            logger.error("ERROR creating DicomExtractedMetadata object: %s", e, exc_info=True)
             return None # Return None if model creation fails
 
     else:
         # Didn't find essential AE titles or successfully parsed P-DATA
-        print(f"Debug: Did not find essential AE titles or parse any P-DATA datasets in the stream for key {key}. Returning None.")
+        if debug: logger.debug("Did not find essential AE titles or parse any P-DATA datasets in the stream for key %s. Returning None.", key)
         return None
 
 
 from typing import Dict, List, Optional, Tuple, Any, Callable # Added Callable
 
-# --- Main Extractor Function ---
-def extract_dicom_metadata_from_pcap(
-    session_id: str,
-    progress_callback: Optional[Callable[[int], None]] = None,
-    check_stop_requested: Optional[Callable[[], bool]] = None # Added cancellation check callback
-) -> Dict[str, List[Dict[str, Any]]]:
+# Cancellation and progress are checked every N packets while streaming the PCAP
+_CHECK_EVERY_N_PACKETS = 1000
+
+
+class _TcpFlow:
+    """Payload segments and packet count of one direction of a TCP connection, built while streaming."""
+    __slots__ = ("segments", "packet_count", "payload_size", "base_seq")
+
+    def __init__(self):
+        # (offset from base_seq, payload) in arrival order
+        self.segments: List[Tuple[int, bytes]] = []
+        self.packet_count = 0
+        # Payload bytes recorded, retransmissions included
+        self.payload_size = 0
+        # Sequence number of the first payload seen, None until then
+        self.base_seq: Optional[int] = None
+
+    def add_segment(self, seq: int, payload: bytes) -> None:
+        """Records a segment's payload; ordering and overlaps are resolved by reassemble()."""
+        if self.base_seq is None:
+            self.base_seq = seq
+        offset = (seq - self.base_seq) & 0xFFFFFFFF
+        if offset >= 0x80000000: # Before the first segment seen (mod 2**32): arrived out of order
+            offset -= 0x100000000
+        self.segments.append((offset, payload))
+        self.payload_size += len(payload)
+
+    def reassemble(self) -> bytes:
+        """
+        Joins the segments in sequence order and releases them. Retransmitted
+        bytes are dropped (the first copy wins); a gap (lost segment in the
+        capture) is just skipped over.
+        """
+        segments = self.segments
+        self.segments = []
+        segments.sort(key=itemgetter(0)) # Stable, and linear when segments arrived in order
+        parts = []
+        end = None
+        for offset, payload in segments:
+            if end is not None and offset < end:
+                if offset + len(payload) <= end:
+                    continue # Full retransmission
+                payload = payload[end - offset:]
+                offset = end
+            parts.append(payload)
+            end = offset + len(payload)
+        return b''.join(parts)
+
+
+# A TCP segment as yielded by the segment readers:
+# (src_ip, dst_ip, sport, dport, tcp_flags, seq, payload)
+# IPv4 addresses are ints so the per-packet flow keys hash fast; they are only
+# turned into dotted strings (_ipv4_str) for the flows that reach the parser.
+TcpSegment = Tuple[int, int, int, int, int, int, bytes]
+FlowKey = Tuple[int, int, int, int]
+
+
+def _ipv4_int(addr: str) -> int:
+    return int.from_bytes(socket.inet_aton(addr), 'big')
+
+
+def _ipv4_str(addr: int) -> str:
+    return socket.inet_ntoa(addr.to_bytes(4, 'big'))
+
+
+class _ScapySegmentReader:
+    """
+    Yields a TcpSegment per packet (None for non IP/TCP packets) from any
+    capture Scapy can read (pcapng, any link type). Records are read raw:
+    Ethernet frames are decoded with _ethernet_segment, and only frames of other
+    link types go through Scapy's dissection.
     """
-    Main function to extract DICOM metadata from a PCAP file associated with a session.
-    Reads the PCAP, identifies TCP sessions potentially containing DICOM,
-    and extracts metadata using `extract_relevant_metadata`.
 
-    Returns a dictionary where keys are string representations of (client_ip, server_ip, server_port)
-    tuples and values are lists of DicomCommunicationInfo-like dictionaries.
+    def __init__(self, session_id: str):
+        self._reader = storage.open_pcap_reader(session_id, raw=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._reader.close()
+
+    def tell(self) -> int:
+        return self._reader.f.tell()
+
+    def __iter__(self):
+        # Classic pcap has one link type per file, pcapng one per interface (in each record's metadata)
+        file_linktype = getattr(self._reader, 'linktype', None)
+        ethernet = storage.PCAP_LINKTYPE_ETHERNET
+        l2types = conf.l2types.num2layer
+        for frame, metadata in self._reader:
+            linktype = getattr(metadata, 'linktype', file_linktype)
+            if linktype == ethernet:
+                yield _ethernet_segment(frame, 0, len(frame))
+                continue
+            pkt = l2types.get(linktype, conf.raw_layer)(frame)
+            ip_layer = pkt.getlayer(IP)
+            tcp_layer = ip_layer.getlayer(TCP) if ip_layer is not None else None
+            if tcp_layer is None:
+                yield None
+                continue
+            # Each layer is looked up once above and each field read once here:
+            # attribute access on a Packet goes through Scapy's field dispatch
+            tcp_payload = tcp_layer.payload
+            if type(tcp_payload) is Raw:
+                payload = tcp_payload.load # Already bytes, bytes(layer) would rebuild it
+            else:
+                payload = bytes(tcp_payload) if tcp_payload else b""
+            yield (_ipv4_int(ip_layer.src), _ipv4_int(ip_layer.dst), tcp_layer.sport, tcp_layer.dport, int(tcp_layer.flags), tcp_layer.seq, payload)
+
+
+class _DpktSegmentReader:
+    """Same as _ScapySegmentReader but parses Ethernet/IPv4/TCP with dpkt. Only for Ethernet pcap files."""
+
+    def __init__(self, pcap_file_path):
+        self._file = open(pcap_file_path, 'rb', buffering=storage.PCAP_READ_BUFFER_SIZE)
+        try:
+            self._reader = dpkt.pcap.Reader(self._file)
+            if self._reader.datalink() != dpkt.pcap.DLT_EN10MB:
+                raise ValueError(f"unsupported link type {self._reader.datalink()}")
+        except Exception:
+            self._file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def __iter__(self):
+        ethernet = dpkt.ethernet.Ethernet
+        ip_cls = dpkt.ip.IP
+        tcp_cls = dpkt.tcp.TCP
+        from_bytes = int.from_bytes
+        for _ts, buf in self._reader:
+            try:
+                ip = ethernet(buf).data
+            except dpkt.dpkt.UnpackError:
+                yield None
+                continue
+            if not isinstance(ip, ip_cls) or not isinstance(ip.data, tcp_cls):
+                yield None
+                continue
+            tcp = ip.data
+            yield (from_bytes(ip.src, 'big'), from_bytes(ip.dst, 'big'), tcp.sport, tcp.dport, tcp.flags, tcp.seq, tcp.data)
+
+
+_PCAP_MAGIC_USEC = 0xA1B2C3D4
+_PCAP_MAGIC_NSEC = 0xA1B23C4D
+_ETH_VLAN = (0x8100, 0x88A8)
+_ETHERTYPE = struct.Struct('>H')
+_IPV4_HDR = struct.Struct('>BxHxxHxBxxII') # Version/IHL, Total length, Flags/Fragment offset, Protocol, Source, Destination
+_TCP_HDR = struct.Struct('>HHI4xBB')   # Source port, Destination port, Sequence number, Data offset, Flags
+
+
+class _MmapSegmentReader:
+    """
+    Same as _ScapySegmentReader but walks a memory-mapped Ethernet pcap file
+    with struct, creating no per-packet objects beyond the yielded tuple.
+    Raises ValueError for anything but classic pcap with an Ethernet link type.
     """
-    print(f">>> [Extractor] ENTER function for session {session_id}")
-    pcap_file_path = get_capture_path(session_id)
-    if not os.path.exists(pcap_file_path):
-        print(f"ERROR: PCAP file not found at {pcap_file_path}")
-        raise FileNotFoundError(f"PCAP file not found for session {session_id}")
 
-    print(f">>> [Extractor] Reading PCAP file: {pcap_file_path}")
-    try:
-        packets = rdpcap(pcap_file_path)
-    except Exception as e:
-        print(f"ERROR reading PCAP file {pcap_file_path} with Scapy: {e}\n{traceback.format_exc()}")
-        return {} # Return empty if PCAP can't be read
+    def __init__(self, pcap_file_path):
+        self._file = open(pcap_file_path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        try:
+            if len(self._mm) < 24:
+                raise ValueError("file too short for a pcap global header")
+            for endian in ('<', '>'):
+                magic, linktype = struct.unpack_from(endian + 'I16xI', self._mm, 0)
+                if magic in (_PCAP_MAGIC_USEC, _PCAP_MAGIC_NSEC):
+                    break
+            else:
+                raise ValueError(f"not a classic pcap file (magic {self._mm[:4].hex()})")
+            if linktype != storage.PCAP_LINKTYPE_ETHERNET:
+                raise ValueError(f"unsupported link type {linktype}")
+            self._record_hdr = struct.Struct(endian + 'IIII')
+        except Exception:
+            self._mm.close()
+            self._file.close()
+            raise
+        self._pos = 24
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._mm.close()
+        self._file.close()
+
+    def tell(self) -> int:
+        return self._pos
+
+    def __iter__(self):
+        mm = self._mm
+        size = len(mm)
+        record_hdr = self._record_hdr
+        pos = self._pos
+        while pos + record_hdr.size <= size:
+            _ts_sec, _ts_frac, caplen, _wirelen = record_hdr.unpack_from(mm, pos)
+            frame = pos + record_hdr.size
+            frame_end = frame + caplen
+            if frame_end > size:
+                break # Truncated last record
+            pos = self._pos = frame_end
+            yield _ethernet_segment(mm, frame, frame_end)
+
+
+def _ethernet_segment(buf, frame: int, frame_end: int) -> Optional[TcpSegment]:
+    """
+    Decodes the Ethernet frame buf[frame:frame_end] (with up to one VLAN tag)
+    carrying IPv4/TCP with struct, without creating packet objects.
+    Returns None for any other frame.
+    """
+    ip_start = frame + 14
+    if ip_start + 20 > frame_end:
+        return None
+    ethertype, = _ETHERTYPE.unpack_from(buf, ip_start - 2)
+    if ethertype in _ETH_VLAN:
+        ip_start += 4
+        if ip_start + 20 > frame_end:
+            return None
+        ethertype, = _ETHERTYPE.unpack_from(buf, ip_start - 2)
+    if ethertype != 0x0800:
+        return None
+    version_ihl, total_length, frag, protocol, src, dst = _IPV4_HDR.unpack_from(buf, ip_start)
+    # Non-first fragments don't start with a TCP header
+    if version_ihl >> 4 != 4 or protocol != 6 or frag & 0x1FFF:
+        return None
+    tcp_start = ip_start + (version_ihl & 0x0F) * 4
+    if tcp_start + 20 > frame_end:
+        return None
+    sport, dport, seq, data_offset, flags = _TCP_HDR.unpack_from(buf, tcp_start)
+    # The IP total length excludes Ethernet padding (0 with TCP segmentation offload)
+    ip_end = min(ip_start + total_length, frame_end) if total_length else frame_end
+    payload = buf[tcp_start + (data_offset >> 4) * 4:ip_end]
+    return (src, dst, sport, dport, flags, seq, payload)
+
 
-    print(f">>> [Extractor] Analyzing {len(packets)} packets for TCP sessions...")
-    # Group packets into TCP sessions using Scapy's sessions()
+def _open_segment_reader(session_id: str, pcap_file_path):
+    """
+    Opens the fastest segment reader that can read the file: the mmap reader
+    for Ethernet pcap files, then dpkt if installed, else Scapy (pcapng, other
+    link types).
+    """
     try:
-        tcp_sessions = packets.sessions()
+        return _MmapSegmentReader(pcap_file_path)
     except Exception as e:
-        print(f"ERROR grouping packets into TCP sessions: {e}\n{traceback.format_exc()}")
-        return {}
+        logger.info("mmap reader can't read %s (%s).", pcap_file_path, e)
+    if HAS_DPKT:
+        try:
+            return _DpktSegmentReader(pcap_file_path)
+        except Exception as e:
+            logger.info("dpkt can't read %s (%s). Falling back to Scapy.", pcap_file_path, e)
+    return _ScapySegmentReader(session_id)
 
-    print(f">>> [Extractor] Found {len(tcp_sessions)} TCP sessions in the PCAP.")
 
-    # Store results keyed by (client_ip, server_ip, server_port) tuple
-    # Value will be a list of DicomCommunicationInfo objects (as dicts for now)
-    results_by_ip: Dict[Tuple[str, str, int], List[Dict[str, Any]]] = defaultdict(list)
-    # Keep track of all processed streams to avoid duplicates if sessions() returns overlapping fragments
-    processed_stream_hashes = set()
-    # Store AE titles found directly from packet summaries, keyed by (client_ip, server_ip, server_port)
-    ae_titles_from_summary: Dict[Tuple[str, str, int], Dict[str, Optional[str]]] = defaultdict(lambda: {"CallingAE": None, "CalledAE": None})
+# Minimum wall-clock time between two progress callbacks
+_PROGRESS_INTERVAL = 0.25
 
 
-    session_count = 0
-    total_sessions = len(tcp_sessions)
+class _ProgressReporter:
+    """
+    Throttles progress_callback by wall-clock time: a new percentage is reported
+    at most every _PROGRESS_INTERVAL seconds, except 100 which always is.
+    """
+    __slots__ = ("callback", "last_progress", "last_time")
+
+    def __init__(self, callback: Optional[Callable[[int], None]]):
+        self.callback = callback
+        self.last_progress = -1
+        self.last_time = 0.0
+
+    def report(self, current_progress: int) -> None:
+        if not self.callback:
+            return
+        now = time.monotonic()
+        current_progress = min(100, current_progress)
+        if current_progress <= self.last_progress or (current_progress < 100 and now - self.last_time < _PROGRESS_INTERVAL):
+            return
+        try:
+            self.callback(current_progress)
+            logger.debug("Progress callback reported: %d%%", current_progress)
+            self.last_progress = current_progress
+            self.last_time = now
+        except Exception as cb_err:
+            logger.warning("Progress callback failed during DICOM extraction: %s", cb_err)
 
-    # --- First Pass: Extract AE Titles directly from Raw Payload Bytes ---
-    print(">>> [Extractor] First Pass: Scanning packets for A-ASSOCIATE raw payload info...")
-    packet_count = 0
 
-    for pkt in packets:
-        packet_count += 1
-        if not pkt.haslayer(TCP) or not pkt.haslayer(IP) or not pkt.haslayer(Raw):
+# Below this many A-ASSOCIATE candidates, decoding them one by one is cheaper than setting up NumPy arrays
+_NUMPY_AE_BATCH_MIN = 64
+
+
+def _strip_ae_fields(fields: List[bytes]) -> List[Tuple[int, int, int, int]]:
+    """
+    For each 32-byte (Called AE, Calling AE) block returns the (start, end)
+    offsets of both titles with space/NUL padding stripped, computed for the
+    whole batch at once with NumPy when it is installed.
+    """
+    if HAS_NUMPY and len(fields) >= _NUMPY_AE_BATCH_MIN:
+        titles = np.frombuffer(b''.join(fields), dtype=np.uint8).reshape(-1, 2, 16)
+        keep = (titles != 0x20) & (titles != 0x00)
+        non_empty = keep.any(axis=2)
+        starts = np.where(non_empty, keep.argmax(axis=2), 0)
+        ends = np.where(non_empty, 16 - keep[:, :, ::-1].argmax(axis=2), 0)
+        return [(s0, e0, 16 + s1, 16 + e1) for (s0, s1), (e0, e1) in zip(starts.tolist(), ends.tolist())]
+    bounds = []
+    for block in fields:
+        called, calling = block[:16], block[16:]
+        called_end = len(called.rstrip(b' \x00'))
+        calling_end = len(calling.rstrip(b' \x00'))
+        bounds.append((
+            min(16 - len(called.lstrip(b' \x00')), called_end), called_end,
+            16 + min(16 - len(calling.lstrip(b' \x00')), calling_end), 16 + calling_end,
+        ))
+    return bounds
+
+
+def _scan_associate_payloads(
+    candidates: List[Tuple[int, FlowKey, int, bytes]],
+    ae_titles_from_summary: Dict[Tuple[str, str, int], List[Optional[str]]],
+) -> None:
+    """
+    Reads the AE titles of the A-ASSOCIATE-RQ/AC payloads collected while
+    streaming, as (pdu_type, flow_key, packet_count, payload[10:42]) in capture order.
+    """
+    debug = logger.isEnabledFor(logging.DEBUG)
+    bounds = _strip_ae_fields([fields for _, _, _, fields in candidates])
+    for (pdu_type, flow_key, packet_count, fields), (called_start, called_end, calling_start, calling_end) in zip(candidates, bounds):
+        # Called AE Title is at payload bytes 10-25, Calling AE Title at 26-41; ASCII (common for AE titles)
+        called_ae_found = fields[called_start:called_end].decode('ascii', errors='ignore')
+        calling_ae_found = fields[calling_start:calling_end].decode('ascii', errors='ignore')
+        if not (called_ae_found or calling_ae_found):
             continue
+        if debug:
+            logger.debug("Raw payload scan: packet %d (%s): Calling='%s', Called='%s'",
+                         packet_count, 'RQ' if pdu_type == 0x01 else 'AC', calling_ae_found, called_ae_found)
+
+        # Determine the primary key (Client -> Server)
+        # For RQ, packet direction is Client -> Server
+        # For AC, packet direction is Server -> Client
+        pkt_client_ip, pkt_server_ip, pkt_client_port, pkt_server_port = flow_key
+        if pdu_type == 0x01: # RQ
+            primary_key = (_ipv4_str(pkt_client_ip), _ipv4_str(pkt_server_ip), pkt_server_port)
+        else: # AC
+            primary_key = (_ipv4_str(pkt_client_ip), _ipv4_str(pkt_server_ip), pkt_client_port) # Note: AC source port is server port
+
+        # Store AE titles under the primary key if found (last seen wins)
+        entry = ae_titles_from_summary.get(primary_key)
+        if entry is None:
+            entry = ae_titles_from_summary[primary_key] = [None, None]
+        if calling_ae_found:
+            entry[0] = calling_ae_found
+        if called_ae_found:
+            entry[1] = called_ae_found
+
+
+def _flow_fingerprint(flow_key: FlowKey, flow: _TcpFlow) -> Tuple[Any, ...]:
+    """
+    Cheap identity of a flow, computed without reassembling it: the client,
+    server and server port, the packet and payload byte counts, and the head of
+    the first and last payloads. Repeated identical sessions between the same
+    peers (e.g. an SCU re-sending the same association) share it.
+    """
+    segments = flow.segments
+    return (flow_key[0], flow_key[1], flow_key[3], flow.packet_count, flow.payload_size,
+            bytes(segments[0][1][:32]), bytes(segments[-1][1][:32]))
 
-        payload = bytes(pkt[Raw].load)
-        # Check for A-ASSOCIATE-RQ (0x01) or A-ASSOCIATE-AC (0x02) PDU Type
-        # and minimum length to contain AE titles (1 + 1 + 4 + 2 + 2 + 16 + 16 = 42 bytes)
-        if len(payload) >= 42 and (payload[0] == 0x01 or payload[0] == 0x02):
-            pdu_type = payload[0]
-            pkt_client_ip = pkt[IP].src
-            pkt_server_ip = pkt[IP].dst
-            pkt_client_port = pkt[TCP].sport
-            pkt_server_port = pkt[TCP].dport
 
-            try:
-                # Extract Called AE Title (bytes 10-25) and Calling AE Title (bytes 26-41)
-                called_ae_bytes = payload[10:26]
-                calling_ae_bytes = payload[26:42]
-
-                # Decode assuming ASCII (common for AE titles) and strip padding spaces
-                called_ae_found = called_ae_bytes.decode('ascii', errors='ignore').strip()
-                calling_ae_found = calling_ae_bytes.decode('ascii', errors='ignore').strip()
-
-                if called_ae_found or calling_ae_found:
-                    print(f"  [Raw Payload Scan] Packet {packet_count} ({'RQ' if pdu_type == 0x01 else 'AC'}): Found Calling='{calling_ae_found}', Called='{called_ae_found}'")
-
-                    # Determine the primary key (Client -> Server)
-                    # For RQ, packet direction is Client -> Server
-                    # For AC, packet direction is Server -> Client
-                    if pdu_type == 0x01: # RQ
-                        primary_key = (pkt_client_ip, pkt_server_ip, pkt_server_port)
-                    else: # AC
-                        primary_key = (pkt_client_ip, pkt_server_ip, pkt_client_port) # Note: AC source port is server port
-
-                    # Store AE titles under the primary key, overwriting if necessary (last seen wins?)
-                    # Or only store if None? Let's store if found.
-                    if calling_ae_found:
-                         ae_titles_from_summary[primary_key]["CallingAE"] = calling_ae_found
-                         print(f"    -> Stored CallingAE '{calling_ae_found}' for key {primary_key}")
-                    if called_ae_found:
-                         ae_titles_from_summary[primary_key]["CalledAE"] = called_ae_found
-                         print(f"    -> Stored CalledAE '{called_ae_found}' for key {primary_key}")
+def _finish_flow(flow_key: FlowKey, flow: _TcpFlow, seen_fingerprints: set, processed_stream_hashes: set) -> Optional[bytes]:
+    """
+    Returns the reassembled payload of one finished TCP flow direction if it is
+    worth parsing, or None if the flow is skipped.
 
-            except Exception as e:
-                print(f"  [Raw Payload Scan] Error processing payload for packet {packet_count}: {e}")
+    Flows whose fingerprint was already seen are skipped before reassembly;
+    the hash of the reassembled stream then catches the remaining duplicates.
+    """
+    client_ip, server_ip, client_port, server_port = flow_key
+    # Heuristic: Skip sessions with very few packets (unlikely to be DICOM association)
+    if flow.packet_count < 3: # Need at least SYN, SYN/ACK, ACK
+        return None
+    # Flows are per direction, so the sender of the first payload is the flow's source;
+    # a flow without payload (the SYN side of an empty connection) has nothing to parse
+    if not flow.segments:
+        return None
 
-    print(f"<<< [Extractor] First Pass Complete. Found AE titles from raw payload scan: {dict(ae_titles_from_summary)}")
+    fingerprint = _flow_fingerprint(flow_key, flow)
+    if fingerprint in seen_fingerprints:
+        flow.segments = [] # Release the payloads
+        logger.debug("Skipping session: same fingerprint as an already processed session.")
+        return None
+    seen_fingerprints.add(fingerprint)
 
+    stream_data = flow.reassemble()
 
-    # --- Second Pass: Process TCP Sessions (Existing Stream Parsing Logic - pydicom) ---
-    print(">>> [Extractor] Second Pass: Processing reassembled TCP sessions...")
-    session_count = 0
-    total_sessions = len(tcp_sessions)
-    last_reported_progress = -1 # Track last reported progress
+    # Avoid reprocessing identical stream data
+    stream_hash = _stream_digest(stream_data)
+    if stream_hash in processed_stream_hashes:
+        logger.debug("Skipping session: identical stream data already processed.")
+        return None
+    processed_stream_hashes.add(stream_hash)
 
-    for session_key, session_packets in tcp_sessions.items():
-        session_count += 1
-        print(f"\n>>> [Extractor] Processing TCP session {session_count}/{total_sessions}: {session_key}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Stream reassembled with %d bytes for session between %s:%d and %s:%d.",
+                     len(stream_data), _ipv4_str(client_ip), client_port, _ipv4_str(server_ip), server_port)
+    return stream_data
 
-        # --- Cancellation Check ---
-        if check_stop_requested and check_stop_requested():
-            print(f"!!! [Extractor] Stop requested. Aborting extraction for session {session_id} before processing session {session_key}.")
-            raise JobCancelledException("Stop requested by user.")
-        # ------------------------
 
-        # --- Progress Reporting Logic ---
-        if progress_callback and total_sessions > 0:
-            current_progress = int(((session_count) / total_sessions) * 100)
-            # Report only on change or every few percent to avoid spamming logs/callbacks
-            if current_progress > last_reported_progress and (current_progress % 5 == 0 or current_progress == 100):
-                try:
-                    progress_callback(current_progress)
-                    last_reported_progress = current_progress
-                    print(f"  [Progress Callback] Reported: {current_progress}%") # Debug log
-                except Exception as cb_err:
-                    print(f"Warning: Progress callback failed during DICOM extraction: {cb_err}")
-        # -----------------------------
-
-        # Heuristic: Skip sessions with very few packets (unlikely to be DICOM association)
-        if len(session_packets) < 3: # Need at least SYN, SYN/ACK, ACK
-             print(f"  Skipping session with only {len(session_packets)} packets.")
-             continue
-
-        # Reassemble TCP Stream data
-        stream_data = b""
-        client_ip: Optional[str] = None
-        server_ip: Optional[str] = None
-        server_port: Optional[int] = None
-        client_port: Optional[int] = None # Store client port too
-
-        # Determine client/server based on first SYN or data packet
-        # Look for SYN or first packet with payload to guess direction
-        first_data_packet = None
-        syn_packet = None
-        for pkt in session_packets:
-             if TCP in pkt and pkt[TCP].flags & 0x02: # Check for SYN flag
-                 syn_packet = pkt
-                 break
-             if TCP in pkt and pkt[TCP].payload:
-                 first_data_packet = pkt
-                 break
-
-        if syn_packet:
-            client_ip = syn_packet[IP].src
-            server_ip = syn_packet[IP].dst
-            client_port = syn_packet[TCP].sport
-            server_port = syn_packet[TCP].dport
-        elif first_data_packet:
-            # If no SYN (capture started mid-stream), guess based on first data
-            client_ip = first_data_packet[IP].src
-            server_ip = first_data_packet[IP].dst
-            client_port = first_data_packet[TCP].sport
-            server_port = first_data_packet[TCP].dport
-        else:
-             print("  Skipping session: Cannot determine client/server IPs/ports (no SYN or payload).")
-             continue # Cannot determine direction
-
-        # Filter packets for this specific flow (client -> server and server -> client)
-        # This might be redundant if tcp_sessions already gives clean sessions, but adds safety
-        flow_packets = [pkt for pkt in session_packets if IP in pkt and TCP in pkt and
-                        ((pkt[IP].src == client_ip and pkt[IP].dst == server_ip and pkt[TCP].sport == client_port and pkt[TCP].dport == server_port) or \
-                         (pkt[IP].src == server_ip and pkt[IP].dst == client_ip and pkt[TCP].sport == server_port and pkt[TCP].dport == client_port))]
-
-        # Crude reassembly by concatenating payloads in order
-        # Scapy's TCPSession reassembly is preferred if available and reliable
-        # For simplicity here, just concat payloads for DICOM check
-        # WARNING: This crude reassembly might fail for complex streams with retransmissions etc.
-        ordered_payloads = sorted(flow_packets, key=lambda p: (p.time, p[TCP].seq))
-        for pkt in ordered_payloads:
-            if pkt[TCP].payload:
-                 stream_data += bytes(pkt[TCP].payload)
-
-        if not stream_data:
-            print("  Skipping session: No TCP payload data found.")
-            continue
+# Finished streams are sent to the worker processes in batches, to amortize the
+# per-task IPC cost over several (usually small) streams; a large stream goes alone
+_STREAMS_PER_TASK = 8
+_BATCH_BYTES = 1 << 20
 
-        print(f"  Stream reassembled with {len(stream_data)} bytes for session between {client_ip}:{client_port} and {server_ip}:{server_port}.")
 
-        # Avoid reprocessing identical stream data if session keys were ambiguous
-        stream_hash = hash(stream_data)
-        if stream_hash in processed_stream_hashes:
-            print("  Skipping session: Identical stream data already processed.")
-            continue
-        processed_stream_hashes.add(stream_hash)
-
-        # Attempt to extract metadata using the existing stream-based function
-        stream_buffer = io.BytesIO(stream_data)
-        metadata_obj = extract_relevant_metadata(stream_buffer, (client_ip, server_ip, server_port)) # This function still does the detailed PDU parsing
-
-        # --- Integration Step: Merge AE Titles from Packet Scan ---
-        comm_key = (client_ip, server_ip, server_port)
-        summary_aes = ae_titles_from_summary.get(comm_key, {})
-        summary_calling_ae = summary_aes.get("CallingAE")
-        summary_called_ae = summary_aes.get("CalledAE")
-
-        if metadata_obj:
-            print(f">>> [Extractor] Stream metadata extracted for key: {comm_key}")
-            # Override AE titles if they are missing/empty in stream result but found in packet scan
-            if not metadata_obj.CallingAE and summary_calling_ae:
-                print(f"  Overriding empty CallingAE with value from packet scan: '{summary_calling_ae}'")
-                metadata_obj.CallingAE = summary_calling_ae
-            if not metadata_obj.CalledAE and summary_called_ae:
-                print(f"  Overriding empty CalledAE with value from packet scan: '{summary_called_ae}'")
-                metadata_obj.CalledAE = summary_called_ae
-
-            # Append result as a dictionary
-            metadata_dict = {}
-            for field, value in metadata_obj.__dict__.items():
-                 if isinstance(value, bytes):
-                     try:
-                         metadata_dict[field] = value.decode('ascii', errors='replace').strip()
-                     except UnicodeDecodeError:
-                         metadata_dict[field] = repr(value) # Fallback for non-decodable bytes
-                 else:
-                     metadata_dict[field] = value
-
-            comm_info = {
-                "client_ip": client_ip,
-                "server_ip": server_ip,
-                "server_port": server_port,
-                "metadata": metadata_dict
-            }
-            results_by_ip[comm_key].append(comm_info)
-            print(f"  Stored communication info (potentially merged). Current count for key {comm_key}: {len(results_by_ip[comm_key])}")
-        elif summary_calling_ae or summary_called_ae:
-             # If stream parsing failed BUT packet scan found AE titles, create a minimal metadata entry
-             print(f"  Stream parsing failed for key {comm_key}, but found AE titles in packet scan. Creating minimal entry.")
-             minimal_metadata = {
-                 "CallingAE": summary_calling_ae,
-                 "CalledAE": summary_called_ae,
-                 # Set other fields to None or default
-                 "ImplementationClassUID": None, "ImplementationVersionName": None, "negotiation_successful": None,
-                 "Manufacturer": None, "ManufacturerModelName": None, "DeviceSerialNumber": None,
-                 "SoftwareVersions": None, "TransducerData": None, "StationName": None
-             }
-             comm_info = {
-                "client_ip": client_ip,
-                "server_ip": server_ip,
-                "server_port": server_port,
-                "metadata": minimal_metadata
-             }
-             results_by_ip[comm_key].append(comm_info)
-             print(f"  Stored minimal communication info from packet scan. Current count for key {comm_key}: {len(results_by_ip[comm_key])}")
+def _extract_streams(batch: List[Tuple[bytes, Tuple[str, str, int]]]) -> List[Optional[DicomExtractedMetadata]]:
+    """Worker task: extract_relevant_metadata for each (stream_data, comm_key) of a batch."""
+    results: List[Optional[DicomExtractedMetadata]] = []
+    for stream_data, comm_key in batch:
+        try:
+            results.append(extract_relevant_metadata(stream_data, comm_key))
+        except Exception as e:
+            logger.error("ERROR parsing stream %s: %s", comm_key, e, exc_info=True)
+            results.append(None)
+    return results
+
+
+_NO_AE_TITLES = (None, None)
+
+# Metadata fields aggregated per IP pair, in output order
+_AGGREGATED_FIELDS = DicomExtractedMetadata.__slots__
+_AGGREGATED_FIELD_SET = frozenset(_AGGREGATED_FIELDS)
+
+
+class _IpPairAggregate:
+    """Metadata aggregated over every stream between one client and server IP; see to_dict()."""
+    __slots__ = ('client_ip', 'server_ip') + _AGGREGATED_FIELDS + ('server_ports',)
+
+    def __init__(self, client_ip: str, server_ip: str):
+        self.client_ip = client_ip
+        self.server_ip = server_ip
+        for field in _AGGREGATED_FIELDS:
+            setattr(self, field, None)
+        self.server_ports = set() # Unique server ports seen for this IP pair
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The JSON-ready entry returned by extract_dicom_metadata_from_pcap (server_ports sorted)."""
+        entry = {slot: getattr(self, slot) for slot in self.__slots__}
+        entry['server_ports'] = sorted(self.server_ports)
+        return entry
+
+
+def _json_element_value(value: Any) -> Any:
+    """A P-DATA element value as str (or list of str for multi-valued elements), so results stay JSON-serializable."""
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('ascii', errors='replace').strip()
+    if isinstance(value, MultiValue):
+        return [_json_element_value(item) if isinstance(item, bytes) else str(item) for item in value]
+    return str(value)
+
+
+def _merge_flow_result(
+    comm_key: Tuple[str, str, int],
+    metadata_obj: Optional[DicomExtractedMetadata],
+    ae_titles_from_summary: Dict[Tuple[str, str, int], List[Optional[str]]],
+    results_by_ip: Dict[Tuple[str, str, int], List[Dict[str, Any]]],
+) -> None:
+    """Appends the metadata parsed from one stream, merged with the AE titles from the payload scan, to results_by_ip."""
+    client_ip, server_ip, server_port = comm_key
+
+    # --- Integration Step: Merge AE Titles from Packet Scan ---
+    summary_calling_ae, summary_called_ae = ae_titles_from_summary.get(comm_key, _NO_AE_TITLES)
+
+    if metadata_obj:
+        logger.debug("Stream metadata extracted for key: %s", comm_key)
+        # Override AE titles if they are missing/empty in stream result but found in packet scan
+        if not metadata_obj.CallingAE and summary_calling_ae:
+            metadata_obj.CallingAE = summary_calling_ae
+        if not metadata_obj.CalledAE and summary_called_ae:
+            metadata_obj.CalledAE = summary_called_ae
+
+        # Append result as a dictionary
+        metadata_dict = {field: getattr(metadata_obj, field) for field in _AGGREGATED_FIELDS}
+        # The association fields are decoded by _parse_associate; only P-DATA
+        # elements can still hold pydicom values (bytes for a wanted tag sent
+        # with VR UN, MultiValue, PersonName, ...)
+        for field in _WANTED_FIELDS:
+            metadata_dict[field] = _json_element_value(metadata_dict[field])
+        results_by_ip[comm_key].append({
+            "client_ip": client_ip,
+            "server_ip": server_ip,
+            "server_port": server_port,
+            "metadata": metadata_dict
+        })
+    elif summary_calling_ae or summary_called_ae:
+        # If stream parsing failed BUT packet scan found AE titles, create a minimal metadata entry
+        logger.debug("Stream parsing failed for key %s, but found AE titles in packet scan. Creating minimal entry.", comm_key)
+        minimal_metadata = {
+            "CallingAE": summary_calling_ae,
+            "CalledAE": summary_called_ae,
+            # Set other fields to None or default
+            "ImplementationClassUID": None, "ImplementationVersionName": None, "negotiation_successful": None,
+            "Manufacturer": None, "ManufacturerModelName": None, "DeviceSerialNumber": None,
+            "SoftwareVersions": None, "TransducerData": None, "StationName": None
+        }
+        results_by_ip[comm_key].append({
+            "client_ip": client_ip,
+            "server_ip": server_ip,
+            "server_port": server_port,
+            "metadata": minimal_metadata
+        })
+
+# Extraction results are cached next to the capture, tagged with the capture's
+# size and mtime so a replaced or rewritten capture is re-extracted.
+_RESULTS_CACHE_FILENAME = ".dicom_metadata_cache.pkl"
+# Stored with the results: bump it whenever the extractor's output changes, so
+# results cached by an older version are extracted again
+_RESULTS_CACHE_VERSION = 2
+
+
+def _load_cached_results(session_id: str, capture_stat: os.stat_result) -> Optional[Dict[str, Any]]:
+    """Returns the cached results for this exact capture file, or None."""
+    cache_path = storage.get_session_filepath(session_id, _RESULTS_CACHE_FILENAME)
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Ignoring unreadable DICOM metadata cache %s: %s", cache_path, e)
+        return None
+    # Caches written before the version field are 3-tuples
+    if not isinstance(cached, tuple) or len(cached) != 4 or cached[0] != _RESULTS_CACHE_VERSION:
+        return None
+    _, size, mtime_ns, results = cached
+    if (size, mtime_ns) != (capture_stat.st_size, capture_stat.st_mtime_ns):
+        return None
+    return results
+
+
+def _store_cached_results(session_id: str, capture_stat: os.stat_result, results: Dict[str, Any]) -> None:
+    """Writes the results cache atomically; failures only cost a re-extraction next time."""
+    cached = (_RESULTS_CACHE_VERSION, capture_stat.st_size, capture_stat.st_mtime_ns, results)
+    try:
+        storage.store_bytes(session_id, _RESULTS_CACHE_FILENAME, pickle.dumps(cached, protocol=5))
+    except Exception as e:
+        logger.warning("Could not write DICOM metadata cache for session %s: %s", session_id, e)
+
+
+# --- Main Extractor Function ---
+def extract_dicom_metadata_from_pcap(
+    session_id: str,
+    progress_callback: Optional[Callable[[int], None]] = None,
+    check_stop_requested: Optional[Callable[[], bool]] = None, # Added cancellation check callback
+    max_workers: Optional[int] = None,
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Main function to extract DICOM metadata from a PCAP file associated with a session.
+    Streams the PCAP (memory-mapped for Ethernet pcap files, else with dpkt
+    or Scapy's PcapReader), reassembles TCP flows by sequence number into
+    per-direction payload buffers and parses each flow in a worker process
+    with `extract_relevant_metadata` as it ends (FIN/RST) or at the end of
+    the file. Results are cached per capture file (size + mtime).
+
+    The flows are parsed by a pool of `max_workers` processes (os.cpu_count()
+    if None); with max_workers=1 they are parsed in this process instead, e.g.
+    when the caller already is one of several worker processes.
+
+    Returns a dictionary where keys are string representations of (client_ip, server_ip, server_port)
+    tuples and values are lists of DicomCommunicationInfo-like dictionaries.
+    """
+    pcap_file_path = storage.get_capture_path(session_id)
+    if not os.path.exists(pcap_file_path):
+        logger.error("PCAP file not found at %s", pcap_file_path)
+        raise FileNotFoundError(f"PCAP file not found for session {session_id}")
+
+    capture_stat = os.stat(pcap_file_path)
+    cached_results = _load_cached_results(session_id, capture_stat)
+    if cached_results is not None:
+        logger.info("Using cached DICOM metadata for session %s", session_id)
+        if progress_callback:
+            progress_callback(100)
+        return cached_results
+
+    logger.info("Streaming PCAP file: %s", pcap_file_path)
+    try:
+        reader = _open_segment_reader(session_id, pcap_file_path)
+    except Exception as e:
+        logger.error("ERROR reading PCAP file %s: %s", pcap_file_path, e, exc_info=True)
+        return {} # Return empty if PCAP can't be read
+
+    # Store results keyed by (client_ip, server_ip, server_port) tuple
+    # Value will be a list of DicomCommunicationInfo objects (as dicts for now)
+    results_by_ip: Dict[Tuple[str, str, int], List[Dict[str, Any]]] = defaultdict(list)
+    # Keep track of all processed streams to avoid duplicates if the same payload shows up twice
+    processed_stream_hashes = set()
+    # Cheaper pre-reassembly check for the same thing, see _flow_fingerprint
+    seen_fingerprints = set()
+    # Store AE titles found directly from packet payloads, keyed by (client_ip, server_ip, server_port)
+    # Values are [CallingAE, CalledAE]
+    ae_titles_from_summary: Dict[Tuple[str, str, int], List[Optional[str]]] = {}
+    # A-ASSOCIATE-RQ/AC payloads seen while streaming, decoded in one batch afterwards
+    associate_candidates: List[Tuple[int, FlowKey, int, bytes]] = []
+    # Open TCP flows, one per direction (like Scapy's sessions()), keyed by (src_ip, dst_ip, sport, dport)
+    open_flows: Dict[FlowKey, _TcpFlow] = {}
+
+    file_size = capture_stat.st_size
+    progress = _ProgressReporter(progress_callback)
+    packet_count = 0
+    # Batches submitted for parsing, in flow-completion order: (comm_keys, future)
+    pending: List[Tuple[List[Tuple[str, str, int]], Any]] = []
+    # Finished streams not submitted yet, and their total size
+    batch: List[Tuple[bytes, Tuple[str, str, int]]] = []
+    batch_bytes = 0
+    # Streams are parsed in worker processes (pydicom parsing is CPU-bound), created on first use,
+    # unless max_workers is 1
+    pool: Optional[ProcessPoolExecutor] = None
+
+    def submit_batch() -> None:
+        nonlocal pool, batch, batch_bytes
+        if not batch:
+            return
+        if max_workers == 1:
+            future = Future()
+            try:
+                future.set_result(_extract_streams(batch))
+            except Exception as e:
+                future.set_exception(e)
         else:
-            # No metadata found by either method
-            print(f"  No relevant DICOM metadata found or extracted for stream between {client_ip}:{client_port} and {server_ip}:{server_port} by either method.")
+            if pool is None:
+                pool = ProcessPoolExecutor(max_workers=max_workers or os.cpu_count())
+            future = pool.submit(_extract_streams, batch)
+        pending.append(([comm_key for _, comm_key in batch], future))
+        batch = []
+        batch_bytes = 0
+
+    def submit_flow(flow_key: FlowKey, flow: _TcpFlow) -> None:
+        nonlocal batch_bytes
+        stream_data = _finish_flow(flow_key, flow, seen_fingerprints, processed_stream_hashes)
+        if stream_data is None:
+            return
+        comm_key = (_ipv4_str(flow_key[0]), _ipv4_str(flow_key[1]), flow_key[3])
+        batch.append((stream_data, comm_key))
+        batch_bytes += len(stream_data)
+        if len(batch) >= _STREAMS_PER_TASK or batch_bytes >= _BATCH_BYTES:
+            submit_batch()
 
+    try:
+        # --- Single pass: scan A-ASSOCIATE payloads and demux TCP flows as packets stream in ---
+        with reader:
+            for segment in reader:
+                packet_count += 1
+
+                if packet_count % _CHECK_EVERY_N_PACKETS == 0:
+                    # --- Cancellation Check ---
+                    if check_stop_requested and check_stop_requested():
+                        logger.info("Stop requested. Aborting extraction for session %s at packet %d.", session_id, packet_count)
+                        raise JobCancelledException("Stop requested by user.")
+                    # --- Progress Reporting Logic: reading the file is the first half ---
+                    if file_size > 0:
+                        progress.report(int(reader.tell() / file_size * 50))
+
+                if segment is None:
+                    continue # Not IP/TCP
+                src_ip, dst_ip, sport, dport, flags, seq, payload = segment
+                flow_key = (src_ip, dst_ip, sport, dport)
+                flow = open_flows.get(flow_key)
+                if flow is None:
+                    flow = open_flows[flow_key] = _TcpFlow()
+                flow.packet_count += 1
+
+                if payload:
+                    flow.add_segment(seq, payload)
+                    # Check for A-ASSOCIATE-RQ (0x01) or A-ASSOCIATE-AC (0x02) PDU Type
+                    # and minimum length to contain AE titles (1 + 1 + 4 + 2 + 2 + 16 + 16 = 42 bytes)
+                    if len(payload) >= 42 and payload.startswith(_AS_PDU_TYPES):
+                        associate_candidates.append((payload[0], flow_key, packet_count, bytes(payload[10:42])))
+
+                # FIN or RST: this direction is done, hand it to the pool and free its buffer
+                if flags & 0x05:
+                    submit_flow(flow_key, open_flows.pop(flow_key))
+
+        # Flows without FIN/RST (capture cut off, or still open when it ended)
+        for flow_key, flow in open_flows.items():
+            submit_flow(flow_key, flow)
+        open_flows.clear()
+        submit_batch()
+        _scan_associate_payloads(associate_candidates, ae_titles_from_summary)
+        associate_candidates.clear()
+        progress.report(50)
+        logger.info("Streamed %d packets, parsing %d TCP streams.", packet_count, sum(len(comm_keys) for comm_keys, _ in pending))
+
+        # --- Collect parsed streams; the second half of the progress ---
+        parsed: Dict[Any, List[Optional[DicomExtractedMetadata]]] = {}
+        comm_keys_by_future = {future: comm_keys for comm_keys, future in pending}
+        for done_count, future in enumerate(as_completed(comm_keys_by_future), start=1):
+            if check_stop_requested and check_stop_requested():
+                logger.info("Stop requested. Aborting extraction for session %s while parsing streams.", session_id)
+                raise JobCancelledException("Stop requested by user.")
+            try:
+                parsed[future] = future.result()
+            except Exception as e:
+                logger.error("ERROR parsing streams in worker process: %s", e)
+                parsed[future] = [None] * len(comm_keys_by_future[future])
+            progress.report(50 + done_count * 50 // len(pending))
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    # Merge in flow order so results don't depend on which worker finished first
+    for comm_keys, future in pending:
+        for comm_key, metadata_obj in zip(comm_keys, parsed[future]):
+            _merge_flow_result(comm_key, metadata_obj, ae_titles_from_summary, results_by_ip)
+    progress.report(100)
 
     # --- Post-processing: Aggregation by IP Pair ---
-    print(f"\n>>> [Extractor] Finished processing all {total_sessions} TCP sessions. Aggregating results by IP pair...")
 
-    aggregated_results: Dict[str, Dict[str, Any]] = {}
+    aggregates: Dict[str, _IpPairAggregate] = {}
 
     for key_tuple, comm_list in results_by_ip.items():
-        client_ip, server_ip, _ = key_tuple # Extract IPs from the tuple key
+        client_ip, server_ip, server_port = key_tuple # Extract IPs from the tuple key
         agg_key = f"{client_ip}-{server_ip}" # Create aggregation key based on IPs only
 
-        if agg_key not in aggregated_results:
-            # Initialize the entry for this IP pair
-            aggregated_results[agg_key] = {
-                "client_ip": client_ip,
-                "server_ip": server_ip,
-                # Initialize all potential metadata fields to None or default
-                "CallingAE": None,
-                "CalledAE": None,
-                "ImplementationClassUID": None,
-                "ImplementationVersionName": None,
-                "negotiation_successful": None, # Keep track of negotiation status if needed
-                "Manufacturer": None,
-                "ManufacturerModelName": None,
-                "DeviceSerialNumber": None,
-                "SoftwareVersions": None, # Use None initially, could become list later if needed
-                "TransducerData": None,
-                "StationName": None,
-                # Add a field to store the list of server ports seen for this IP pair
-                "server_ports": set() # Use a set to store unique ports
-            }
+        agg = aggregates.get(agg_key)
+        if agg is None:
+            # Initialize the entry for this IP pair, all metadata fields None
+            agg = aggregates[agg_key] = _IpPairAggregate(client_ip, server_ip)
 
         # Add the server port from this specific communication to the set
-        aggregated_results[agg_key]["server_ports"].add(key_tuple[2]) # Add the port
+        agg.server_ports.add(server_port)
 
         # Iterate through each communication instance found for this specific flow (key_tuple)
         for comm_info in comm_list:
-            metadata = comm_info.get("metadata", {})
+            metadata = comm_info.get("metadata")
             if not metadata: continue # Skip if no metadata in this instance
 
-            # Aggregate metadata: Update fields only if the current aggregated value is None/empty
-            for field in [
-                "CallingAE", "CalledAE", "ImplementationClassUID", "ImplementationVersionName",
-                "Manufacturer", "ManufacturerModelName", "DeviceSerialNumber",
-                "SoftwareVersions", "TransducerData", "StationName"
-            ]:
-                if aggregated_results[agg_key][field] is None and metadata.get(field) is not None:
-                    aggregated_results[agg_key][field] = metadata[field]
-
-            # Handle negotiation_successful: Maybe prioritize 'True' or 'False' over 'None'?
-            # For simplicity, let's take the first non-None value encountered.
-            if aggregated_results[agg_key]["negotiation_successful"] is None and metadata.get("negotiation_successful") is not None:
-                 aggregated_results[agg_key]["negotiation_successful"] = metadata.get("negotiation_successful")
+            # Aggregate metadata: the first non-None value of each field wins
+            # (negotiation_successful included)
+            for field, value in metadata.items():
+                if value is not None and field in _AGGREGATED_FIELD_SET and getattr(agg, field) is None:
+                    setattr(agg, field, value)
 
-
-    # Convert server_ports set to a sorted list for consistent JSON output
-    for key in aggregated_results:
-        aggregated_results[key]["server_ports"] = sorted(list(aggregated_results[key]["server_ports"]))
+    # Plain dicts for the JSON response and the results cache
+    aggregated_results = {agg_key: agg.to_dict() for agg_key, agg in aggregates.items()}
 
     total_aggregated_entries = len(aggregated_results)
-    print(f">>> [Extractor] Aggregation complete. Found {total_aggregated_entries} unique IP pairs with DICOM metadata.")
-    print(f"<<< [Extractor] EXIT function for session {session_id}. Returning aggregated results.")
-    # Use repr() for potentially more detail on complex objects within the dict
-    # print(f"<<< [Extractor] Final aggregated results content: {repr(aggregated_results)}")
+    logger.info("Aggregation complete for session %s. Found %d unique IP pairs with DICOM metadata.", session_id, total_aggregated_entries)
 
+    _store_cached_results(session_id, capture_stat, aggregated_results)
     return aggregated_results # Return the aggregated dictionary
 
 
 # --- Test Execution Block ---
 if __name__ == '__main__':
-    # Create a dummy session dir if it doesn't exist
-    if not os.path.exists(SESSION_DIR):
-        os.makedirs(SESSION_DIR)
-        print(f"Created session directory: {SESSION_DIR}")
-
     TEST_SESSION_ID = "test_dicom_session"
     print(f"\n--- Running Test Block for session: {TEST_SESSION_ID} ---")
-    TEST_PCAP_PATH = get_capture_path(TEST_SESSION_ID)
+    TEST_PCAP_PATH = storage.get_capture_path(TEST_SESSION_ID) # storage creates the sessions directory
 
     # Check if test pcap exists, if not, maybe skip test or create a dummy one
     if not os.path.exists(TEST_PCAP_PATH):
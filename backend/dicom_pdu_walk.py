@@ -0,0 +1,57 @@
+# backend/dicom_pdu_walk.py
+# Offset arithmetic for walking the DICOM Upper Layer PDUs of a reassembled
+# TCP stream, used by dicom_pcap_extractor.py.
+# Kept in its own module, on plain bytes/int operations (no struct, no
+# memoryview), so it can be compiled ahead of time with mypyc:
+#     cd backend && mypyc dicom_pdu_walk.py
+# The compiled extension then shadows this file on import. Uncompiled, it is
+# ordinary Python and behaves the same.
+
+from typing import List, Optional, Tuple
+
+PDU_HEADER_SIZE = 6 # PDU type, Reserved, PDU length (4 bytes, Big Endian)
+PDV_HEADER_SIZE = 5 # PDV item length (4 bytes, Big Endian), Presentation Context ID
+
+
+def _u32(buf: bytes, pos: int) -> int:
+    return (buf[pos] << 24) | (buf[pos + 1] << 16) | (buf[pos + 2] << 8) | buf[pos + 3]
+
+
+def read_pdu_header(buf: bytes, pos: int, end: int) -> Optional[Tuple[int, int, int]]:
+    """
+    Reads the header of the PDU starting at `pos`.
+
+    Returns (pdu_type, data_start, data_end), or None if there isn't a
+    complete PDU between `pos` and `end`.
+    """
+    if end - pos < PDU_HEADER_SIZE:
+        return None
+    data_start = pos + PDU_HEADER_SIZE
+    data_end = data_start + _u32(buf, pos + 2)
+    if data_end > end:
+        return None
+    return buf[pos], data_start, data_end
+
+
+def data_pdvs(buf: bytes, start: int, end: int) -> Tuple[List[Tuple[int, bool, int, int]], int]:
+    """
+    Walks the PDV items of the P-DATA-TF PDU body in buf[start:end].
+
+    Returns ([(context_id, is_last_fragment, data_start, data_end), ...], stop),
+    listing only data PDVs: command PDVs (Message Control Header bit 0, PS3.8
+    E.2) carry none of the dataset tags the extractor looks for. data_start..data_end
+    is the fragment without its Message Control Header. `stop` is the offset
+    where the walk ended; it is less than `end` if the last PDV is truncated.
+    """
+    pdvs: List[Tuple[int, bool, int, int]] = []
+    pos = start
+    while pos + PDV_HEADER_SIZE < end:
+        item_length = _u32(buf, pos) # Counts the context ID and Message Control Header bytes
+        item_end = pos + 4 + item_length
+        if item_length < 2 or item_end > end:
+            break
+        message_control_header = buf[pos + 5]
+        if not message_control_header & 0x01:
+            pdvs.append((buf[pos + 4], (message_control_header & 0x02) != 0, pos + 6, item_end))
+        pos = item_end
+    return pdvs, pos
@@ -0,0 +1,175 @@
+# backend/job_state.py
+# Live state of running jobs (progress, stop requests) kept in Redis, so the
+# per-tick progress writes and cancellation checks don't go through the SQL
+# database. Stop requests are also published, so a running job learns about
+# them from a listener thread instead of polling, and so are job updates, so
+# the SSE streams only re-read a job when it changed.
+# Enabled when redis-py is installed and REDIS_URL is set; otherwise every
+# function here is a no-op (or returns nothing found) and callers keep using
+# the AsyncJob row.
+# The database stays the source of truth for terminal states and results.
+
+import os
+import threading
+from typing import Dict, Iterable, Optional
+
+try:
+    import redis
+    import redis.asyncio
+    HAS_REDIS = True
+except ImportError:
+    HAS_REDIS = False
+
+REDIS_URL = os.environ.get("REDIS_URL")
+# Keys outlive a job by at most this long if it never cleans up (e.g. a crash)
+JOB_STATE_TTL_SECONDS = 24 * 3600
+# How long a stop listener blocks for a message before checking whether it should exit
+STOP_LISTENER_TIMEOUT = 1.0
+
+_client = None # Sync client, for the background job threads
+_async_client = None # Async client, for the request handlers
+_stop_listeners = {} # job_id -> pub/sub worker thread of the job's stop channel
+
+
+def enabled() -> bool:
+    return HAS_REDIS and bool(REDIS_URL)
+
+
+def _progress_key(job_id: int) -> str:
+    return f"job:{job_id}:progress"
+
+
+def _stop_key(job_id: int) -> str:
+    return f"job:{job_id}:stop"
+
+
+def _stop_channel(job_id: int) -> str:
+    return f"job:{job_id}:cancel"
+
+
+def _updates_channel(job_id: int) -> str:
+    return f"job:{job_id}:updates"
+
+
+def _get_client():
+    global _client
+    if _client is None and enabled():
+        _client = redis.Redis.from_url(REDIS_URL)
+    return _client
+
+
+def _get_async_client():
+    global _async_client
+    if _async_client is None and enabled():
+        _async_client = redis.asyncio.Redis.from_url(REDIS_URL)
+    return _async_client
+
+
+# --- Background job side (sync) ---
+
+def set_progress(job_id: int, progress: int) -> None:
+    client = _get_client()
+    if client is not None:
+        with client.pipeline(transaction=False) as pipe:
+            pipe.set(_progress_key(job_id), progress, ex=JOB_STATE_TTL_SECONDS)
+            pipe.publish(_updates_channel(job_id), 1)
+            pipe.execute()
+
+
+def notify(job_id: int) -> None:
+    """Tells the job's subscribers (see subscribe_updates) that its row changed."""
+    client = _get_client()
+    if client is not None:
+        client.publish(_updates_channel(job_id), 1)
+
+
+def watch_stop(job_id: int) -> Optional[threading.Event]:
+    """
+    Subscribes to the job's stop channel and returns an Event that is set once a
+    stop is requested, so checking for one is an in-memory read.
+    The listener runs until clear(job_id). Returns None if job_state is disabled.
+    """
+    client = _get_client()
+    if client is None:
+        return None
+    stop_event = threading.Event()
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**{_stop_channel(job_id): lambda message: stop_event.set()})
+    _stop_listeners[job_id] = pubsub.run_in_thread(sleep_time=STOP_LISTENER_TIMEOUT, daemon=True)
+    # A stop requested before the subscription only left its key behind
+    if client.exists(_stop_key(job_id)):
+        stop_event.set()
+    return stop_event
+
+
+def clear(job_id: int) -> None:
+    """Drops the live state of a job once its final state is in the database."""
+    listener = _stop_listeners.pop(job_id, None)
+    if listener is not None:
+        listener.stop()
+    client = _get_client()
+    if client is not None:
+        with client.pipeline(transaction=False) as pipe:
+            pipe.delete(_progress_key(job_id), _stop_key(job_id))
+            pipe.publish(_updates_channel(job_id), 1)
+            pipe.execute()
+
+
+# --- Request handler side (async) ---
+
+async def request_stop(job_id: int) -> None:
+    client = _get_async_client()
+    if client is not None:
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.set(_stop_key(job_id), 1, ex=JOB_STATE_TTL_SECONDS)
+            pipe.publish(_stop_channel(job_id), 1)
+            pipe.publish(_updates_channel(job_id), 1)
+            await pipe.execute()
+
+
+async def get_progress(job_ids: Iterable[int]) -> Dict[int, int]:
+    """Live progress of the given jobs, for those that have one."""
+    client = _get_async_client()
+    job_ids = list(job_ids)
+    if client is None or not job_ids:
+        return {}
+    values = await client.mget([_progress_key(job_id) for job_id in job_ids])
+    return {job_id: int(value) for job_id, value in zip(job_ids, values) if value is not None}
+
+
+async def subscribe_updates(job_id: int):
+    """
+    Subscribes to the job's updates: pass the result to wait_for_update, and
+    aclose() it when done. Returns None if job_state is disabled.
+    """
+    client = _get_async_client()
+    if client is None:
+        return None
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(_updates_channel(job_id))
+    return pubsub
+
+
+async def wait_for_update(pubsub, timeout: float) -> bool:
+    """
+    Waits up to `timeout` seconds for an update of the subscribed job, then
+    drops the ones queued behind it. Returns False on timeout.
+    """
+    if await pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout) is None:
+        return False
+    while await pubsub.get_message(ignore_subscribe_messages=True, timeout=0) is not None:
+        pass
+    return True
+
+
+async def close() -> None:
+    global _client, _async_client
+    for listener in _stop_listeners.values():
+        listener.stop()
+    _stop_listeners.clear()
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+    if _client is not None:
+        _client.close()
+        _client = None
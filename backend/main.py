@@ -10,17 +10,24 @@ if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
 import asyncio
+import functools
+import hashlib
 import json
 import logging  # Added for logging configuration
+import multiprocessing
 import os  # Required for file operations (delete)
+import queue
 import shutil
 import tempfile  # Added missing import
+import time
 import traceback  # To debug and print full tracebacks
 import uuid
-from contextlib import asynccontextmanager
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path  # Added for Path type hint
-from typing import Any, Dict, List, Literal, Optional, Tuple  # Added Dict, Any, Literal, Tuple
+from typing import Annotated, Any, Callable, Dict, Iterator, List, Literal, Optional, Tuple  # Added Dict, Any, Literal, Tuple
 
 from fastapi import (
     BackgroundTasks,
@@ -30,6 +37,7 @@ from fastapi import (
     Form,
     HTTPException,
     Query,  # Added Query
+    Request,
     Response,
     status,
     UploadFile,
@@ -41,18 +49,40 @@ from fastapi.responses import (
     StreamingResponse,
 )
 from fastapi.routing import APIRouter # Added for organizing routes
-from sqlmodel import Session, SQLModel, select  # Ensure select is imported
+from sqlmodel import Session, SQLModel, and_, bindparam, delete, func, insert, or_, select, update  # Ensure select is imported
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import defer
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 # --- Database Imports ---
-from backend.database import AsyncJob, PcapSession, create_db_and_tables, engine, get_session  # Added AsyncJob, engine
+from backend.database import AsyncJob, DicomMetadataOverride, PcapSession, async_engine, create_db_and_tables, engine, get_session  # Added AsyncJob, engine
 
 # --- Storage Import ---
 from backend import storage  # Import the refactored storage module
+from backend import job_state  # Live job progress/stop state (Redis, optional)
 
 # --- Basic Logging Configuration ---
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+def start_log_listener() -> QueueListener:
+    """
+    Moves the root logger's handlers behind a QueueListener: logging calls
+    (from the event loop included) then only enqueue the record, and the
+    writes to stderr happen on the listener's thread.
+    """
+    root_logger = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *root_logger.handlers, respect_handler_level=True)
+    root_logger.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+def stop_log_listener(listener: QueueListener) -> None:
+    """Flushes the queued records and gives the handlers back to the root logger."""
+    listener.stop()
+    logging.getLogger().handlers = list(listener.handlers)
+
 # --- Central Exception Import ---
 from backend.exceptions import JobCancelledException
 
@@ -65,6 +95,7 @@ from backend.anonymizer import (  # Use absolute import
     apply_anonymization,
     # apply_anonymization_response, # This model seems unused, consider removing if confirmed
     generate_preview,
+    preview_to_rows,
     get_subnets,
     save_rules,
 )
@@ -82,7 +113,7 @@ logger.info("Successfully imported extract_dicom_metadata_from_pcap from backend
 
 
 # --- Pydantic Models ---
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PositiveInt, StringConstraints, TypeAdapter
 from backend.models import (
     AggregatedDicomResponse,
     DicomMetadataUpdatePayload,
@@ -130,12 +161,37 @@ logger.info("Successfully imported functions from backend.MacAnonymizer")
 # --- Constants ---
 RESOURCES_DIR = os.path.join(os.path.dirname(__file__), "resources")
 os.makedirs(RESOURCES_DIR, exist_ok=True)
+# Worker processes for the CPU-bound jobs (anonymization, MAC transform, DICOM
+# extraction): at most this many run at once, the others wait in the pool's queue.
+# A DICOM extraction job parses its TCP streams in its own worker process
+# (DICOM_EXTRACT_JOB_WORKERS) rather than starting a parser pool per job, so
+# running jobs never use more than JOB_PROCESS_POOL_SIZE processes in total.
+JOB_PROCESS_POOL_SIZE = os.cpu_count() or 1
+DICOM_EXTRACT_JOB_WORKERS = 1
+# The workers are started by a fork server rather than forked from the running
+# app, whose threads (log listener, aiosqlite, anyio) may hold locks at fork time
+JOB_PROCESS_START_METHOD = "forkserver"
+
+# Session IDs are generated by storage.create_new_session_id (str(uuid4())).
+# Path and form parameters are checked against this before any database lookup.
+SESSION_ID_PATTERN = r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$"
+SessionId = Annotated[str, StringConstraints(pattern=SESSION_ID_PATTERN)]
+
+
+class PcapFileResponse(FileResponse):
+    """
+    FileResponse for capture downloads. The file is already streamed from disk
+    rather than loaded into memory, but each chunk read is a thread pool hop;
+    1 MiB chunks instead of Starlette's 64 KiB keep that overhead small for
+    large traces.
+    """
+    chunk_size = 1 << 20
 
 # --- Helper Function to Validate Session and File Existence ---
 async def validate_session_and_file(
     session_id: str,
     pcap_filename: str, # Logical filename, e.g., "capture.pcap" or "anonymized.pcap"
-    db_session: Session
+    db_session: AsyncSession
 ) -> Tuple[PcapSession, Path]:
     """
     Validates that a PcapSession exists for the given ID and that the specified
@@ -146,7 +202,7 @@ async def validate_session_and_file(
     """
     logger.debug(f"Validating session ID: {session_id}, filename: {pcap_filename}")
 
-    pcap_session_record = db_session.get(PcapSession, session_id)
+    pcap_session_record = await db_session.get(PcapSession, session_id)
     if not pcap_session_record:
         logger.error(f"PcapSession record not found for ID: {session_id}")
         raise HTTPException(
@@ -214,31 +270,60 @@ class PcapSessionUpdate(SQLModel):
 # --- Lifespan Manager ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    app.state.log_listener = start_log_listener()
     logger.info("FastAPI application starting up...")
     logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
     logger.info("SQLAlchemy engine logging level set to WARNING.")
     create_db_and_tables()
-    logger.info("Checking for stale 'running' jobs from previous runs...")
     try:
-        with Session(engine) as startup_session:
-            stale_jobs_statement = select(AsyncJob).where(AsyncJob.status == "running")
-            stale_jobs = startup_session.exec(stale_jobs_statement).all()
-            if stale_jobs:
-                logger.info(f"Found {len(stale_jobs)} stale 'running' jobs. Marking as 'failed'.")
-                for job in stale_jobs:
-                    job.status = "failed"
-                    job.error_message = "Job interrupted due to backend restart."
-                    job.updated_at = datetime.utcnow()
-                    startup_session.add(job)
+        moved_session_dirs = storage.migrate_flat_session_dirs()
+        if moved_session_dirs:
+            # Keep the stored paths pointing at the files' new location
+            with Session(engine) as startup_session:
+                for old_dir, new_dir in moved_session_dirs:
+                    startup_session.exec(
+                        update(PcapSession)
+                        .where(PcapSession.pcap_path.startswith(f"{old_dir}{os.sep}", autoescape=True))
+                        .values(
+                            pcap_path=func.replace(PcapSession.pcap_path, str(old_dir), str(new_dir)),
+                            rules_path=func.replace(PcapSession.rules_path, str(old_dir), str(new_dir)),
+                        )
+                    )
                 startup_session.commit()
-                logger.info("Stale jobs marked as 'failed'.")
+    except Exception as e:
+        logger.error(f"ERROR: Could not migrate session directories to shard directories: {e}")
+        logger.exception("Exception detail during session directory migration:")
+    logger.info("Checking for stale 'pending'/'running' jobs from previous runs...")
+    try:
+        with Session(engine) as startup_session:
+            # One bulk UPDATE, without loading the jobs. Pending jobs were queued
+            # in the job process pool of the previous run and will never start.
+            stale_jobs_statement = (
+                update(AsyncJob)
+                .where(AsyncJob.status.in_(["pending", "running"]))
+                .values(status="failed", error_message="Job interrupted due to backend restart.", updated_at=func.now())
+                .returning(AsyncJob.id)
+            )
+            stale_job_ids = startup_session.exec(stale_jobs_statement).scalars().all()
+            startup_session.commit()
+            if stale_job_ids:
+                logger.info(f"Marked {len(stale_job_ids)} stale 'pending'/'running' jobs as 'failed': {stale_job_ids}")
             else:
-                logger.info("No stale 'running' jobs found.")
+                logger.info("No stale 'pending'/'running' jobs found.")
     except Exception as e:
         logger.error(f"ERROR: Could not check/update stale jobs during startup: {e}")
         logger.exception("Exception detail during startup job check:")
+    app.state.job_process_pool = ProcessPoolExecutor(
+        max_workers=JOB_PROCESS_POOL_SIZE, mp_context=multiprocessing.get_context(JOB_PROCESS_START_METHOD),
+    )
     yield
     logger.info("FastAPI application shutting down...")
+    # Jobs still running are marked failed on the next startup
+    app.state.job_process_pool.shutdown(wait=False, cancel_futures=True)
+    await async_engine.dispose()
+    await job_state.close()
+    stop_log_listener(app.state.log_listener)
+    del app.state.log_listener
 
 # --- FastAPI Application ---
 app = FastAPI(lifespan=lifespan)
@@ -258,6 +343,7 @@ app.add_middleware(
     allow_credentials=True,      # Allow cookies to be included in requests
     allow_methods=["*"],         # Allow all methods (GET, POST, PUT, DELETE, OPTIONS, etc.)
     allow_headers=["*"],         # Allow all headers
+    expose_headers=["X-Next-Before", "X-Next-Before-Id"], # Pagination cursor of /sessions and /jobs
 )
 # --- End CORS Middleware Configuration ---
 
@@ -271,9 +357,9 @@ dicom_router = APIRouter(prefix="/protocols/dicom", tags=["dicom"])
 
 # --- DICOM Protocol Endpoints ---
 @dicom_router.post("/generate-pcap", response_class=FileResponse)
-async def generate_dicom_pcap_endpoint(
+def generate_dicom_pcap_endpoint(
     payload: DicomPcapRequestPayload,
-    db_session: Session = Depends(get_session) # Keep db_session if storage needs it, though not directly used here
+    db_session: AsyncSession = Depends(get_session) # Keep db_session if storage needs it, though not directly used here
 ):
     logger.info(f"Received request to generate DICOM PCAP with payload: {payload.model_dump_json(indent=2)}")
 
@@ -372,7 +458,7 @@ async def generate_dicom_pcap_endpoint(
         logger.info(f"PCAP file successfully written to: {pcap_file_path}")
 
         # 6. Return FileResponse
-        return FileResponse(
+        return PcapFileResponse(
             path=str(pcap_file_path),
             media_type="application/vnd.tcpdump.pcap",
             filename=output_pcap_filename, # Filename for the download
@@ -392,9 +478,9 @@ async def generate_dicom_pcap_endpoint(
         )
 
 @dicom_router.post("/v2/generate-pcap-from-scene", response_class=FileResponse)
-async def generate_pcap_from_scene_endpoint(
+def generate_pcap_from_scene_endpoint(
     scene_payload: Scene,
-    # db_session: Session = Depends(get_session) # Not creating persistent records for this type of generation
+    # db_session: AsyncSession = Depends(get_session) # Not creating persistent records for this type of generation
 ):
     logger.info(f"Received request for /v2/protocols/dicom/generate-pcap-from-scene for scene: {scene_payload.scene_id}")
     try:
@@ -423,7 +509,7 @@ async def generate_pcap_from_scene_endpoint(
         )
         logger.info(f"Temporary PCAP file for scene '{scene_payload.scene_id}' written to: {pcap_file_path}")
 
-        return FileResponse(
+        return PcapFileResponse(
             path=str(pcap_file_path),
             media_type="application/vnd.tcpdump.pcap",
             filename=output_pcap_filename,
@@ -447,18 +533,61 @@ async def generate_pcap_from_scene_endpoint(
 
 # --- General API Endpoints (moved to general_router) ---
 
+def paginate_by_time(statement, column, id_column, limit: Optional[int], before: Optional[datetime], before_id):
+    """
+    Keyset pagination for a statement ordered by (`column`, `id_column`) descending,
+    `column` being an indexed timestamp: rows before (`before`, `before_id`), at most
+    `limit` of them. The id breaks ties between rows with the same timestamp; without
+    it, rows at exactly `before` are skipped.
+    """
+    if before is not None:
+        # Timestamps are stored in UTC; a `before` without an offset is taken as UTC too
+        before = before.astimezone(timezone.utc) if before.tzinfo is not None else before.replace(tzinfo=timezone.utc)
+        if before_id is None:
+            statement = statement.where(column < before)
+        else:
+            statement = statement.where(or_(column < before, and_(column == before, id_column < before_id)))
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+def set_next_page_header(response: Response, rows, limit: Optional[int], key_of) -> None:
+    """
+    Sets X-Next-Before and X-Next-Before-Id (the `before` and `before_id` values of
+    the next page) when the page is full. `key_of` returns a row's (timestamp, id).
+    """
+    if limit is not None and len(rows) == limit:
+        timestamp, row_id = key_of(rows[-1])
+        response.headers["X-Next-Before"] = timestamp.isoformat()
+        response.headers["X-Next-Before-Id"] = str(row_id)
+
+def conditional_json_response(request: Request, response: Response, adapter: TypeAdapter, content) -> Response:
+    """
+    Serializes `content` with `adapter` and returns it with an ETag, or an empty
+    304 if the client already has that version (If-None-Match), for endpoints the
+    frontend polls. Headers already set on `response` (e.g. X-Next-Before) are kept.
+    """
+    body = adapter.dump_json(content)
+    etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    headers = {**response.headers, "ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @general_router.post("/upload", response_model=PcapSession)
 async def upload(
     name: str = Form(...),
     file: UploadFile = File(...),
     description: Optional[str] = Form(None),
-    db_session: Session = Depends(get_session),
+    db_session: AsyncSession = Depends(get_session),
 ):
     session_id = storage.create_new_session_id()
     safe_original_filename = os.path.basename(file.filename or "unknown.pcap")
     logger.info(f"Processing upload for new session: {session_id}, name: {name}")
     try:
-        pcap_path_obj = storage.store_uploaded_pcap(session_id, file, "capture.pcap")
+        # The copy to disk blocks for the whole file: run it in a worker thread, off the event loop
+        pcap_path_obj = await asyncio.to_thread(storage.store_uploaded_pcap, session_id, file, "capture.pcap")
         pcap_path = str(pcap_path_obj)
         logger.info(f"SUCCESS: File successfully saved to: {pcap_path}")
     except Exception as e:
@@ -467,19 +596,20 @@ async def upload(
 
     rules_path_obj = storage.get_session_filepath(session_id, "rules.json")
     rules_path = str(rules_path_obj)
-    upload_time = datetime.utcnow()
+    upload_time = datetime.now(timezone.utc)
     db_pcap_session = PcapSession(
         id=session_id, name=name, description=description,
         original_filename=safe_original_filename, upload_timestamp=upload_time,
         pcap_path=pcap_path, rules_path=rules_path, updated_at=upload_time,
     )
-    db_session.add(db_pcap_session)
+    # INSERT ... RETURNING: the stored row comes back with the insert, no refresh SELECT
+    insert_statement = insert(PcapSession).values(**db_pcap_session.model_dump()).returning(PcapSession)
     try:
-        db_session.commit()
-        db_session.refresh(db_pcap_session)
+        db_pcap_session = (await db_session.exec(insert_statement)).scalars().one()
+        await db_session.commit()
         logger.info(f"SUCCESS: Session metadata saved to DB for ID: {session_id}")
     except Exception as e:
-        db_session.rollback()
+        await db_session.rollback()
         try:
             if os.path.exists(pcap_path): os.remove(pcap_path)
         except OSError as rm_err:
@@ -487,33 +617,51 @@ async def upload(
         logger.error(f"Database commit failed for session {session_id}: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to save session metadata: {e}")
     try:
-        storage.store_rules(session_id, [])
+        await asyncio.to_thread(storage.store_rules, session_id, []) # File I/O, off the event loop like the capture copy
     except Exception as e:
         logger.warning(f"Warning: Failed to create initial empty rules file for {session_id}: {e}")
     return db_pcap_session
 
+_session_list_adapter = TypeAdapter(List[PcapSessionResponse])
+
 @general_router.get("/sessions", response_model=List[PcapSessionResponse])
-async def list_sessions_endpoint(db_session: Session = Depends(get_session)): # Renamed for clarity
+async def list_sessions_endpoint( # Renamed for clarity
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Page size; all sessions if omitted"),
+    before: Optional[datetime] = Query(None, description="Only sessions uploaded before this time (the previous page's X-Next-Before)"),
+    before_id: Optional[str] = Query(None, description="With `before`, also sessions uploaded at that time with a smaller id (the previous page's X-Next-Before-Id)"),
+    db_session: AsyncSession = Depends(get_session),
+):
     logger.info("Request received for GET /sessions")
     all_pcap_responses: List[PcapSessionResponse] = []
     try:
-        pcap_session_statement = select(PcapSession).order_by(PcapSession.upload_timestamp.desc())
-        db_pcap_sessions = db_session.exec(pcap_session_statement).all()
+        # The type of the job that produced each derived session comes from the same
+        # query (outer join) instead of one AsyncJob lookup per session
+        pcap_session_statement = (
+            select(PcapSession, AsyncJob.job_type)
+            .outerjoin(AsyncJob, PcapSession.async_job_id == AsyncJob.id)
+            .order_by(PcapSession.upload_timestamp.desc(), PcapSession.id.desc())
+        )
+        pcap_session_statement = paginate_by_time(
+            pcap_session_statement, PcapSession.upload_timestamp, PcapSession.id, limit, before, before_id
+        )
+        db_pcap_sessions = (await db_session.exec(pcap_session_statement)).all()
         logger.info(f"Found {len(db_pcap_sessions)} PcapSession records.")
-        for session in db_pcap_sessions:
+        set_next_page_header(response, db_pcap_sessions, limit, lambda row: (row[0].upload_timestamp, row[0].id))
+        for session, job_type in db_pcap_sessions:
             file_type_for_response = "original"
             derived_from_session_id_for_response = None
             source_job_id_for_response = None
             if session.async_job_id:
                 source_job_id_for_response = session.async_job_id
                 derived_from_session_id_for_response = session.original_session_id
-                job = db_session.get(AsyncJob, session.async_job_id)
-                if job:
-                    if job.job_type == "transform": file_type_for_response = "ip_mac_anonymized"
-                    elif job.job_type == "mac_transform": file_type_for_response = "mac_transformed"
-                    elif job.job_type == "dicom_anonymize_v2": file_type_for_response = "dicom_v2_anonymized"
+                if job_type:
+                    if job_type == "transform": file_type_for_response = "ip_mac_anonymized"
+                    elif job_type == "mac_transform": file_type_for_response = "mac_transformed"
+                    elif job_type == "dicom_anonymize_v2": file_type_for_response = "dicom_v2_anonymized"
                     else:
-                        logger.warning(f"Unmapped job_type '{job.job_type}' for PcapSession {session.id}. Defaulting to 'derived'.")
+                        logger.warning(f"Unmapped job_type '{job_type}' for PcapSession {session.id}. Defaulting to 'derived'.")
                         file_type_for_response = "derived"
                 else:
                     logger.warning(f"PcapSession {session.id} has async_job_id {session.async_job_id} but job not found. Defaulting to 'derived_job_info_missing'.")
@@ -540,9 +688,8 @@ async def list_sessions_endpoint(db_session: Session = Depends(get_session)): #
                 actual_pcap_filename=actual_pcap_filename,
             )
             all_pcap_responses.append(response_item)
-        all_pcap_responses.sort(key=lambda x: x.upload_timestamp, reverse=True)
         logger.info(f"Returning {len(all_pcap_responses)} file entries.")
-        return all_pcap_responses
+        return conditional_json_response(request, response, _session_list_adapter, all_pcap_responses)
     except Exception as e:
         logger.error(f"Error fetching sessions: {e}")
         logger.exception("Exception detail during /sessions fetch:")
@@ -550,10 +697,10 @@ async def list_sessions_endpoint(db_session: Session = Depends(get_session)): #
 
 @general_router.put("/sessions/{session_id}", response_model=PcapSession)
 async def update_session(
-    session_id: str, session_update: PcapSessionUpdate, db_session: Session = Depends(get_session)
+    session_id: SessionId, session_update: PcapSessionUpdate, db_session: AsyncSession = Depends(get_session)
 ):
     logger.info(f"Request received for PUT /sessions/{session_id}")
-    db_pcap_session = db_session.get(PcapSession, session_id)
+    db_pcap_session = await db_session.get(PcapSession, session_id)
     if not db_pcap_session:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
     update_data = session_update.model_dump(exclude_unset=True)
@@ -566,22 +713,22 @@ async def update_session(
             setattr(db_pcap_session, key, value)
             needs_update = True
     if needs_update:
-        db_pcap_session.updated_at = datetime.utcnow()
+        db_pcap_session.updated_at = datetime.now(timezone.utc)
         db_session.add(db_pcap_session)
         try:
-            db_session.commit()
-            db_session.refresh(db_pcap_session)
+            await db_session.commit()
+            await db_session.refresh(db_pcap_session)
             logger.info(f"Session {session_id} updated successfully.")
         except Exception as e:
-            db_session.rollback()
+            await db_session.rollback()
             logger.error(f"Database commit failed for session {session_id}: {e}")
             raise HTTPException(status_code=500, detail=f"Failed to update session metadata: {e}")
     return db_pcap_session
 
 @general_router.delete("/sessions/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_session(session_id: str, db_session: Session = Depends(get_session)):
+async def delete_session(session_id: SessionId, db_session: AsyncSession = Depends(get_session)):
     logger.info(f"Request received for DELETE /sessions/{session_id}")
-    pcap_session = db_session.get(PcapSession, session_id)
+    pcap_session = await db_session.get(PcapSession, session_id)
     if not pcap_session:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
     try:
@@ -594,10 +741,11 @@ async def delete_session(session_id: str, db_session: Session = Depends(get_sess
         # Only delete directory if pcap_session.original_session_id is None (it's an original trace)
         if pcap_session.original_session_id is None:
             session_dir_path = storage.get_session_dir(session_id)
-            if session_dir_path.exists() and session_dir_path.is_dir():
-                shutil.rmtree(session_dir_path)
+            try:
+                # Unlinking a whole capture directory can take a while; keep it off the event loop
+                await asyncio.to_thread(shutil.rmtree, session_dir_path)
                 logger.info(f"Deleted session directory: {str(session_dir_path)} for original trace {session_id}")
-            else:
+            except (FileNotFoundError, NotADirectoryError):
                 logger.warning(f"Session directory not found or not a directory for original trace {session_id}: {str(session_dir_path)}")
         else:
             logger.info(f"Session {session_id} is a derived trace. Its database record will be deleted, but no physical directory will be removed as its files reside in {pcap_session.original_session_id}'s directory.")
@@ -608,30 +756,127 @@ async def delete_session(session_id: str, db_session: Session = Depends(get_sess
 
     # Delete related AsyncJob if it produced this session
     if pcap_session.async_job_id:
-        job_to_delete = db_session.get(AsyncJob, pcap_session.async_job_id)
+        job_to_delete = await db_session.get(AsyncJob, pcap_session.async_job_id)
         if job_to_delete and job_to_delete.output_trace_id == session_id:
             # Potentially delete the job too, or just nullify its output_trace_id
             # For now, let's just log. Deleting jobs might be a separate concern.
             logger.info(f"Session {session_id} was an output of job {pcap_session.async_job_id}. Consider job cleanup if necessary.")
 
-    db_session.delete(pcap_session)
+    await db_session.exec(delete(DicomMetadataOverride).where(DicomMetadataOverride.session_id == session_id))
+    await db_session.delete(pcap_session)
     try:
-        db_session.commit()
+        await db_session.commit()
         logger.info(f"PcapSession record {session_id} deleted successfully from database.")
         return Response(status_code=status.HTTP_204_NO_CONTENT)
     except Exception as e:
-        db_session.rollback()
+        await db_session.rollback()
         logger.error(f"Database commit failed for deleting PcapSession record {session_id}: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to delete session from database: {e}")
 
 # --- Background Task Definitions ---
+# CPU-bound jobs are plain def functions submitted to the job process pool
+# (submit_job). The remaining BackgroundTasks run in the threadpool if plain def,
+# or on the event loop itself if async def, so those doing blocking work must be def.
+
+def _log_job_failure(future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Job process pool task failed", exc_info=future.exception())
 
-async def run_apply_anonymization(
+def submit_job(task: Callable[..., None], **task_kwargs) -> None:
+    """
+    Queues a job function (module-level, so it can be pickled) on the job process
+    pool. The job updates its AsyncJob row itself; the caller doesn't wait for it.
+    """
+    future = app.state.job_process_pool.submit(functools.partial(task, **task_kwargs))
+    future.add_done_callback(_log_job_failure)
+
+@contextmanager
+def job_db_session() -> Iterator[Session]:
+    """
+    Session for a background job, bound to one connection for the whole run:
+    its commits don't hand the connection back to the pool, so the per-tick
+    ones don't check it out again. expire_on_commit=False: a job only writes
+    its row after loading it (stop requests are read with their own query),
+    so its final update doesn't reload the row before the UPDATE.
+    """
+    with engine.connect() as connection, Session(bind=connection, expire_on_commit=False) as db_session:
+        yield db_session
+
+# Minimum time between two progress commits of a running job, and how long a
+# stop-request check result is reused before the job row is read again
+JOB_PROGRESS_COMMIT_INTERVAL = 1.0
+JOB_STOP_CHECK_INTERVAL = 0.5
+
+# Core statements for the per-tick job updates: executed on the task session's
+# connection, without ORM flushes or refreshes (compiled once, then cached)
+_UPDATE_JOB_PROGRESS = (
+    update(AsyncJob)
+    .where(AsyncJob.id == bindparam("job_id"), AsyncJob.status == "running")
+    .values(progress=bindparam("new_progress"), updated_at=bindparam("now"))
+)
+_SELECT_JOB_STOP = select(AsyncJob.stop_requested, AsyncJob.status).where(AsyncJob.id == bindparam("job_id"))
+
+def make_job_callbacks(db_session: Session, job: AsyncJob) -> Tuple[Callable[[int], None], Callable[[], bool]]:
+    """
+    Returns (progress_callback, check_stop_requested) for a background job.
+    With job_state enabled (Redis), progress and stop requests go through it and
+    the database only gets the job's final state; stop requests arrive by
+    pub/sub, so check_stop_requested is an in-memory read, and the job must call
+    job_state.clear when done. Otherwise both run Core statements on the task's
+    own session (see job_db_session) instead of opening one per call: progress
+    is committed at most every JOB_PROGRESS_COMMIT_INTERVAL seconds (100%
+    always), and the stop flags are re-read at most every
+    JOB_STOP_CHECK_INTERVAL seconds.
+    Must be called from the thread that owns db_session.
+    """
+    job_id = job.id # Read once: committing expires the job's attributes
+    live = job_state.enabled()
+    stop_event = job_state.watch_stop(job_id) if live else None
+    job_state.notify(job_id) # The job was just committed as running
+    last_progress = -1
+    last_commit_time = 0.0
+    last_check_time = 0.0
+    stop_requested = False
+
+    def progress_callback(progress_percentage: int):
+        nonlocal last_progress, last_commit_time
+        if live and progress_percentage > last_progress:
+            job_state.set_progress(job_id, progress_percentage)
+            last_progress = progress_percentage
+            return
+        now = time.monotonic()
+        if progress_percentage <= last_progress or (progress_percentage < 100 and now - last_commit_time < JOB_PROGRESS_COMMIT_INTERVAL):
+            return
+        db_session.connection().execute(
+            _UPDATE_JOB_PROGRESS,
+            {"job_id": job_id, "new_progress": progress_percentage, "now": datetime.now(timezone.utc)},
+        )
+        db_session.commit()
+        last_progress, last_commit_time = progress_percentage, now
+        logger.debug(f"Job {job_id} progress: {progress_percentage}%")
+
+    def check_stop_requested() -> bool:
+        nonlocal last_check_time, stop_requested
+        if stop_event is not None:
+            return stop_event.is_set()
+        now = time.monotonic()
+        if not stop_requested and now - last_check_time >= JOB_STOP_CHECK_INTERVAL:
+            # The cancel endpoint writes these from another session
+            job_stop_requested, job_status = db_session.connection().execute(_SELECT_JOB_STOP, {"job_id": job_id}).one()
+            stop_requested = job_stop_requested or job_status == "cancelling"
+            last_check_time = now
+            if stop_requested:
+                logger.info(f"Stop request detected for job {job_id} by check_stop_requested.")
+        return stop_requested
+
+    return progress_callback, check_stop_requested
+
+def run_apply_anonymization(
     job_id: int,
     input_session_id: str, # Renamed for clarity - this is the ID of the trace to read from
     input_pcap_filename: str, # Filename within that directory
 ):
-    with Session(engine) as db_session:
+    with job_db_session() as db_session:
         job = db_session.get(AsyncJob, job_id)
         if not job:
             logger.error(f"Job {job_id} not found for IP/MAC anonymization task.")
@@ -640,7 +885,7 @@ async def run_apply_anonymization(
         if job.status == "cancelling" or job.stop_requested:
             job.status = "cancelled"
             job.error_message = "Cancelled before start."
-            job.updated_at = datetime.utcnow()
+            job.updated_at = datetime.now(timezone.utc)
             db_session.add(job)
             db_session.commit()
             logger.info(f"Job {job_id} (IP/MAC Anonymization) cancelled before start.")
@@ -648,29 +893,13 @@ async def run_apply_anonymization(
 
         job.status = "running"
         job.progress = 0 # Initialize progress
-        job.updated_at = datetime.utcnow()
+        job.updated_at = datetime.now(timezone.utc)
         db_session.add(job)
         db_session.commit()
         logger.info(f"Job {job_id} (IP/MAC Anonymization) for input session {input_session_id}, file '{input_pcap_filename}' started.")
 
-        # Define callbacks for anonymizer
-        def progress_callback(progress_percentage: int):
-            with Session(engine) as cb_session: # Use a new session for thread safety if anonymizer runs in a separate thread
-                cb_job = cb_session.get(AsyncJob, job_id)
-                if cb_job:
-                    cb_job.progress = progress_percentage
-                    cb_job.updated_at = datetime.utcnow()
-                    cb_session.add(cb_job)
-                    cb_session.commit()
-                    logger.debug(f"Job {job_id} progress: {progress_percentage}%")
-
-        def check_stop_requested() -> bool:
-            with Session(engine) as cb_session:
-                cb_job = cb_session.get(AsyncJob, job_id)
-                if cb_job and (cb_job.stop_requested or cb_job.status == "cancelling"):
-                    logger.info(f"Stop request detected for job {job_id} by check_stop_requested.")
-                    return True
-                return False
+        # Define callbacks for anonymizer (it runs synchronously, in this task's thread)
+        progress_callback, check_stop_requested = make_job_callbacks(db_session, job)
 
         new_output_trace_id = storage.create_new_session_id()
         output_pcap_filename = f"anonymized_ip_mac_{new_output_trace_id[:8]}.pcap" # Example filename
@@ -691,15 +920,16 @@ async def run_apply_anonymization(
             original_session_record = db_session.get(PcapSession, input_session_id) # Get original to copy name etc.
             original_session_name = original_session_record.name if original_session_record else "Unknown Original"
 
+            now = datetime.now(timezone.utc)
             new_pcap_session = PcapSession(
                 id=new_output_trace_id, # Use the ID from anonymization_result which should match new_output_trace_id
                 name=f"IP/MAC Anonymized - {original_session_name}",
                 description=f"Derived from '{original_session_name}' (ID: {input_session_id}) by IP/MAC anonymization job {job_id}.",
                 original_filename=output_pcap_filename, # The name of the file within its session dir
-                upload_timestamp=datetime.utcnow(),
+                upload_timestamp=now,
                 pcap_path=str(anonymization_result["full_output_path"]), # Full path to the new pcap
                 rules_path=str(storage.get_session_filepath(new_output_trace_id, "rules.json")), # Path for potential rules copy
-                updated_at=datetime.utcnow(),
+                updated_at=now,
                 is_transformed=True,
                 original_session_id=input_session_id, # Link to the original session
                 async_job_id=job_id
@@ -738,22 +968,23 @@ async def run_apply_anonymization(
             logger.error(f"Job {job_id} (IP/MAC Anonymization) failed for input {input_session_id}: {e}", exc_info=True)
             # traceback.print_exc() # For more detailed console logging during debug
         finally:
-            job.updated_at = datetime.utcnow()
+            job.updated_at = datetime.now(timezone.utc)
             db_session.add(job)
             db_session.commit()
+            job_state.clear(job_id)
 
-async def run_mac_transform(
+def run_mac_transform(
     job_id: int,
     input_session_id: str, # Renamed for clarity
     input_pcap_filename: str, # Renamed for clarity
 ):
-    with Session(engine) as db_session:
+    with job_db_session() as db_session:
         job = db_session.get(AsyncJob, job_id)
         if not job: logger.error(f"Job {job_id} not found."); return
         if job.status == "cancelling":
-            job.status = "cancelled"; job.error_message = "Cancelled before start."; job.updated_at = datetime.utcnow()
+            job.status = "cancelled"; job.error_message = "Cancelled before start."; job.updated_at = datetime.now(timezone.utc)
             db_session.add(job); db_session.commit(); logger.info(f"Job {job_id} cancelled before start."); return
-        job.status = "running"; job.updated_at = datetime.utcnow(); db_session.add(job); db_session.commit()
+        job.status = "running"; job.updated_at = datetime.now(timezone.utc); db_session.add(job); db_session.commit()
         logger.info(f"Job {job_id} (MAC Transform) for input session {input_session_id}, file {input_pcap_filename} started.")
         try:
             # apply_mac_transformation needs to be updated to accept input_trace_id, new_output_trace_id etc.
@@ -783,15 +1014,16 @@ async def run_mac_transform(
             original_session_record = db_session.get(PcapSession, input_session_id)
             original_session_name = original_session_record.name if original_session_record else "Unknown Original"
 
+            now = datetime.now(timezone.utc)
             new_pcap_session = PcapSession(
                 id=new_output_trace_id,
                 name=f"MAC Transformed - {original_session_name}",
                 description=f"Derived from '{original_session_name}' (ID: {input_session_id}) by MAC transformation job {job_id}.",
                 original_filename=output_pcap_filename,
-                upload_timestamp=datetime.utcnow(),
+                upload_timestamp=now,
                 pcap_path=str(mac_transform_result["full_output_path"]),
                 rules_path=str(storage.get_session_filepath(new_output_trace_id, "mac_rules.json")), # Path for potential rules copy
-                updated_at=datetime.utcnow(),
+                updated_at=now,
                 is_transformed=True,
                 original_session_id=input_session_id,
                 async_job_id=job_id
@@ -809,32 +1041,30 @@ async def run_mac_transform(
             job.status = "failed"; job.error_message = f"Error during MAC transformation: {str(e)}"
             logger.error(f"Job {job_id} MAC transform failed for input {input_session_id}: {e}", exc_info=True)
         finally:
-            job.updated_at = datetime.utcnow(); db_session.add(job); db_session.commit()
+            job.updated_at = datetime.now(timezone.utc); db_session.add(job); db_session.commit()
+            job_state.clear(job_id)
 
-async def run_dicom_extract(
+def run_dicom_extract(
     job_id: int,
     input_session_id: str, # Renamed for clarity
     input_pcap_filename: str, # Renamed for clarity
 ):
-    with Session(engine) as db_session:
+    with job_db_session() as db_session:
         job = db_session.get(AsyncJob, job_id)
         if not job: logger.error(f"Job {job_id} not found."); return
         if job.status == "cancelling":
-            job.status = "cancelled"; job.error_message = "Cancelled before start."; job.updated_at = datetime.utcnow()
+            job.status = "cancelled"; job.error_message = "Cancelled before start."; job.updated_at = datetime.now(timezone.utc)
             db_session.add(job); db_session.commit(); logger.info(f"Job {job_id} cancelled before start."); return
-        job.status = "running"; job.updated_at = datetime.utcnow(); db_session.add(job); db_session.commit()
+        job.status = "running"; job.updated_at = datetime.now(timezone.utc); db_session.add(job); db_session.commit()
         logger.info(f"Job {job_id} (DICOM Extract) for input session {input_session_id}, file {input_pcap_filename} started.")
+        progress_callback, check_stop_requested = make_job_callbacks(db_session, job)
         try:
-            # extract_dicom_metadata_from_pcap needs the input session ID and filename
-            # It should use storage.read_pcap_from_session(input_session_id, input_pcap_filename) internally
-            # Assuming extract_dicom_metadata_from_pcap is adapted or called correctly.
-            # TODO: Verify/Adapt extract_dicom_metadata_from_pcap if needed.
-            # It should return the result data to be stored in the job.
-            extracted_data = await extract_dicom_metadata_from_pcap(
-                session_id=input_session_id, # Pass the correct input session ID
-                pcap_file_name=input_pcap_filename,
-                job_id=job_id, # For cancellation check
-                db_session=db_session # For job progress updates
+            # The extractor reads the session's capture file itself
+            extracted_data = extract_dicom_metadata_from_pcap(
+                session_id=input_session_id,
+                progress_callback=progress_callback,
+                check_stop_requested=check_stop_requested,
+                max_workers=DICOM_EXTRACT_JOB_WORKERS,
             )
             job.result_data = extracted_data # Store the result directly in the job
             job.status = "completed"; job.progress = 100
@@ -847,7 +1077,8 @@ async def run_dicom_extract(
             job.status = "failed"; job.error_message = f"Error during DICOM extraction: {str(e)}"
             logger.error(f"Job {job_id} DICOM extraction failed for input {input_session_id}: {e}", exc_info=True)
         finally:
-            job.updated_at = datetime.utcnow(); db_session.add(job); db_session.commit()
+            job.updated_at = datetime.now(timezone.utc); db_session.add(job); db_session.commit()
+            job_state.clear(job_id)
 
 async def run_dicom_anonymize_v2(
     job_id: int,
@@ -859,9 +1090,9 @@ async def run_dicom_anonymize_v2(
         job = db_session.get(AsyncJob, job_id)
         if not job: logger.error(f"Job {job_id} not found."); return
         if job.status == "cancelling":
-            job.status = "cancelled"; job.error_message = "Cancelled before start."; job.updated_at = datetime.utcnow()
+            job.status = "cancelled"; job.error_message = "Cancelled before start."; job.updated_at = datetime.now(timezone.utc)
             db_session.add(job); db_session.commit(); logger.info(f"Job {job_id} cancelled before start."); return
-        job.status = "running"; job.updated_at = datetime.utcnow(); db_session.add(job); db_session.commit()
+        job.status = "running"; job.updated_at = datetime.now(timezone.utc); db_session.add(job); db_session.commit()
         logger.info(f"Job {job_id} (DICOM Anonymize V2) for input session {input_session_id}, file {input_pcap_filename} started.")
 
         metadata_overrides: Optional[Dict[str, DicomMetadataUpdatePayload]] = None
@@ -871,7 +1102,7 @@ async def run_dicom_anonymize_v2(
                 metadata_overrides = {k: DicomMetadataUpdatePayload(**v) for k, v in overrides_raw.items()}
             except json.JSONDecodeError:
                 job.status = "failed"; job.error_message = "Invalid JSON in metadata_overrides."
-                job.updated_at = datetime.utcnow(); db_session.add(job); db_session.commit()
+                job.updated_at = datetime.now(timezone.utc); db_session.add(job); db_session.commit()
                 logger.error(f"Job {job_id} failed due to invalid metadata_overrides JSON.")
                 return
         try:
@@ -905,15 +1136,16 @@ async def run_dicom_anonymize_v2(
             original_session_name = original_session_record.name if original_session_record else "Unknown Original"
             output_full_path = storage.get_session_filepath(new_output_trace_id, output_pcap_filename) # Get the full path
 
+            now = datetime.now(timezone.utc)
             new_pcap_session = PcapSession(
                 id=new_output_trace_id,
                 name=f"DICOM Anonymized V2 - {original_session_name}",
                 description=f"Derived from '{original_session_name}' (ID: {input_session_id}) by DICOM Anonymization V2 job {job_id}.",
                 original_filename=output_pcap_filename,
-                upload_timestamp=datetime.utcnow(),
+                upload_timestamp=now,
                 pcap_path=str(output_full_path),
                 rules_path=None, # DICOM V2 doesn't use separate rules files in the same way
-                updated_at=datetime.utcnow(),
+                updated_at=now,
                 is_transformed=True,
                 original_session_id=input_session_id,
                 async_job_id=job_id
@@ -932,14 +1164,14 @@ async def run_dicom_anonymize_v2(
             job.status = "failed"; job.error_message = f"Error during DICOM Anonymization V2: {str(e)}"
             logger.error(f"Job {job_id} DICOM Anonymization V2 failed for input {input_session_id}: {e}", exc_info=True)
         finally:
-            job.updated_at = datetime.utcnow(); db_session.add(job); db_session.commit()
+            job.updated_at = datetime.now(timezone.utc); db_session.add(job); db_session.commit()
 
 
 # --- IP/MAC Anonymization Endpoints (moved to general_router) ---
-@general_router.get("/subnets/{session_id_from_frontend}")
+@general_router.get("/subnets/{session_id_from_frontend}", response_model=List[Dict[str, Any]])
 async def get_subnets_endpoint(
-    session_id_from_frontend: str,
-    db_session: Session = Depends(get_session),
+    session_id_from_frontend: SessionId,
+    db_session: AsyncSession = Depends(get_session),
     pcap_filename: Optional[str] = Query("capture.pcap", description="Logical filename of the PCAP to analyze")
 ):
     logger.info(f"Subnet request for session_id: {session_id_from_frontend}, logical_file: {pcap_filename}")
@@ -957,7 +1189,7 @@ async def get_subnets_endpoint(
     logger.info(f"Extracting subnets for session {pcap_session_record.name} ({session_id_from_frontend}), file {pcap_filename}.")
     try:
         # Call get_subnets directly with the validated session_id
-        subnets = get_subnets(session_id_from_frontend, pcap_filename)
+        subnets = await asyncio.to_thread(get_subnets, session_id_from_frontend, pcap_filename) # Reads the whole capture
         return subnets
     except FileNotFoundError: # Should be caught by validate_session_and_file, but keep as fallback
         raise HTTPException(status_code=404, detail=f"PCAP file '{pcap_filename}' not found for session '{pcap_session_record.name}'.")
@@ -966,12 +1198,12 @@ async def get_subnets_endpoint(
         raise HTTPException(status_code=500, detail=f"Failed to extract subnets: {e}")
 
 @general_router.put("/rules")
-async def rules_endpoint(input: RuleInput, db_session: Session = Depends(get_session)):
+async def rules_endpoint(input: RuleInput, db_session: AsyncSession = Depends(get_session)):
     session_id = input.session_id # Use the ID directly
     logger.info(f"Request received for PUT /rules for session_id: {session_id}")
 
     # Validate the session exists
-    pcap_session_record = db_session.get(PcapSession, session_id)
+    pcap_session_record = await db_session.get(PcapSession, session_id)
     if not pcap_session_record:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Session (trace) with ID '{session_id}' not found, cannot save rules.")
 
@@ -980,23 +1212,23 @@ async def rules_endpoint(input: RuleInput, db_session: Session = Depends(get_ses
     try:
         rules_as_dict_list = [rule.model_dump(by_alias=False) for rule in input.rules]
         # Call save_rules directly with the session_id
-        result = save_rules(session_id, rules_as_dict_list) # save_rules uses storage.store_rules
+        result = await asyncio.to_thread(save_rules, session_id, rules_as_dict_list) # save_rules uses storage.store_rules (fsync)
         # Update timestamp of the session
-        pcap_session_record.updated_at = datetime.utcnow()
+        pcap_session_record.updated_at = datetime.now(timezone.utc)
         db_session.add(pcap_session_record)
-        db_session.commit()
+        await db_session.commit()
         logger.info(f"Updated 'updated_at' for PcapSession {session_id} after saving rules.")
         return result
     except Exception as e:
-        db_session.rollback()
+        await db_session.rollback()
         logger.error(f"Error saving rules for session {session_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Failed to save subnet rules: {e}")
 
-@general_router.get("/preview/{session_id_from_frontend}")
+@general_router.get("/preview/{session_id_from_frontend}", response_model=List[Dict[str, Dict[str, Any]]])
 async def preview_endpoint(
-    session_id_from_frontend: str,
+    session_id_from_frontend: SessionId,
     pcap_filename: Optional[str] = Query("capture.pcap", description="Logical filename of PCAP to preview"),
-    db_session: Session = Depends(get_session),
+    db_session: AsyncSession = Depends(get_session),
 ):
     logger.info(f"Preview request for session_id: {session_id_from_frontend}, logical_file: {pcap_filename}")
     try:
@@ -1013,8 +1245,8 @@ async def preview_endpoint(
     logger.info(f"Generating preview for {pcap_session_record.name} ({session_id_from_frontend}), file {validated_pcap_path}.")
     try:
         # Call generate_preview directly with the validated session_id and filename
-        preview_data = generate_preview(session_id_from_frontend, pcap_filename)
-        return preview_data
+        preview_data = await asyncio.to_thread(generate_preview, session_id_from_frontend, pcap_filename) # Reads the capture
+        return preview_to_rows(preview_data)
     except FileNotFoundError: # Should be caught by validate_session_and_file
         raise HTTPException(status_code=404, detail=f"PCAP file '{pcap_filename}' not found for session '{pcap_session_record.name}'.")
     except Exception as e:
@@ -1023,10 +1255,9 @@ async def preview_endpoint(
 
 @general_router.post("/apply", response_model=AsyncJob)
 async def apply_endpoint(
-    background_tasks: BackgroundTasks, 
-    session_id_from_frontend: str = Form(..., alias="session_id"),
+    session_id_from_frontend: str = Form(..., alias="session_id", pattern=SESSION_ID_PATTERN),
     input_pcap_filename: str = Form(...),
-    db_session: Session = Depends(get_session)
+    db_session: AsyncSession = Depends(get_session)
 ):
     logger.info(f"Apply IP/MAC anonymization request for session_id: {session_id_from_frontend}, input_pcap_filename: {input_pcap_filename}")
     try:
@@ -1045,22 +1276,23 @@ async def apply_endpoint(
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Anonymization rules not found for session '{pcap_session_record.name}'. Please define rules first.")
 
     # Create the job, associating it with the input session ID
+    now = datetime.now(timezone.utc)
     new_job = AsyncJob(
         session_id=session_id_from_frontend, # Job is associated with the input trace
         trace_name=pcap_session_record.name, # User-facing name of the input trace
-        job_type="transform", status="pending", created_at=datetime.utcnow(), updated_at=datetime.utcnow(),
+        job_type="transform", status="pending", created_at=now, updated_at=now,
     )
     db_session.add(new_job)
     try:
-        db_session.commit(); db_session.refresh(new_job)
+        await db_session.commit(); await db_session.refresh(new_job)
         logger.info(f"Created AsyncJob {new_job.id} for IP/MAC anonymization of {pcap_session_record.name} ({session_id_from_frontend})/{input_pcap_filename}.")
     except Exception as e:
-        db_session.rollback()
+        await db_session.rollback()
         logger.error(f"DB error creating AsyncJob for IP/MAC anonymization: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Failed to create anonymization job.")
 
     # Pass the input session ID directly to the background task
-    background_tasks.add_task(
+    submit_job(
         run_apply_anonymization,
         job_id=new_job.id,
         input_session_id=session_id_from_frontend, # Pass the input session ID
@@ -1070,8 +1302,8 @@ async def apply_endpoint(
 
 # --- MAC Anonymization Endpoints (moved to general_router) ---
 
-@general_router.get("/mac/vendors")
-async def get_mac_vendors_endpoint():
+@general_router.get("/mac/vendors", response_model=List[str])
+def get_mac_vendors_endpoint():
     """
     Retrieves the MAC address vendor lookup data from the OUI CSV file.
     """
@@ -1114,7 +1346,7 @@ async def get_mac_vendors_endpoint():
         )
 
 @general_router.get("/mac/vendors/{vendor_name}/oui", response_model=Dict[str, Optional[str]])
-async def get_oui_for_vendor_endpoint(vendor_name: str):
+def get_oui_for_vendor_endpoint(vendor_name: str):
     """
     Retrieves the OUI for a specific vendor name.
     Performs a case-insensitive search.
@@ -1156,7 +1388,7 @@ async def get_oui_for_vendor_endpoint(vendor_name: str):
         )
 
 @general_router.get("/mac/settings", response_model=MacSettings)
-async def get_mac_settings_endpoint(db_session: Session = Depends(get_session)):
+def get_mac_settings_endpoint():
     # MAC settings are currently global, not per-session.
     # This endpoint might need re-evaluation if settings become session-specific.
     settings = load_mac_settings() # From MacAnonymizer.py (global settings file)
@@ -1167,7 +1399,7 @@ async def get_mac_settings_endpoint(db_session: Session = Depends(get_session)):
     return settings
 
 @general_router.put("/mac/settings", response_model=MacSettings)
-async def update_mac_settings_endpoint(update: MacSettingsUpdate, db_session: Session = Depends(get_session)):
+def update_mac_settings_endpoint(update: MacSettingsUpdate):
     # Global settings update
     try:
         updated_settings = save_mac_settings_global({"csv_url": update.csv_url}) # save_mac_settings_global from MacAnonymizer
@@ -1179,7 +1411,7 @@ async def update_mac_settings_endpoint(update: MacSettingsUpdate, db_session: Se
 @general_router.post("/mac/update_oui_csv", response_model=AsyncJob)
 async def update_oui_csv_endpoint(
     background_tasks: BackgroundTasks,
-    db_session: Session = Depends(get_session)
+    db_session: AsyncSession = Depends(get_session)
 ):
     # This job is global, not tied to a specific session_id for its operation,
     # but we need a placeholder or a way to represent global jobs if AsyncJob.session_id is mandatory.
@@ -1191,12 +1423,13 @@ async def update_oui_csv_endpoint(
     # A better approach might be to allow nullable session_id for certain job_types.
     global_mac_job_session_id = "global_mac_oui_update_job" # Conceptual ID
 
+    now = datetime.now(timezone.utc)
     new_job = AsyncJob(
         session_id=global_mac_job_session_id, # Placeholder
         trace_name="OUI CSV Update",
-        job_type="mac_oui_update", status="pending", created_at=datetime.utcnow(), updated_at=datetime.utcnow()
+        job_type="mac_oui_update", status="pending", created_at=now, updated_at=now
     )
-    db_session.add(new_job); db_session.commit(); db_session.refresh(new_job)
+    db_session.add(new_job); await db_session.commit(); await db_session.refresh(new_job)
     logger.info(f"Created AsyncJob {new_job.id} for OUI CSV update.")
     
     async def run_update_oui_task(job_id: int): # Inner task for global operation
@@ -1211,7 +1444,7 @@ async def update_oui_csv_endpoint(
                 job.status = "failed"; job.error_message = str(e)
                 logger.error(f"OUI CSV update job {job.id} failed: {e}", exc_info=True)
             finally:
-                job.updated_at = datetime.utcnow(); task_db_session.add(job); task_db_session.commit()
+                job.updated_at = datetime.now(timezone.utc); task_db_session.add(job); task_db_session.commit()
 
     background_tasks.add_task(run_update_oui_task, job_id=new_job.id)
     return new_job
@@ -1219,8 +1452,8 @@ async def update_oui_csv_endpoint(
 # Updated response_model to List[IpMacPair] (using the direct import)
 @general_router.get("/mac/ip-mac-pairs/{session_id_from_frontend}", response_model=List[IpMacPair])
 async def get_ip_mac_pairs_endpoint(
-    session_id_from_frontend: str,
-    db_session: Session = Depends(get_session), # Restored
+    session_id_from_frontend: SessionId,
+    db_session: AsyncSession = Depends(get_session), # Restored
     pcap_filename: str = Query("capture.pcap", description="Logical filename of PCAP to analyze") # Restored
 ):
     logger.info(f"IP-MAC pairs request for session_id: {session_id_from_frontend}, file: {pcap_filename}") # Removed test route mention
@@ -1241,7 +1474,7 @@ async def get_ip_mac_pairs_endpoint(
         oui_map: Dict[str, str] = {}
         if os.path.exists(OUI_CSV_PATH):
             try:
-                oui_map = parse_oui_csv(OUI_CSV_PATH) # Function from MacAnonymizer
+                oui_map = await asyncio.to_thread(parse_oui_csv, OUI_CSV_PATH) # Function from MacAnonymizer
                 if not oui_map:
                     logger.warning(f"OUI map parsed from {OUI_CSV_PATH} is empty for IP-MAC pair extraction.")
                 else:
@@ -1253,7 +1486,7 @@ async def get_ip_mac_pairs_endpoint(
 
         # Call extract_ip_mac_pairs (synchronous) with the loaded oui_map
         logger.info(f"Calling extract_ip_mac_pairs for session {session_id_from_frontend}, file {pcap_filename}...")
-        pairs = extract_ip_mac_pairs(session_id_from_frontend, pcap_filename, oui_map) # From MacAnonymizer
+        pairs = await asyncio.to_thread(extract_ip_mac_pairs, session_id_from_frontend, pcap_filename, oui_map) # From MacAnonymizer
         logger.info(f"extract_ip_mac_pairs completed for session {session_id_from_frontend}. Found {len(pairs)} pairs.")
         # Return the list directly
         return pairs
@@ -1268,8 +1501,8 @@ async def get_ip_mac_pairs_endpoint(
 
 @general_router.get("/mac/rules/{session_id_from_frontend}", response_model=List[MacRule])
 async def get_mac_rules_endpoint(
-    session_id_from_frontend: str,
-    db_session: Session = Depends(get_session)
+    session_id_from_frontend: SessionId,
+    db_session: AsyncSession = Depends(get_session)
 ):
     """
     Retrieves the saved MAC anonymization rules for a specific session.
@@ -1277,7 +1510,7 @@ async def get_mac_rules_endpoint(
     logger.info(f"Request received for GET /mac/rules/{session_id_from_frontend}")
 
     # Validate the session exists (don't strictly need the record, but good practice)
-    pcap_session_record = db_session.get(PcapSession, session_id_from_frontend)
+    pcap_session_record = await db_session.get(PcapSession, session_id_from_frontend)
     if not pcap_session_record:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Session (trace) with ID '{session_id_from_frontend}' not found.")
 
@@ -1310,12 +1543,12 @@ async def get_mac_rules_endpoint(
 
 
 @general_router.put("/mac/rules") # Assuming MacRuleInput contains session_id
-async def mac_rules_endpoint(input: MacRuleInput, db_session: Session = Depends(get_session)):
+async def mac_rules_endpoint(input: MacRuleInput, db_session: AsyncSession = Depends(get_session)):
     session_id = input.session_id # Use the ID directly
     logger.info(f"Request to save MAC rules for session_id: {session_id}")
 
     # Validate the session exists
-    pcap_session_record = db_session.get(PcapSession, session_id)
+    pcap_session_record = await db_session.get(PcapSession, session_id)
     if not pcap_session_record:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Session (trace) with ID '{session_id}' not found.")
 
@@ -1326,23 +1559,22 @@ async def mac_rules_endpoint(input: MacRuleInput, db_session: Session = Depends(
         # Frontend is now responsible for providing target_oui.
         # Pydantic validation will ensure target_oui is present as it's mandatory in MacRule model.
         rules_data = [r.model_dump() for r in input.rules]
-        storage.store_json(session_id, mac_rules_filename, rules_data)
+        await asyncio.to_thread(storage.store_json, session_id, mac_rules_filename, rules_data) # fsync, off the event loop
         
-        pcap_session_record.updated_at = datetime.utcnow()
+        pcap_session_record.updated_at = datetime.now(timezone.utc)
         db_session.add(pcap_session_record)
-        db_session.commit()
+        await db_session.commit()
         return {"message": "MAC rules saved successfully.", "session_id": session_id, "file": mac_rules_filename}
     except Exception as e:
-        db_session.rollback()
+        await db_session.rollback()
         logger.error(f"Error saving MAC rules for session {session_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Failed to save MAC rules: {str(e)}")
 
 @general_router.post("/mac/apply", response_model=AsyncJob)
 async def apply_mac_transform_endpoint(
-    background_tasks: BackgroundTasks,
-    session_id_from_frontend: str = Form(..., alias="session_id"),
+    session_id_from_frontend: str = Form(..., alias="session_id", pattern=SESSION_ID_PATTERN),
     input_pcap_filename: str = Form(...),
-    db_session: Session = Depends(get_session)
+    db_session: AsyncSession = Depends(get_session)
 ):
     logger.info(f"Apply MAC transform request for session_id: {session_id_from_frontend}, file: {input_pcap_filename}")
     try:
@@ -1362,16 +1594,17 @@ async def apply_mac_transform_endpoint(
         # Allow proceeding if rules are optional
 
     # Create the job, associating it with the input session ID
+    now = datetime.now(timezone.utc)
     new_job = AsyncJob(
         session_id=session_id_from_frontend, # Job associated with the input trace
         trace_name=pcap_session_record.name,
-        job_type="mac_transform", status="pending", created_at=datetime.utcnow(), updated_at=datetime.utcnow()
+        job_type="mac_transform", status="pending", created_at=now, updated_at=now
     )
-    db_session.add(new_job); db_session.commit(); db_session.refresh(new_job)
+    db_session.add(new_job); await db_session.commit(); await db_session.refresh(new_job)
     logger.info(f"Created AsyncJob {new_job.id} for MAC transform of {pcap_session_record.name} ({session_id_from_frontend})/{input_pcap_filename}.")
 
     # Pass the input session ID directly to the background task
-    background_tasks.add_task(
+    submit_job(
         run_mac_transform,
         job_id=new_job.id,
         input_session_id=session_id_from_frontend, # Pass the input session ID
@@ -1382,10 +1615,9 @@ async def apply_mac_transform_endpoint(
 # --- DICOM Endpoints (moved to general_router, except the new one which is in dicom_router) ---
 @general_router.post("/dicom/extract_metadata", response_model=AsyncJob)
 async def extract_dicom_metadata_endpoint(
-    background_tasks: BackgroundTasks,
-    session_id_from_frontend: str = Form(..., alias="session_id"),
+    session_id_from_frontend: str = Form(..., alias="session_id", pattern=SESSION_ID_PATTERN),
     input_pcap_filename: str = Form(...),
-    db_session: Session = Depends(get_session)
+    db_session: AsyncSession = Depends(get_session)
 ):
     logger.info(f"DICOM metadata extraction request for session_id: {session_id_from_frontend}, file: {input_pcap_filename}")
     try:
@@ -1399,16 +1631,17 @@ async def extract_dicom_metadata_endpoint(
         raise e # Propagate 404 or other validation errors
 
     # Create the job, associating it with the input session ID
+    now = datetime.now(timezone.utc)
     new_job = AsyncJob(
         session_id=session_id_from_frontend, # Job associated with the input trace
         trace_name=pcap_session_record.name,
-        job_type="dicom_extract", status="pending", created_at=datetime.utcnow(), updated_at=datetime.utcnow()
+        job_type="dicom_extract", status="pending", created_at=now, updated_at=now
     )
-    db_session.add(new_job); db_session.commit(); db_session.refresh(new_job)
+    db_session.add(new_job); await db_session.commit(); await db_session.refresh(new_job)
     logger.info(f"Created AsyncJob {new_job.id} for DICOM extraction from {pcap_session_record.name} ({session_id_from_frontend})/{input_pcap_filename}.")
 
     # Pass the input session ID directly to the background task
-    background_tasks.add_task(
+    submit_job(
         run_dicom_extract,
         job_id=new_job.id,
         input_session_id=session_id_from_frontend, # Pass the input session ID
@@ -1419,10 +1652,10 @@ async def extract_dicom_metadata_endpoint(
 @general_router.post("/dicom/anonymize_v2", response_model=AsyncJob)
 async def anonymize_dicom_v2_endpoint(
     background_tasks: BackgroundTasks,
-    session_id_from_frontend: str = Form(..., alias="session_id"),
+    session_id_from_frontend: str = Form(..., alias="session_id", pattern=SESSION_ID_PATTERN),
     input_pcap_filename: str = Form(...),
     metadata_overrides_json: Optional[str] = Form(None), # JSON string for overrides
-    db_session: Session = Depends(get_session)
+    db_session: AsyncSession = Depends(get_session)
 ):
     logger.info(f"DICOM Anonymize V2 request for session_id: {session_id_from_frontend}, file: {input_pcap_filename}")
     try:
@@ -1439,12 +1672,13 @@ async def anonymize_dicom_v2_endpoint(
     # The task runner will handle parsing it.
 
     # Create the job, associating it with the input session ID
+    now = datetime.now(timezone.utc)
     new_job = AsyncJob(
         session_id=session_id_from_frontend, # Job associated with the input trace
         trace_name=pcap_session_record.name,
-        job_type="dicom_anonymize_v2", status="pending", created_at=datetime.utcnow(), updated_at=datetime.utcnow()
+        job_type="dicom_anonymize_v2", status="pending", created_at=now, updated_at=now
     )
-    db_session.add(new_job); db_session.commit(); db_session.refresh(new_job)
+    db_session.add(new_job); await db_session.commit(); await db_session.refresh(new_job)
     logger.info(f"Created AsyncJob {new_job.id} for DICOM Anonymize V2 of {pcap_session_record.name} ({session_id_from_frontend})/{input_pcap_filename}.")
 
     # Pass the input session ID directly to the background task
@@ -1457,83 +1691,167 @@ async def anonymize_dicom_v2_endpoint(
     )
     return new_job
 
-DICOM_OVERRIDES_FILENAME = "dicom_metadata_overrides.json" # This can remain global if filename is standard
+# Overrides used to be stored in this file of the session directory; it is
+# imported into the dicommetadataoverride table on first access
+DICOM_OVERRIDES_FILENAME = "dicom_metadata_overrides.json"
+
+def _read_legacy_dicom_overrides(session_id: str) -> dict | None:
+    """Returns the overrides of a session's legacy JSON file, or None if it has no readable one."""
+    legacy_path = storage.get_session_filepath(session_id, DICOM_OVERRIDES_FILENAME)
+    if not legacy_path.is_file():
+        return None
+    legacy_overrides = storage.load_json(session_id, DICOM_OVERRIDES_FILENAME)
+    if not isinstance(legacy_overrides, dict):
+        # Kept on disk so the overrides can still be recovered by hand
+        logger.warning(f"Not importing unreadable {legacy_path}; the file is left in place")
+        return None
+    return legacy_overrides
+
+def _remove_legacy_dicom_overrides(session_id: str) -> None:
+    storage.get_session_filepath(session_id, DICOM_OVERRIDES_FILENAME).unlink(missing_ok=True)
+
+async def import_legacy_dicom_overrides(session_id: str, db_session: AsyncSession) -> None:
+    """Moves the overrides of a session's legacy JSON file, if it has one, into the table."""
+    legacy_overrides = await asyncio.to_thread(_read_legacy_dicom_overrides, session_id)
+    if legacy_overrides is None:
+        return
+    if legacy_overrides:
+        await db_session.exec(
+            sqlite_insert(DicomMetadataOverride)
+            .values([
+                {"session_id": session_id, "ip_pair_key": ip_pair_key, "overrides": overrides}
+                for ip_pair_key, overrides in legacy_overrides.items()
+            ])
+            .on_conflict_do_nothing()
+        )
+        await db_session.commit()
+    # Another request may have imported and removed the file meanwhile
+    await asyncio.to_thread(_remove_legacy_dicom_overrides, session_id)
+    logger.info(f"Imported {len(legacy_overrides)} DICOM metadata overrides of session {session_id} from {DICOM_OVERRIDES_FILENAME}")
 
 @general_router.get("/dicom/metadata_overrides/{session_id_from_frontend}/{ip_pair_key}")
 async def get_dicom_metadata_overrides_endpoint(
-    session_id_from_frontend: str,
+    session_id_from_frontend: SessionId,
     ip_pair_key: str, # e.g., "192.168.1.10-192.168.1.20"
-    db_session: Session = Depends(get_session)
+    db_session: AsyncSession = Depends(get_session)
 ):
     logger.info(f"Get DICOM metadata overrides for session {session_id_from_frontend}, IP pair {ip_pair_key}")
     # Validate the session exists
-    pcap_session_record = db_session.get(PcapSession, session_id_from_frontend)
+    pcap_session_record = await db_session.get(PcapSession, session_id_from_frontend)
     if not pcap_session_record:
         raise HTTPException(status_code=404, detail=f"Session {session_id_from_frontend} not found.")
 
-    # Load overrides directly from the session's directory
-    all_overrides = storage.load_json(session_id_from_frontend, DICOM_OVERRIDES_FILENAME)
-    if all_overrides and ip_pair_key in all_overrides:
-        return all_overrides[ip_pair_key]
+    await import_legacy_dicom_overrides(session_id_from_frontend, db_session)
+    override = await db_session.get(DicomMetadataOverride, (session_id_from_frontend, ip_pair_key))
+    if override:
+        return override.overrides
     return {} # Return empty dict if no specific override for this key
 
 @general_router.put("/dicom/metadata_overrides/{session_id_from_frontend}/{ip_pair_key}")
 async def update_dicom_metadata_overrides_endpoint(
-    session_id_from_frontend: str,
+    session_id_from_frontend: SessionId,
     ip_pair_key: str,
     payload: DicomMetadataUpdatePayload,
-    db_session: Session = Depends(get_session)
+    db_session: AsyncSession = Depends(get_session)
 ):
     logger.info(f"Update DICOM metadata overrides for session {session_id_from_frontend}, IP pair {ip_pair_key}")
 
     # Validate the session exists
-    pcap_session_record = db_session.get(PcapSession, session_id_from_frontend)
+    pcap_session_record = await db_session.get(PcapSession, session_id_from_frontend)
     if not pcap_session_record:
         raise HTTPException(status_code=404, detail=f"Session {session_id_from_frontend} not found.")
 
-    # Load and store overrides directly in the session's directory
-    all_overrides = storage.load_json(session_id_from_frontend, DICOM_OVERRIDES_FILENAME) or {}
-    all_overrides[ip_pair_key] = payload.model_dump(exclude_none=True) # Store only provided fields
-    storage.store_json(session_id_from_frontend, DICOM_OVERRIDES_FILENAME, all_overrides)
-
-    # Update timestamp of the session
-    pcap_session_record.updated_at = datetime.utcnow()
-    db_session.add(pcap_session_record)
-    db_session.commit()
+    await import_legacy_dicom_overrides(session_id_from_frontend, db_session)
+    # Upsert this IP pair's row only
+    upsert_statement = sqlite_insert(DicomMetadataOverride).values(
+        session_id=session_id_from_frontend,
+        ip_pair_key=ip_pair_key,
+        overrides=payload.model_dump(exclude_none=True), # Store only provided fields
+    )
+    upsert_statement = upsert_statement.on_conflict_do_update(
+        index_elements=[DicomMetadataOverride.session_id, DicomMetadataOverride.ip_pair_key],
+        set_={"overrides": upsert_statement.excluded.overrides},
+        # The UI re-sends unchanged overrides: leave those rows alone
+        where=DicomMetadataOverride.overrides != upsert_statement.excluded.overrides,
+    ).returning(DicomMetadataOverride.ip_pair_key)
+    written = (await db_session.exec(upsert_statement)).first()
+
+    if written is not None:
+        # Update timestamp of the session
+        pcap_session_record.updated_at = datetime.now(timezone.utc)
+        db_session.add(pcap_session_record)
+        await db_session.commit()
 
     return {"message": "DICOM metadata overrides updated successfully.", "ip_pair_key": ip_pair_key, "overrides": payload}
 
 # --- Job Management Endpoints (moved to general_router) ---
+async def apply_live_progress(responses: List[JobListResponse]) -> None:
+    """Replaces the progress of running jobs by their live value from job_state, if it has one."""
+    running = [response for response in responses if response.status == "running"]
+    if not running:
+        return
+    live_progress = await job_state.get_progress(response.id for response in running)
+    for response in running:
+        response.progress = live_progress.get(response.id, response.progress)
+
+_job_list_adapter = TypeAdapter(List[JobListResponse])
+
 @general_router.get("/jobs", response_model=List[JobListResponse])
-async def list_jobs(db_session: Session = Depends(get_session)):
-    statement = select(AsyncJob).order_by(AsyncJob.created_at.desc())
-    jobs = db_session.exec(statement).all()
-    return jobs
+async def list_jobs(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Page size; all jobs if omitted"),
+    before: Optional[datetime] = Query(None, description="Only jobs created before this time (the previous page's X-Next-Before)"),
+    before_id: Optional[int] = Query(None, description="With `before`, also jobs created at that time with a smaller id (the previous page's X-Next-Before-Id)"),
+    db_session: AsyncSession = Depends(get_session),
+):
+    # result_data isn't part of the list: don't load (and decompress) it
+    statement = paginate_by_time(
+        select(AsyncJob).options(defer(AsyncJob.result_data)).order_by(AsyncJob.created_at.desc(), AsyncJob.id.desc()),
+        AsyncJob.created_at, AsyncJob.id, limit, before, before_id,
+    )
+    jobs = (await db_session.exec(statement)).all()
+    set_next_page_header(response, jobs, limit, lambda job: (job.created_at, job.id))
+    responses = [JobListResponse.model_validate(job, from_attributes=True) for job in jobs]
+    await apply_live_progress(responses)
+    return conditional_json_response(request, response, _job_list_adapter, responses)
 
 @general_router.get("/jobs/{job_id}", response_model=JobStatusResponse)
-async def get_job_status(job_id: int, db_session: Session = Depends(get_session)):
-    job = db_session.get(AsyncJob, job_id)
+async def get_job_status(job_id: PositiveInt, db_session: AsyncSession = Depends(get_session)):
+    job = await db_session.get(AsyncJob, job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
-    return job
+    if not job_state.enabled():
+        return job
+    response = JobStatusResponse.model_validate(job, from_attributes=True)
+    await apply_live_progress([response])
+    return response
 
 @general_router.post("/jobs/{job_id}/cancel", response_model=JobStatusResponse)
-async def cancel_job(job_id: int, db_session: Session = Depends(get_session)):
-    job = db_session.get(AsyncJob, job_id)
-    if not job:
-        raise HTTPException(status_code=404, detail="Job not found")
-    if job.status not in ["pending", "running"]:
+async def cancel_job(job_id: PositiveInt, db_session: AsyncSession = Depends(get_session)):
+    # Check and transition in one conditional UPDATE, so a concurrent cancel or
+    # the job finishing in between can't be overwritten
+    cancel_statement = (
+        update(AsyncJob)
+        .where(AsyncJob.id == job_id, AsyncJob.status.in_(["pending", "running"]))
+        .values(status="cancelling", stop_requested=True, updated_at=func.now()) # Signals to the task
+        .returning(AsyncJob)
+    )
+    job = (await db_session.exec(cancel_statement)).scalars().one_or_none()
+    if job is None:
+        # Not updated: find out why
+        job = await db_session.get(AsyncJob, job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
         raise HTTPException(status_code=400, detail=f"Job in status '{job.status}' cannot be cancelled.")
-    job.status = "cancelling" # Signal to the task
-    job.stop_requested = True # More explicit flag
-    job.updated_at = datetime.utcnow()
-    db_session.add(job); db_session.commit(); db_session.refresh(job)
+    await db_session.commit()
+    await job_state.request_stop(job_id)
     logger.info(f"Cancellation requested for job {job_id}.")
     return job
 
 @general_router.delete("/jobs/{job_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_job_record(job_id: int, db_session: Session = Depends(get_session)):
-    job = db_session.get(AsyncJob, job_id)
+async def delete_job_record(job_id: PositiveInt, db_session: AsyncSession = Depends(get_session)):
+    job = await db_session.get(AsyncJob, job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
     # Optionally, add logic: only allow deletion of completed/failed/cancelled jobs
@@ -1545,48 +1863,82 @@ async def delete_job_record(job_id: int, db_session: Session = Depends(get_sessi
     if job.output_trace_id:
         logger.warning(f"Job {job_id} produced output trace {job.output_trace_id}. Deleting job record only. Trace remains.")
 
-    db_session.delete(job)
-    db_session.commit()
+    await db_session.delete(job)
+    await db_session.commit()
     logger.info(f"AsyncJob record {job_id} deleted.")
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 # --- SSE Job Status Endpoint ---
-async def job_status_event_generator(job_id: int, initial_job_status: JobStatusResponse, db: Session):
+# Interval of the SSE streams' job polling without job_state: it grows by a
+# second every JOB_EVENTS_POLL_BACKOFF_POLLS polls without a change, up to the
+# max, and is reset by a change. With job_state, the longest wait for a
+# published update before re-reading the job anyway.
+JOB_EVENTS_POLL_INTERVAL = 1.0
+JOB_EVENTS_MAX_POLL_INTERVAL = 5.0
+JOB_EVENTS_POLL_BACKOFF_POLLS = 3
+JOB_EVENTS_UPDATE_TIMEOUT = 5.0
+JOB_TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+def job_event_response(job: AsyncJob) -> JobListResponse:
+    """
+    The SSE payload for the job. result_data is only included once the job has
+    finished, so a large result isn't re-sent with every progress update.
+    """
+    response_model = JobStatusResponse if job.status in JOB_TERMINAL_STATUSES else JobListResponse
+    return response_model.model_validate(job, from_attributes=True)
+
+async def job_status_event_generator(job_id: int, initial_job_status: JobListResponse, db: AsyncSession):
     """
     Asynchronously generates Server-Sent Events for job status updates.
-    Relies on polling the database for changes.
+    With job_state enabled, the job is re-read when it publishes an update;
+    otherwise the database is polled for changes.
     """
     logger.info(f"SSE connection opened for job_id: {job_id}")
     last_status_json = initial_job_status.model_dump_json()
     yield f"data: {last_status_json}\n\n" # Send initial status immediately
 
+    updates = None
+    idle_polls = 0 # Polls since the last change
     try:
+        updates = await job_state.subscribe_updates(job_id)
         while True:
-            await asyncio.sleep(1) # Polling interval (e.g., 1 second)
+            if updates is None:
+                await asyncio.sleep(min(
+                    JOB_EVENTS_MAX_POLL_INTERVAL,
+                    JOB_EVENTS_POLL_INTERVAL + idle_polls // JOB_EVENTS_POLL_BACKOFF_POLLS,
+                ))
+            else:
+                await job_state.wait_for_update(updates, JOB_EVENTS_UPDATE_TIMEOUT)
             
             # Re-fetch job in each iteration to get the latest state
             # This ensures that the db session is used in a way that's safe for long polling
-            current_job_from_db = db.get(AsyncJob, job_id)
+            # populate_existing: reload the row instead of returning the identity-map copy
+            current_job_from_db = await db.get(
+                AsyncJob, job_id, populate_existing=True, options=[defer(AsyncJob.result_data)],
+            )
             if not current_job_from_db:
                 logger.warning(f"Job {job_id} not found during SSE polling. Closing stream.")
                 yield f"data: {{\"error\": \"Job not found\", \"job_id\": {job_id}}}\n\n"
                 break
+            if current_job_from_db.status in JOB_TERMINAL_STATUSES:
+                # Only the final event carries result_data: load it just for that one
+                await db.refresh(current_job_from_db, ["result_data"])
 
-            # Convert SQLModel instance to a dictionary before validation
-            job_dict = current_job_from_db.model_dump()
-            current_job_response = JobStatusResponse.model_validate(job_dict)
+            current_job_response = job_event_response(current_job_from_db)
+            await apply_live_progress([current_job_response])
             current_status_json = current_job_response.model_dump_json()
 
             if current_status_json != last_status_json:
                 last_status_json = current_status_json
+                idle_polls = 0
                 logger.info(f"SSE: Job {job_id} status update: {last_status_json}")
                 yield f"data: {last_status_json}\n\n"
+            else:
+                idle_polls += 1
 
-            if current_job_from_db.status in ["completed", "failed", "cancelled"]:
+            if current_job_from_db.status in JOB_TERMINAL_STATUSES:
+                # The final status, with result_data, was sent above
                 logger.info(f"SSE: Job {job_id} reached terminal state '{current_job_from_db.status}'. Closing stream.")
-                # Send final status one last time if it changed and led to termination
-                if current_status_json != last_status_json: # Ensure the very last update is sent
-                     yield f"data: {current_status_json}\n\n"
                 break
     except asyncio.CancelledError:
         logger.info(f"SSE connection for job_id: {job_id} closed by client.")
@@ -1601,12 +1953,14 @@ async def job_status_event_generator(job_id: int, initial_job_status: JobStatusR
         except Exception as send_err:
             logger.error(f"SSE: Failed to send error to client for job {job_id}: {send_err}")
     finally:
+        if updates is not None:
+            await updates.aclose()
         logger.info(f"SSE stream ended for job_id: {job_id}")
 
 
 @general_router.get("/jobs/{job_id}/events", response_class=StreamingResponse)
-async def job_events_sse(job_id: int, db_session: Session = Depends(get_session)):
-    job_orm = db_session.get(AsyncJob, job_id) # Renamed to job_orm
+async def job_events_sse(job_id: PositiveInt, db_session: AsyncSession = Depends(get_session)):
+    job_orm = await db_session.get(AsyncJob, job_id) # Renamed to job_orm
     if not job_orm:
         # Return a plain JSON response for the 404, not a stream
         return JSONResponse(
@@ -1614,9 +1968,8 @@ async def job_events_sse(job_id: int, db_session: Session = Depends(get_session)
             content={"detail": "Job not found"}
         )
     
-    # Convert SQLModel instance to a dictionary before validation
-    job_dict = job_orm.model_dump()
-    initial_job_status = JobStatusResponse.model_validate(job_dict)
+    initial_job_status = job_event_response(job_orm)
+    await apply_live_progress([initial_job_status])
     
     # Pass the db_session to the generator. The generator should use this session.
     # FastAPI handles the lifecycle of db_session for the request.
@@ -1626,9 +1979,9 @@ async def job_events_sse(job_id: int, db_session: Session = Depends(get_session)
 # --- Download Endpoint (moved to general_router) ---
 @general_router.get("/download/{session_id_from_frontend}/{filename}")
 async def download_session_file_endpoint( # Renamed function
-    session_id_from_frontend: str,
+    session_id_from_frontend: SessionId,
     filename: str, # This is the logical filename the user wants to download
-    db_session: Session = Depends(get_session)
+    db_session: AsyncSession = Depends(get_session)
 ):
     logger.info(f"Download request for session {session_id_from_frontend}, filename {filename}")
     try:
@@ -1659,13 +2012,39 @@ async def download_session_file_endpoint( # Renamed function
 
     logger.info(f"Determined media type: {media_type} for filename: {filename}")
 
-    return FileResponse(path=validated_file_path, filename=filename, media_type=media_type)
+    return PcapFileResponse(path=validated_file_path, filename=filename, media_type=media_type)
 
 # --- Settings Management Endpoints (moved to general_router) ---
+def _delete_all_session_dirs() -> tuple[int, int, list[str]]:
+    """Removes every directory under SESSIONS_BASE_DIR; returns (deleted, failed, error messages)."""
+    deleted_dirs_count = 0
+    failed_dirs_count = 0
+    error_messages = []
+    try:
+        sessions_base_dir = storage.SESSIONS_BASE_DIR # Corrected to use the constant
+        if sessions_base_dir.exists() and sessions_base_dir.is_dir():
+            for session_dir_item in sessions_base_dir.iterdir():
+                if session_dir_item.is_dir(): # Ensure it's a directory
+                    try:
+                        shutil.rmtree(session_dir_item)
+                        logger.info(f"Successfully deleted session directory: {session_dir_item}")
+                        deleted_dirs_count += 1
+                    except Exception as e:
+                        msg = f"Failed to delete session directory {session_dir_item}: {str(e)}"
+                        logger.error(msg, exc_info=True)
+                        error_messages.append(msg)
+                        failed_dirs_count += 1
+        logger.info(f"Physical directory cleanup: {deleted_dirs_count} deleted, {failed_dirs_count} failed.")
+    except Exception as e:
+        msg = f"Error accessing or iterating session directories at {storage.SESSIONS_BASE_DIR}: {str(e)}" # Corrected here as well
+        logger.error(msg, exc_info=True)
+        error_messages.append(msg)
+    return deleted_dirs_count, failed_dirs_count, error_messages
+
 @general_router.post("/api/v1/settings/clear-all-data", status_code=status.HTTP_200_OK)
 async def clear_all_data_endpoint(
     background_tasks: BackgroundTasks, # Moved before db_session
-    db_session: Session = Depends(get_session)
+    db_session: AsyncSession = Depends(get_session)
 ):
     logger.info("Request received for POST /api/v1/settings/clear-all-data")
 
@@ -1674,55 +2053,37 @@ async def clear_all_data_endpoint(
     # 1. Delete all AsyncJob records
     try:
         statement_jobs = select(AsyncJob)
-        jobs_to_delete = db_session.exec(statement_jobs).all()
+        jobs_to_delete = (await db_session.exec(statement_jobs)).all()
         num_jobs_deleted = len(jobs_to_delete)
         for job in jobs_to_delete:
-            db_session.delete(job)
-        db_session.commit()
+            await db_session.delete(job)
+        await db_session.commit()
         logger.info(f"Successfully deleted {num_jobs_deleted} AsyncJob records.")
     except Exception as e:
-        db_session.rollback()
+        await db_session.rollback()
         msg = f"Error deleting AsyncJob records: {str(e)}"
         logger.error(msg, exc_info=True)
         error_messages.append(msg)
 
-    # 2. Delete all PcapSession records
+    # 2. Delete all PcapSession records (and the DICOM metadata overrides referencing them)
     try:
+        await db_session.exec(delete(DicomMetadataOverride))
         statement_sessions = select(PcapSession)
-        sessions_to_delete = db_session.exec(statement_sessions).all()
+        sessions_to_delete = (await db_session.exec(statement_sessions)).all()
         num_sessions_deleted = len(sessions_to_delete)
         for session_record in sessions_to_delete:
-            db_session.delete(session_record)
-        db_session.commit()
+            await db_session.delete(session_record)
+        await db_session.commit()
         logger.info(f"Successfully deleted {num_sessions_deleted} PcapSession records.")
     except Exception as e:
-        db_session.rollback()
+        await db_session.rollback()
         msg = f"Error deleting PcapSession records: {str(e)}"
         logger.error(msg, exc_info=True)
         error_messages.append(msg)
 
-    # 3. Delete all physical session directories
-    deleted_dirs_count = 0
-    failed_dirs_count = 0
-    try:
-        sessions_base_dir = storage.SESSIONS_BASE_DIR # Corrected to use the constant
-        if sessions_base_dir.exists() and sessions_base_dir.is_dir():
-            for session_dir_item in sessions_base_dir.iterdir():
-                if session_dir_item.is_dir(): # Ensure it's a directory
-                    try:
-                        shutil.rmtree(session_dir_item)
-                        logger.info(f"Successfully deleted session directory: {session_dir_item}")
-                        deleted_dirs_count += 1
-                    except Exception as e:
-                        msg = f"Failed to delete session directory {session_dir_item}: {str(e)}"
-                        logger.error(msg, exc_info=True)
-                        error_messages.append(msg)
-                        failed_dirs_count += 1
-        logger.info(f"Physical directory cleanup: {deleted_dirs_count} deleted, {failed_dirs_count} failed.")
-    except Exception as e:
-        msg = f"Error accessing or iterating session directories at {storage.SESSIONS_BASE_DIR}: {str(e)}" # Corrected here as well
-        logger.error(msg, exc_info=True)
-        error_messages.append(msg)
+    # 3. Delete all physical session directories (the shard directories holding them), off the event loop
+    deleted_dirs_count, failed_dirs_count, dir_error_messages = await asyncio.to_thread(_delete_all_session_dirs)
+    error_messages.extend(dir_error_messages)
 
     if error_messages:
         # If there were any errors, return a 500 status but include details
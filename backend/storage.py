@@ -1,11 +1,15 @@
 import json
+import os
 import uuid
 from pathlib import Path
 import shutil # Added for store_uploaded_pcap
 import logging
+import struct
+import tempfile
+from typing import Iterable, Tuple
 
 # Scapy imports
-from scapy.all import rdpcap, wrpcap, PacketList
+from scapy.all import rdpcap, wrpcap, PacketList, PcapReader, RawPcapReader, RawPcapNgReader
 
 # FastAPI specific imports (needed for UploadFile type hint)
 from fastapi import UploadFile
@@ -22,6 +26,10 @@ def create_new_session_id() -> str:
     """Creates and returns a new unique session ID."""
     return str(uuid.uuid4())
 
+# Session directories are grouped by the first characters of their ID
+# (sessions/ab/abcdef.../) so the base directory doesn't grow one entry per session
+SESSION_SHARD_LENGTH = 2
+
 def get_session_dir(session_id: str) -> Path:
     """
     Returns the absolute path to a specific session's directory.
@@ -29,10 +37,32 @@ def get_session_dir(session_id: str) -> Path:
     """
     if not session_id:
         raise ValueError("session_id cannot be empty or None.")
-    session_path = SESSIONS_BASE_DIR / session_id
+    session_path = SESSIONS_BASE_DIR / session_id[:SESSION_SHARD_LENGTH] / session_id
     session_path.mkdir(parents=True, exist_ok=True)
     return session_path.resolve()
 
+def migrate_flat_session_dirs() -> list[Tuple[Path, Path]]:
+    """
+    Moves session directories still stored directly under SESSIONS_BASE_DIR
+    (before sharding) into their shard directory.
+    Returns the (old, new) absolute paths of the moved directories.
+    """
+    moved = []
+    for entry in SESSIONS_BASE_DIR.iterdir():
+        if not entry.is_dir() or len(entry.name) <= SESSION_SHARD_LENGTH:
+            continue # Already a shard directory
+        target = SESSIONS_BASE_DIR / entry.name[:SESSION_SHARD_LENGTH] / entry.name
+        if target.exists():
+            logger.warning(f"Not migrating session directory {entry}: {target} already exists")
+            continue
+        old_path = entry.resolve()
+        target.parent.mkdir(exist_ok=True)
+        entry.rename(target)
+        moved.append((old_path, target.resolve()))
+    if moved:
+        logger.info(f"Moved {len(moved)} session directories into shard directories")
+    return moved
+
 def get_session_filepath(session_id: str, filename: str) -> Path:
     """
     Returns the absolute path to a specific file within a session's directory.
@@ -43,16 +73,41 @@ def get_session_filepath(session_id: str, filename: str) -> Path:
     session_dir = get_session_dir(session_id)
     return (session_dir / filename).resolve()
 
-def store_json(session_id: str, filename: str, data: dict):
+# mkstemp creates its files 0600; saved files get the mode open() would give them.
+# The umask can only be read by setting it, so this is done once, before any threads start.
+_umask = os.umask(0)
+os.umask(_umask)
+_NEW_FILE_MODE = 0o666 & ~_umask
+
+def store_bytes(session_id: str, filename: str, data: bytes) -> Path:
     """
-    Stores data (dictionary) as a JSON file in the session's directory.
-    The filename should include the .json extension if desired.
+    Stores raw bytes as a file in the session's directory.
+    The data is written to a temporary file that then replaces the old one, so
+    a crash or a concurrent save never leaves a truncated file behind.
     """
+    # No lock: every caller saves a whole document rather than merging into the
+    # stored one, so of two concurrent saves the last replace simply wins.
     filepath = get_session_filepath(session_id, filename)
-    with open(filepath, 'w') as f:
-        json.dump(data, f, indent=2)
+    fd, tmp_path = tempfile.mkstemp(dir=filepath.parent, prefix=f"{filepath.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            os.fchmod(f.fileno(), _NEW_FILE_MODE)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
     return filepath
 
+def store_json(session_id: str, filename: str, data: dict):
+    """
+    Stores data (dictionary) as a JSON file in the session's directory, atomically (see store_bytes).
+    The filename should include the .json extension if desired.
+    """
+    return store_bytes(session_id, filename, json.dumps(data, indent=2).encode())
+
 def load_json(session_id: str, filename: str) -> dict | None:
     """
     Loads data from a JSON file in the session's directory.
@@ -96,6 +151,49 @@ def get_capture_path(session_id: str) -> Path:
 
 # --- PCAP specific helpers ---
 
+# Chunk size for copying uploads to disk: few, large reads/writes instead of
+# shutil.copyfileobj's 64 KiB ones
+UPLOAD_COPY_BUFFER_SIZE = 4 << 20
+
+# Bytes per os.sendfile call when an upload is already on disk
+UPLOAD_SENDFILE_CHUNK = 1 << 24
+
+def _sendfile_upload(src, out) -> bool:
+    """
+    Copies src to the (still empty) file out in the kernel with os.sendfile, when
+    src is a SpooledTemporaryFile that has spilled to disk (Starlette does that
+    for large uploads). Returns False, with out left empty, if src is still in
+    memory or the platform can't sendfile between regular files.
+    """
+    if not getattr(src, '_rolled', False) or not hasattr(os, 'sendfile'):
+        return False
+    in_fd = src.fileno()
+    out_fd = out.fileno()
+    offset = src.tell()
+    try:
+        while sent := os.sendfile(out_fd, in_fd, offset, UPLOAD_SENDFILE_CHUNK):
+            offset += sent
+    except OSError as e:
+        logger.debug(f"sendfile not usable for upload copy ({e}), falling back to buffered copy")
+        out.seek(0)
+        out.truncate()
+        return False
+    return True
+
+def _copy_upload_stream(src, pcap_path: Path) -> None:
+    """Copies the file object src to pcap_path, zero-copy if it is on disk, else through one reusable buffer."""
+    readinto = getattr(src, 'readinto', None)
+    with open(pcap_path, 'wb') as out: # Chunks larger than the write buffer go straight to the file
+        if _sendfile_upload(src, out):
+            return
+        if readinto is None:
+            shutil.copyfileobj(src, out, UPLOAD_COPY_BUFFER_SIZE)
+            return
+        buf = bytearray(UPLOAD_COPY_BUFFER_SIZE)
+        view = memoryview(buf)
+        while n := readinto(buf):
+            out.write(view[:n])
+
 def store_uploaded_pcap(session_id: str, uploaded_file: UploadFile, target_filename: str = "capture.pcap") -> Path:
     """
     Saves an uploaded PCAP file (FastAPI UploadFile) to the session directory.
@@ -103,8 +201,7 @@ def store_uploaded_pcap(session_id: str, uploaded_file: UploadFile, target_filen
     """
     pcap_path = get_session_filepath(session_id, target_filename)
     try:
-        with open(pcap_path, 'wb') as buffer:
-            shutil.copyfileobj(uploaded_file.file, buffer)
+        _copy_upload_stream(uploaded_file.file, pcap_path)
         return pcap_path
     except Exception as e:
         logger.exception(f"Error storing uploaded PCAP file to {pcap_path}")
@@ -113,6 +210,10 @@ def store_uploaded_pcap(session_id: str, uploaded_file: UploadFile, target_filen
         if hasattr(uploaded_file, 'file') and uploaded_file.file and not uploaded_file.file.closed:
             uploaded_file.file.close()
 
+# Buffer size for sequential PCAP reads. Readers pull packets with many small
+# read() calls; a 1 MiB buffer turns those into far fewer syscalls.
+PCAP_READ_BUFFER_SIZE = 1 << 20
+
 def read_pcap_from_session(session_id: str, filename: str = "capture.pcap") -> PacketList:
     """
     Reads a PCAP file from the session directory and returns Scapy PacketList.
@@ -123,12 +224,37 @@ def read_pcap_from_session(session_id: str, filename: str = "capture.pcap") -> P
         logger.error(f"PCAP file not found in session {session_id}: {filename} at {pcap_path}")
         raise FileNotFoundError(f"PCAP file not found in session {session_id}: {filename} at {pcap_path}")
     try:
-        packets = rdpcap(str(pcap_path))
+        with open(pcap_path, 'rb', buffering=PCAP_READ_BUFFER_SIZE) as f:
+            packets = rdpcap(f)
         return packets
     except Exception as e:
         logger.exception(f"Failed to read PCAP file {pcap_path}")
         raise RuntimeError(f"Failed to read PCAP file {pcap_path}: {e}") from e
 
+def open_pcap_reader(session_id: str, filename: str = "capture.pcap", raw: bool = False) -> PcapReader:
+    """
+    Opens a PCAP file from the session directory for streaming, packet by packet.
+    Use it as a context manager so the file gets closed; callers that only need
+    the head of a capture can stop iterating early instead of loading it all.
+    With raw=True a RawPcapReader is returned, yielding (frame bytes, metadata)
+    without dissecting the packets.
+    """
+    pcap_path = get_session_filepath(session_id, filename)
+    if not pcap_path.exists():
+        logger.error(f"PCAP file not found in session {session_id}: {filename} at {pcap_path}")
+        raise FileNotFoundError(f"PCAP file not found in session {session_id}: {filename} at {pcap_path}")
+    try:
+        f = open(pcap_path, 'rb', buffering=PCAP_READ_BUFFER_SIZE)
+    except Exception as e:
+        logger.exception(f"Failed to open PCAP file {pcap_path}")
+        raise RuntimeError(f"Failed to open PCAP file {pcap_path}: {e}") from e
+    try:
+        return (RawPcapReader if raw else PcapReader)(f) # Closing the reader closes the file
+    except Exception as e:
+        f.close()
+        logger.exception(f"Failed to open PCAP file {pcap_path}")
+        raise RuntimeError(f"Failed to open PCAP file {pcap_path}: {e}") from e
+
 def write_pcap_to_session(session_id: str, filename: str, packets: PacketList) -> Path:
     """
     Writes Scapy PacketList to a PCAP file in the session directory.
@@ -142,6 +268,63 @@ def write_pcap_to_session(session_id: str, filename: str, packets: PacketList) -
         logger.exception(f"Failed to write PCAP file {pcap_path}")
         raise RuntimeError(f"Failed to write PCAP file {pcap_path}: {e}") from e
 
+# Classic libpcap format: microsecond timestamps, little-endian headers
+PCAP_GLOBAL_HEADER = struct.Struct('<IHHiIII')
+PCAP_RECORD_HEADER = struct.Struct('<IIII')
+PCAP_LINKTYPE_ETHERNET = 1
+PCAP_DEFAULT_SNAPLEN = 65535
+
+def read_pcap_link_info(session_id: str, filename: str = "capture.pcap") -> Tuple[int, int]:
+    """
+    Returns the (linktype, snaplen) of a PCAP or PCAPNG file in the session directory.
+    For PCAPNG the first interface is used; an unset snaplen gives the default.
+    """
+    with open_pcap_reader(session_id, filename, raw=True) as reader:
+        if isinstance(reader, RawPcapNgReader):
+            # Interfaces are only known once their description block has been read
+            next(iter(reader), None)
+            if not reader.interfaces:
+                return PCAP_LINKTYPE_ETHERNET, PCAP_DEFAULT_SNAPLEN
+            linktype, snaplen = reader.interfaces[0][:2]
+        else:
+            linktype, snaplen = reader.linktype, reader.snaplen
+    return linktype, snaplen or PCAP_DEFAULT_SNAPLEN
+
+def write_pcap_records_to_session(
+    session_id: str,
+    filename: str,
+    records: Iterable[Tuple[int, int, bytes, int]],
+    linktype: int = PCAP_LINKTYPE_ETHERNET,
+    snaplen: int = PCAP_DEFAULT_SNAPLEN,
+) -> Path:
+    """
+    Writes already serialized frames to a PCAP file in the session directory,
+    without going through Scapy. Each record is (ts_sec, ts_usec, frame_bytes, wire_len).
+    Pass the linktype and snaplen of the capture the frames come from; the
+    snaplen is raised in the header if a frame turns out to be longer.
+    Returns the Path object of the written file.
+    """
+    pcap_path = get_session_filepath(session_id, filename)
+    try:
+        with open(pcap_path, 'wb') as f:
+            write = f.write
+            pack_record_header = PCAP_RECORD_HEADER.pack
+            write(PCAP_GLOBAL_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, snaplen, linktype))
+            max_frame_len = 0
+            for ts_sec, ts_usec, frame, wire_len in records:
+                frame_len = len(frame)
+                if frame_len > max_frame_len:
+                    max_frame_len = frame_len
+                write(pack_record_header(ts_sec, ts_usec, frame_len, wire_len))
+                write(frame)
+            if max_frame_len > snaplen:
+                f.seek(0)
+                write(PCAP_GLOBAL_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, max_frame_len, linktype))
+        return pcap_path
+    except Exception as e:
+        logger.exception(f"Failed to write PCAP file {pcap_path}")
+        raise RuntimeError(f"Failed to write PCAP file {pcap_path}: {e}") from e
+
 # --- Job status helpers ---
 def store_job_status(session_id: str, job_id: str, status: dict):
     """
@@ -0,0 +1,113 @@
+"""
+Test suite for the IP/MAC anonymization helpers in `backend.anonymizer`.
+
+Covers:
+- Compilation of CIDR rules into int tuples.
+- Rule matching and fallback in `anon_ip`.
+- Uniqueness and determinism of the fallback 10.x.x.x pool.
+- Expansion of the column-oriented preview into per-flow rows.
+- The link type and snaplen carried from the input capture into the written output.
+"""
+import ipaddress
+
+import pytest
+
+from scapy.all import IP, Ether, RawPcapReader, wrpcap, wrpcapng
+
+from backend import storage
+from backend.anonymizer import PREVIEW_COLUMNS, FallbackIpPool, anon_ip, compile_rules, preview_to_rows
+from backend.models import Rule
+
+# --- Test Data ---
+
+SAMPLE_RULES = [
+    Rule(source="192.168.1.0/24", target="10.1.1.0/24"),
+    Rule(source="192.168.0.0/16", target="172.20.0.0/16"),
+    Rule(source="172.16.0.0/24", target="11.0.0.0/30"),
+]
+"""Rules already sorted by specificity, as apply_anonymization sorts them."""
+
+SAMPLE_IPS = ["192.168.1.7", "192.168.5.9", "172.16.0.2", "172.16.0.200", "8.8.8.8"]
+"""IPs hitting the /24 rule, the /16 rule, a fitting offset, an overflowing offset and no rule."""
+
+
+def test_compile_rules_int_tuples():
+    """Rules compile to (version, from_int, prefixlen, to_int, to_size) in input order."""
+    compiled = compile_rules(SAMPLE_RULES)
+    assert compiled[0] == (4, int(ipaddress.IPv4Address("192.168.1.0")), 24, int(ipaddress.IPv4Address("10.1.1.0")), 256)
+    assert [rule[2] for rule in compiled] == [24, 16, 24]
+    assert compiled[2][4] == 4
+
+
+def test_compile_rules_skips_invalid_cidr():
+    """Rules with unparsable CIDRs are dropped instead of raising."""
+    compiled = compile_rules([Rule(source="not-a-cidr", target="10.0.0.0/8")] + SAMPLE_RULES)
+    assert len(compiled) == len(SAMPLE_RULES)
+
+
+def test_anon_ip_rules_and_fallback():
+    """Longest-prefix rules map by offset; no match or an overflowing offset falls back to 10.x.x.x."""
+    compiled = compile_rules(SAMPLE_RULES)
+    pool = FallbackIpPool()
+    mapped = [anon_ip(ip, compiled, pool) for ip in SAMPLE_IPS]
+    assert mapped[:3] == ["10.1.1.7", "172.20.5.9", "11.0.0.2"]
+    assert all(ip.startswith("10.") for ip in mapped[3:])
+
+
+def test_fallback_pool_deterministic_per_salt():
+    """The same IP and salt always start from the same fallback address."""
+    packed = ipaddress.IPv4Address("8.8.8.8").packed
+    first = FallbackIpPool(salt=b"fixed-salt").allocate(packed)
+    second = FallbackIpPool(salt=b"fixed-salt").allocate(packed)
+    assert first == second
+    assert first.startswith("10.")
+
+
+def test_fallback_pool_probes_past_used_addresses():
+    """Colliding or reserved slots are skipped; .0 and .255 are never handed out."""
+    pool = FallbackIpPool(salt=b"fixed-salt")
+    packed = ipaddress.IPv4Address("8.8.8.8").packed
+    first = pool.allocate(packed)
+    # Reserve the next slot as if a rule had mapped an IP onto it
+    pool.mark_used(int(ipaddress.IPv4Address(first)) + 1)
+    allocated = {first} | {pool.allocate(packed) for _ in range(600)}
+    assert len(allocated) == 601
+    assert str(ipaddress.IPv4Address(int(ipaddress.IPv4Address(first)) + 1)) not in allocated
+    assert not any(ip.endswith((".0", ".255")) for ip in allocated)
+
+
+def test_preview_to_rows():
+    """Column lists expand into the original/anonymized row dicts, in order."""
+    values = {
+        'src_ip': "192.168.1.7", 'dst_ip': "8.8.8.8",
+        'src_mac': "00:11:22:33:44:55", 'dst_mac': "66:77:88:99:aa:bb",
+        'anon_src_ip': "10.1.1.7", 'anon_dst_ip': "10.2.3.4",
+        'anon_src_mac': "00:11:22:AA:BB:CC", 'anon_dst_mac': "66:77:88:DD:EE:FF",
+    }
+    preview = {"columns": {name: [values[name]] for name in PREVIEW_COLUMNS}, "rows": 1}
+    assert preview_to_rows(preview) == [{
+        'original': {'src_ip': "192.168.1.7", 'dst_ip': "8.8.8.8", 'src_mac': "00:11:22:33:44:55", 'dst_mac': "66:77:88:99:aa:bb"},
+        'anonymized': {'src_ip': "10.1.1.7", 'dst_ip': "10.2.3.4", 'src_mac': "00:11:22:AA:BB:CC", 'dst_mac': "66:77:88:DD:EE:FF"},
+    }]
+
+
+@pytest.mark.parametrize("writer", [wrpcap, wrpcapng])
+def test_output_keeps_input_link_info(tmp_path, monkeypatch, writer):
+    """The output header reuses the input's linktype and snaplen, raised only for longer frames."""
+    monkeypatch.setattr(storage, "SESSIONS_BASE_DIR", tmp_path)
+    frame = bytes(Ether() / IP())
+    kwargs = {"snaplen": 1500} if writer is wrpcap else {}
+    writer(str(storage.get_capture_path("in")), [Ether(frame)], **kwargs)
+    linktype, snaplen = storage.read_pcap_link_info("in")
+    assert linktype == storage.PCAP_LINKTYPE_ETHERNET
+    if writer is wrpcap:
+        assert snaplen == 1500
+
+    path = storage.write_pcap_records_to_session("out", "a.pcap", [(0, 0, frame, len(frame))], linktype, snaplen)
+    with RawPcapReader(str(path)) as reader:
+        assert (reader.linktype, reader.snaplen) == (linktype, snaplen)
+
+    long_frame = frame + b"\x00" * snaplen
+    path = storage.write_pcap_records_to_session("out", "b.pcap", [(0, 0, long_frame, len(long_frame))], linktype, snaplen)
+    with RawPcapReader(str(path)) as reader:
+        assert reader.snaplen == len(long_frame)
@@ -0,0 +1,315 @@
+"""
+Test suite for the streaming helpers in `backend.dicom_pcap_extractor`.
+
+Covers:
+- Sequence-ordered TCP payload reassembly in `_TcpFlow`, including out-of-order segments.
+- Skipping repeated sessions in `_finish_flow`.
+- Early rejection of non-DICOM streams in `extract_relevant_metadata`.
+- AE title padding stripping for the A-ASSOCIATE payload scan.
+- Direct parsing of A-ASSOCIATE-RQ/AC PDUs in `_parse_associate`.
+- PDV offset walking in `backend.dicom_pdu_walk`.
+- P-DATA handling: command PDVs skipped, data PDVs parsed for the wanted tags
+  until all of them are found.
+- The memory-mapped pcap reader `_MmapSegmentReader` and the raw-record
+  `_ScapySegmentReader` fallback.
+- The per-capture results cache and its format version.
+- End-to-end extraction with the flows parsed in-process (max_workers=1),
+  and JSON-serializable results for multi-valued elements.
+- Time-based throttling of progress callbacks.
+"""
+import json
+import struct
+
+import pytest
+
+from scapy.all import IP, TCP, UDP, CookedLinux, Dot1Q, Ether, Padding, Raw, wrpcap, wrpcapng
+
+from backend import dicom_pcap_extractor, storage
+from backend.dicom_pdu_walk import data_pdvs
+from backend.dicom_pcap_extractor import (
+    _MmapSegmentReader,
+    _ProgressReporter,
+    _ScapySegmentReader,
+    _TcpFlow,
+    _finish_flow,
+    _load_cached_results,
+    _parse_associate,
+    _store_cached_results,
+    extract_dicom_metadata_from_pcap,
+    extract_relevant_metadata,
+)
+from backend.protocols.dicom.utils import create_associate_ac_pdu, create_associate_rq_pdu
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+IMPLICIT_VR_LE = "1.2.840.10008.1.2"
+
+
+def test_tcp_flow_drops_retransmitted_bytes():
+    """Full and partial retransmissions don't duplicate payload bytes."""
+    flow = _TcpFlow()
+    flow.add_segment(1000, b"abcd")
+    flow.add_segment(1000, b"abcd") # Full retransmission
+    flow.add_segment(1002, b"cdef") # Overlaps the last two bytes
+    flow.add_segment(1006, b"gh")
+    assert flow.reassemble() == b"abcdefgh"
+
+
+def test_tcp_flow_sequence_wraparound():
+    """Sequence numbers wrapping past 2**32 are still treated as in order."""
+    flow = _TcpFlow()
+    flow.add_segment(0xFFFFFFFE, b"ab")
+    flow.add_segment(0, b"cd")
+    flow.add_segment(0xFFFFFFFF, b"bc") # Retransmission across the wrap
+    assert flow.reassemble() == b"abcd"
+
+
+def test_tcp_flow_reorders_segments():
+    """Segments captured out of order are joined in sequence order."""
+    flow = _TcpFlow()
+    flow.add_segment(1004, b"ef")
+    flow.add_segment(1000, b"abcd") # Arrived before the first-seen segment
+    flow.add_segment(1006, b"gh")
+    flow.add_segment(1002, b"cd") # Late retransmission
+    assert flow.reassemble() == b"abcdefgh"
+
+
+def _flow(*payloads):
+    flow = _TcpFlow()
+    flow.packet_count = len(payloads) + 2
+    seq = 1
+    for payload in payloads:
+        flow.add_segment(seq, payload)
+        seq += len(payload)
+    return flow
+
+
+def test_finish_flow_skips_repeated_sessions():
+    """A session repeating an earlier one between the same peers is skipped before reassembly."""
+    seen_fingerprints, stream_hashes = set(), set()
+    assert _finish_flow((1, 2, 50000, 104), _flow(b"assoc", b"data"), seen_fingerprints, stream_hashes) == b"assocdata"
+    assert _finish_flow((1, 2, 50001, 104), _flow(b"assoc", b"data"), seen_fingerprints, stream_hashes) is None
+    assert _finish_flow((1, 2, 50002, 104), _flow(b"assoc", b"other"), seen_fingerprints, stream_hashes) == b"assocother"
+
+
+@pytest.mark.parametrize("stream_data", [
+    b"GET / HTTP/1.1\r\nHost: example\r\n\r\n",
+    b"\x16\x03\x01\x00\xa5\x01\x00\x00\xa1\x03\x03", # TLS ClientHello
+    b"\x01\x00\x00\x00\xff\xff", # A-ASSOCIATE-RQ header with a length past the stream end
+    b"\x04\x00",
+])
+def test_non_dicom_stream_rejected(stream_data):
+    """Streams that don't start with a plausible PDU header yield no metadata."""
+    assert extract_relevant_metadata(stream_data, ("10.0.0.1", "10.0.0.2", 104)) is None
+
+
+def test_strip_ae_fields_numpy_matches_python(monkeypatch):
+    """The batched NumPy padding strip gives the same title bounds as the per-block fallback."""
+    pytest.importorskip("numpy")
+    blocks = [b"  SCP_AE".ljust(16, b" ") + b"SCU_AE".ljust(16, b"\x00"), b" " * 32, b"A" * 16 + b" B C ".ljust(16)] * 30
+    batched = dicom_pcap_extractor._strip_ae_fields(blocks)
+    monkeypatch.setattr(dicom_pcap_extractor, "HAS_NUMPY", False)
+    assert batched == dicom_pcap_extractor._strip_ae_fields(blocks)
+    assert [(b[s0:e0], b[s1:e1]) for b, (s0, e0, s1, e1) in zip(blocks[:3], batched)] == [
+        (b"SCP_AE", b"SCU_AE"), (b"", b""), (b"A" * 16, b"B C"),
+    ]
+
+
+def test_parse_associate_rq():
+    """AE titles, presentation contexts and user information are read from an RQ."""
+    pdu = create_associate_rq_pdu(
+        calling_ae_title="SCU_AE",
+        called_ae_title="SCP_AE",
+        application_context_name="1.2.840.10008.3.1.1.1",
+        presentation_contexts_input=[{"id": 1, "abstract_syntax": CT_IMAGE_STORAGE, "transfer_syntaxes": [IMPLICIT_VR_LE]}],
+    )
+    info = _parse_associate(memoryview(pdu)[6:])
+    assert (info["CallingAE"], info["CalledAE"]) == ("SCU_AE", "SCP_AE")
+    assert info["ApplicationContext"] == "1.2.840.10008.3.1.1.1"
+    assert info["PresentationContexts"] == {1: {"AbstractSyntax": CT_IMAGE_STORAGE, "TransferSyntaxes": [IMPLICIT_VR_LE]}}
+    assert info["ImplementationClassUID"]
+    assert info["MaxLength"] is not None
+
+
+def test_parse_associate_ac_results():
+    """Presentation context results are read from an AC."""
+    pdu = create_associate_ac_pdu(
+        calling_ae_title="SCP_AE",
+        called_ae_title="SCU_AE",
+        application_context_name="1.2.840.10008.3.1.1.1",
+        presentation_contexts_results_input=[{"id": 1, "result": 0, "transfer_syntax": IMPLICIT_VR_LE}],
+    )
+    info = _parse_associate(memoryview(pdu)[6:])
+    assert info["PresentationContexts"] == {1: {"Result": 0, "TransferSyntaxes": [IMPLICIT_VR_LE]}}
+
+
+def test_parse_associate_rejects_short_pdu():
+    """A PDU body shorter than the fixed A-ASSOCIATE fields raises ValueError."""
+    with pytest.raises(ValueError):
+        _parse_associate(b"\x00\x01" + b" " * 40)
+
+
+def _p_data_tf(*pdvs):
+    """Builds a P-DATA-TF PDU from (context_id, message_control_header, data) tuples."""
+    items = b"".join(struct.pack(">IBB", len(data) + 2, context_id, mch) + data for context_id, mch, data in pdvs)
+    return struct.pack(">BBI", 0x04, 0, len(items)) + items
+
+
+def test_p_data_skips_command_pdvs():
+    """Command PDVs are not mixed into the data set; data fragments are joined and parsed."""
+    manufacturer = struct.pack("<HHI", 0x0008, 0x0070, 4) + b"ACME" # Implicit VR Little Endian
+    stream = _p_data_tf(
+        (1, 0x03, b"\xff" * 12), # Command, last fragment
+        (1, 0x00, manufacturer[:5]), # Data, more fragments follow
+        (1, 0x02, manufacturer[5:]), # Data, last fragment
+    )
+    metadata = extract_relevant_metadata(stream, ("10.0.0.1", "10.0.0.2", 104))
+    assert metadata is not None
+    assert metadata.Manufacturer == "ACME"
+
+
+def test_p_data_stops_once_all_tags_found(monkeypatch):
+    """Once every wanted tag has a value, later P-DATA datasets are not parsed."""
+    elements = [
+        (0x0008, 0x0070, b"ACME"), (0x0008, 0x1010, b"ST01"), (0x0008, 0x1090, b"CT01"),
+        (0x0018, 0x1000, b"SN01"), (0x0018, 0x1020, b"V1.0"), (0x0018, 0x5010, b"TD01"),
+    ]
+    dataset = b"".join(struct.pack("<HHI", group, element, len(value)) + value for group, element, value in elements)
+    stream = _p_data_tf((1, 0x02, dataset)) + _p_data_tf((1, 0x02, dataset))
+
+    dcmread_calls = []
+    real_dcmread = dicom_pcap_extractor.pydicom.dcmread
+    monkeypatch.setattr(dicom_pcap_extractor.pydicom, "dcmread", lambda *a, **kw: dcmread_calls.append(1) or real_dcmread(*a, **kw))
+
+    metadata = extract_relevant_metadata(stream, ("10.0.0.1", "10.0.0.2", 104))
+    assert metadata.DeviceSerialNumber == "SN01"
+    assert len(dcmread_calls) == 1
+
+
+def test_data_pdvs_offsets_and_truncation():
+    """data_pdvs returns data PDV offsets, skips command PDVs and stops at a truncated item."""
+    body = _p_data_tf((1, 0x03, b"CMD"), (3, 0x00, b"abc"), (3, 0x02, b"de"))[6:]
+    pdvs, stop = data_pdvs(body, 0, len(body))
+    assert [(ctx, last, body[start:end]) for ctx, last, start, end in pdvs] == [(3, False, b"abc"), (3, True, b"de")]
+    assert stop == len(body)
+
+    pdvs, stop = data_pdvs(body, 0, len(body) - 1)
+    assert len(pdvs) == 1
+    assert stop < len(body) - 1
+
+
+def test_mmap_reader_segments(tmp_path):
+    """TCP segments are decoded from Ethernet pcap records; VLAN tags and padding are handled."""
+    pcap_path = tmp_path / "capture.pcap"
+    wrpcap(str(pcap_path), [
+        Ether() / IP(src="10.0.0.1", dst="10.0.0.2") / TCP(sport=1234, dport=104, seq=7, flags="PA") / Raw(b"hello"),
+        Ether() / Dot1Q(vlan=5) / IP(src="10.0.0.2", dst="10.0.0.1") / TCP(sport=104, dport=1234, seq=9, flags="A") / Raw(b"x") / Padding(b"\x00" * 5),
+        Ether() / IP(src="10.0.0.1", dst="10.0.0.2") / UDP(sport=53, dport=53),
+    ])
+    with _MmapSegmentReader(pcap_path) as reader:
+        segments = list(reader)
+        assert reader.tell() == pcap_path.stat().st_size
+    assert segments == [
+        (0x0A000001, 0x0A000002, 1234, 104, 0x18, 7, b"hello"),
+        (0x0A000002, 0x0A000001, 104, 1234, 0x10, 9, b"x"),
+        None,
+    ]
+
+
+def test_mmap_reader_rejects_non_ethernet(tmp_path):
+    """Other link types are left to the Scapy reader."""
+    pcap_path = tmp_path / "capture.pcap"
+    wrpcap(str(pcap_path), [IP(src="10.0.0.1", dst="10.0.0.2") / TCP()], linktype=101) # DLT_RAW
+    with pytest.raises(ValueError):
+        _MmapSegmentReader(pcap_path)
+
+
+@pytest.mark.parametrize("packets, writer", [
+    ([Ether() / IP(src="10.0.0.1", dst="10.0.0.2") / TCP(sport=1234, dport=104, seq=7, flags="PA") / Raw(b"hello")], wrpcapng),
+    ([CookedLinux() / IP(src="10.0.0.1", dst="10.0.0.2") / TCP(sport=1234, dport=104, seq=7, flags="PA") / Raw(b"hello")], wrpcap),
+])
+def test_scapy_reader_segments(tmp_path, monkeypatch, packets, writer):
+    """pcapng Ethernet records take the byte-level path, other link types are dissected by Scapy."""
+    monkeypatch.setattr(storage, "SESSIONS_BASE_DIR", tmp_path)
+    writer(str(storage.get_capture_path("sess")), packets)
+    with _ScapySegmentReader("sess") as reader:
+        assert list(reader) == [(0x0A000001, 0x0A000002, 1234, 104, 0x18, 7, b"hello")]
+
+
+def test_results_cache_keyed_by_capture_stat(tmp_path, monkeypatch):
+    """Cached results are returned only while the capture's size and mtime are unchanged."""
+    monkeypatch.setattr(storage, "SESSIONS_BASE_DIR", tmp_path)
+    capture = storage.get_capture_path("sess")
+    capture.write_bytes(b"\x00" * 24)
+    results = {"10.0.0.1-10.0.0.2": {"CallingAE": "SCU", "server_ports": [104]}}
+
+    _store_cached_results("sess", capture.stat(), results)
+    assert _load_cached_results("sess", capture.stat()) == results
+
+    capture.write_bytes(b"\x00" * 48)
+    assert _load_cached_results("sess", capture.stat()) is None
+
+
+def test_results_cache_ignores_other_versions(tmp_path, monkeypatch):
+    """Results cached by another extractor version are not reused; the cache gets the usual file mode."""
+    monkeypatch.setattr(storage, "SESSIONS_BASE_DIR", tmp_path)
+    capture = storage.get_capture_path("sess")
+    capture.write_bytes(b"\x00" * 24)
+    results = {"10.0.0.1-10.0.0.2": {"CallingAE": "SCU"}}
+
+    _store_cached_results("sess", capture.stat(), results)
+    assert not list(capture.parent.glob("*.tmp"))
+    cache_path = storage.get_session_filepath("sess", dicom_pcap_extractor._RESULTS_CACHE_FILENAME)
+    assert cache_path.stat().st_mode & 0o777 == storage._NEW_FILE_MODE
+
+    monkeypatch.setattr(dicom_pcap_extractor, "_RESULTS_CACHE_VERSION", dicom_pcap_extractor._RESULTS_CACHE_VERSION + 1)
+    assert _load_cached_results("sess", capture.stat()) is None
+
+
+def test_progress_reporter_throttles_by_time(monkeypatch):
+    """Progress is reported at most every _PROGRESS_INTERVAL seconds, 100 always."""
+    now = [10.0]
+    monkeypatch.setattr(dicom_pcap_extractor.time, "monotonic", lambda: now[0])
+    reported = []
+    progress = _ProgressReporter(reported.append)
+
+    progress.report(1)
+    progress.report(2) # Too soon
+    now[0] += 0.3
+    progress.report(3)
+    progress.report(100)
+    assert reported == [1, 3, 100]
+
+
+def _write_dicom_capture(dataset):
+    """Writes the capture of session "sess": an A-ASSOCIATE-RQ then a P-DATA-TF carrying `dataset`."""
+    rq = create_associate_rq_pdu(
+        calling_ae_title="SCU", called_ae_title="SCP", application_context_name="1.2.840.10008.3.1.1.1",
+        presentation_contexts_input=[{"id": 1, "abstract_syntax": CT_IMAGE_STORAGE, "transfer_syntaxes": [IMPLICIT_VR_LE]}],
+    )
+    stream = rq + _p_data_tf((1, 0x02, dataset))
+    wrpcap(str(storage.get_capture_path("sess")), [
+        Ether() / IP(src="10.0.0.1", dst="10.0.0.2") / TCP(sport=5000, dport=104, flags="S", seq=0),
+        Ether() / IP(src="10.0.0.1", dst="10.0.0.2") / TCP(sport=5000, dport=104, flags="PA", seq=1) / Raw(stream),
+        Ether() / IP(src="10.0.0.1", dst="10.0.0.2") / TCP(sport=5000, dport=104, flags="FA", seq=1 + len(stream)),
+    ])
+
+
+def test_extract_in_process_without_pool(tmp_path, monkeypatch):
+    """With max_workers=1 the flows are parsed in the calling process."""
+    monkeypatch.setattr(storage, "SESSIONS_BASE_DIR", tmp_path)
+    monkeypatch.setattr(dicom_pcap_extractor, "ProcessPoolExecutor", None) # Fails if a pool is created
+    _write_dicom_capture(struct.pack("<HHI", 0x0008, 0x0070, 4) + b"ACME")
+
+    results = extract_dicom_metadata_from_pcap("sess", max_workers=1)
+    assert results["10.0.0.1-10.0.0.2"]["CallingAE"] == "SCU"
+    assert results["10.0.0.1-10.0.0.2"]["Manufacturer"] == "ACME"
+
+
+def test_extract_multi_valued_elements_are_json_lists(tmp_path, monkeypatch):
+    """A multi-valued element (SoftwareVersions "V1\\V2") comes out as a list of str, so the results serialize."""
+    monkeypatch.setattr(storage, "SESSIONS_BASE_DIR", tmp_path)
+    _write_dicom_capture(struct.pack("<HHI", 0x0018, 0x1020, 6) + b"V1\\V2 ")
+
+    results = extract_dicom_metadata_from_pcap("sess", max_workers=1)
+    assert results["10.0.0.1-10.0.0.2"]["SoftwareVersions"] == ["V1", "V2"]
+    json.dumps(results)